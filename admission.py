@@ -0,0 +1,264 @@
+"""
+Admission control for the routes that start expensive work
+
+POST / and /api/batch (Whisper and GPT-4), /make-call and /call-ivr (a
+call, then Whisper and GPT-4 on its recording), /api/campaigns and
+/api/ivr-trees (many such calls) are admitted by two checks before any of
+that work starts:
+
+- Overload: while this worker already has ADMISSION_MAX_IN_FLIGHT such
+  requests open, or ADMISSION_MAX_QUEUE OpenAI calls waiting for a scheduler
+  slot, new ones are refused with 503 and a Retry-After taken from the
+  scheduler's recent queue waits.
+- Per client: each client (by address, see client_key()) has a token bucket of
+  RATE_LIMIT_BURST tokens refilled at RATE_LIMIT_PER_MINUTE. A request needs
+  its estimated cost in tokens, else it is refused with 429 and a
+  Retry-After of when the bucket will hold enough. A request costs one
+  token for its GPT-4 work plus one per AUDIO_SECONDS_PER_TOKEN of audio to
+  transcribe: a call is charged its expected recording length
+  (CALL_ESTIMATED_SECONDS) up front, and an upload, whose length is only
+  known once its audio has been probed, is charged its duration before
+  transcription (not at all if it is a duplicate). A campaign is charged a
+  call for every number as it dials it, an exploration for every call as it
+  places it.
+  Those charges may take the bucket below zero, which holds the client's
+  next request back until the cost has refilled.
+
+Buckets live in the shared SQLite database, so the limit holds across
+gunicorn workers; the overload check is per worker, like the scheduler.
+"""
+
+import os
+import math
+import time
+import threading
+import logging
+from flask import request
+import db
+from scheduler import openai_scheduler, OPENAI_CONCURRENCY
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Turn admission control off entirely (e.g. for load tests of the pipeline itself)
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'True').lower() == 'true'
+
+# Tokens a client may spend at once, and how fast they come back (tokens per minute)
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 10))
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', 6))
+
+# Seconds of audio that cost one token
+AUDIO_SECONDS_PER_TOKEN = float(os.getenv('AUDIO_SECONDS_PER_TOKEN', 60))
+
+# Expected recording length of a placed call, charged when it is placed (seconds)
+CALL_ESTIMATED_SECONDS = float(os.getenv('CALL_ESTIMATED_SECONDS', 120))
+
+# Admitted requests open at once in this worker before new ones get 503
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', OPENAI_CONCURRENCY * 4))
+
+# OpenAI calls waiting for a scheduler slot in this worker before new requests get 503
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', OPENAI_CONCURRENCY * 8))
+
+# Bounds of the Retry-After sent with a 503 (seconds)
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+# How often buckets that have refilled completely are purged by each process (seconds)
+PURGE_INTERVAL = 5 * 60
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS client_buckets (
+        client TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+]
+
+
+def client_key():
+    """
+    Who the current request is admitted, charged and scheduled as: its address
+
+    Behind a proxy this is the address the proxy saw, once create_app() trusts
+    its X-Forwarded-For (TRUSTED_PROXIES).
+    """
+    return request.remote_addr or 'unknown'
+
+
+def audio_cost(seconds):
+    """Tokens charged for this many seconds of audio"""
+    return max(0.0, seconds) / AUDIO_SECONDS_PER_TOKEN
+
+
+# Tokens one placed call costs: GPT-4 work plus its expected recording
+CALL_COST = 1.0 + audio_cost(CALL_ESTIMATED_SECONDS)
+
+# Routes admitted here (POST only) and the tokens each costs on admission. A
+# campaign or a DTMF tree exploration is admitted at the cost of one call and
+# charged for the rest as it places them
+ADMITTED_ENDPOINTS = {
+    'web.index': 1.0,
+    'calls.make_call': CALL_COST,
+    'calls.call_ivr': CALL_COST,
+    'api.batch_upload': 1.0,
+    'api.start_campaign': CALL_COST,
+    'api.explore_ivr_tree': CALL_COST,
+}
+
+
+class Rejected(Exception):
+    """
+    A request refused by admission control
+
+    Attributes:
+        status (int): 429 (client over its rate) or 503 (worker overloaded)
+        retry_after (int): Seconds the client should wait before retrying
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Per-client token buckets plus an in-flight and queue-depth cap
+
+    Args:
+        path (str): Database path (defaults to db.default_database_path())
+        burst (float): Bucket size in tokens
+        per_minute (float): Refill rate in tokens per minute
+        max_in_flight (int): Admitted requests open at once in this worker
+        max_queue (int): OpenAI calls waiting in the scheduler before refusing work
+        scheduler (PriorityScheduler): Whose queue depth counts as load
+    """
+
+    def __init__(self, path=None, burst=RATE_LIMIT_BURST, per_minute=RATE_LIMIT_PER_MINUTE,
+                 max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 scheduler=openai_scheduler):
+        self.path = path
+        self.burst = max(1.0, burst)
+        self.rate = max(per_minute, 0.001) / 60
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(1, max_queue)
+        self.scheduler = scheduler
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._last_purge = 0
+
+    def _conn(self):
+        db.ensure_schema(self.path, 'admission', SCHEMA)
+        return db.connect(self.path)
+
+    def admit(self, client, cost=1.0):
+        """
+        Admit a request or refuse it; pair an admission with done()
+
+        Args:
+            client (str): Who is asking (see client_key())
+            cost (float): Tokens the request is known to cost up front
+
+        Raises:
+            Rejected: 503 if this worker is overloaded, 429 if the client's
+                bucket does not hold cost tokens
+        """
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                raise Rejected("The service is busy. Please try again shortly.", 503, self._overload_retry_after())
+            if self.queue_depth() >= self.max_queue:
+                raise Rejected("The service is busy. Please try again shortly.", 503, self._overload_retry_after())
+            self._in_flight += 1
+        try:
+            self._take(client, min(cost, self.burst))
+        except BaseException:
+            self.done()
+            raise
+
+    def done(self):
+        """An admitted request has finished"""
+        with self._lock:
+            self._in_flight -= 1
+
+    def charge(self, client, cost):
+        """
+        Spend tokens on work found to be needed after admission (e.g. the audio of an upload)
+
+        Never refuses: the bucket may go negative, and the client's next
+        request waits until it has refilled.
+        """
+        if cost <= 0:
+            return
+        conn = self._conn()
+        now = time.time()
+        with db.transaction(conn):
+            tokens = self._refilled(conn, client, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO client_buckets (client, tokens, updated_at) VALUES (?, ?, ?)",
+                (client, tokens - cost, now)
+            )
+        logger.debug(f"Charged {client} {cost:.2f} tokens ({tokens - cost:.2f} left)")
+
+    def queue_depth(self):
+        """OpenAI calls waiting for a slot in this worker"""
+        return sum(c['queued'] for c in self.scheduler.stats()['classes'].values())
+
+    def stats(self):
+        """
+        Returns:
+            dict: 'in_flight', 'max_in_flight', 'queued', 'max_queue', 'burst'
+                and 'per_minute'
+        """
+        return {
+            'in_flight': self._in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queued': self.queue_depth(),
+            'max_queue': self.max_queue,
+            'burst': self.burst,
+            'per_minute': self.rate * 60
+        }
+
+    def _take(self, client, cost):
+        """Take cost tokens from the client's bucket or raise a 429"""
+        conn = self._conn()
+        now = time.time()
+        with db.transaction(conn):
+            tokens = self._refilled(conn, client, now)
+            if tokens >= cost:
+                conn.execute(
+                    "INSERT OR REPLACE INTO client_buckets (client, tokens, updated_at) VALUES (?, ?, ?)",
+                    (client, tokens - cost, now)
+                )
+        self._maybe_purge(conn, now)
+        if tokens < cost:
+            retry_after = max(1, math.ceil((cost - tokens) / self.rate))
+            logger.warning(f"Rate limit for {client}: {tokens:.2f} of {cost:.2f} tokens, retry in {retry_after}s")
+            raise Rejected("Too many requests. Please wait before trying again.", 429, retry_after)
+
+    def _refilled(self, conn, client, now):
+        """The client's tokens as of now (caller holds a transaction)"""
+        row = conn.execute(
+            "SELECT tokens, updated_at FROM client_buckets WHERE client = ?", (client,)
+        ).fetchone()
+        if row is None:
+            return self.burst
+        return min(self.burst, row['tokens'] + (now - row['updated_at']) * self.rate)
+
+    def _overload_retry_after(self):
+        """How long the queue is taking to drain, from the scheduler's recent waits"""
+        waits = [c['wait_p95'] for c in self.scheduler.stats()['classes'].values()]
+        return int(min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(max(waits)))))
+
+    def _maybe_purge(self, conn, now):
+        """Drop buckets that have refilled completely, at most once every five minutes"""
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            conn.execute(
+                "DELETE FROM client_buckets WHERE tokens + (? - updated_at) * ? >= ?", (now, self.rate, self.burst)
+            )
+
+
+# Shared controller for this process
+admission = AdmissionController()
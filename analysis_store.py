@@ -0,0 +1,189 @@
+import json
+import time
+import logging
+import db
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Upper bound on page size for history queries
+MAX_PAGE_SIZE = 100
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS analyses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        call_sid TEXT,
+        phone_number TEXT,
+        transcript TEXT NOT NULL,
+        flowchart TEXT NOT NULL,
+        metrics TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        visualization_data TEXT NOT NULL,
+        dtmf_sequence TEXT NOT NULL DEFAULT '[]',
+        complexity_rating INTEGER,
+        cx_score REAL,
+        issues_found INTEGER,
+        total_nodes INTEGER,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_analyses_created_at ON analyses (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_analyses_phone_created ON analyses (phone_number, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_analyses_source_created ON analyses (source, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_analyses_call_sid ON analyses (call_sid)",
+    "CREATE INDEX IF NOT EXISTS idx_analyses_complexity ON analyses (complexity_rating, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_analyses_cx_score ON analyses (cx_score)",
+]
+
+# Columns returned by history listings (the large text blobs are left out)
+LIST_COLUMNS = (
+    "id, source, call_sid, phone_number, complexity_rating, cx_score, "
+    "issues_found, total_nodes, summary, created_at, updated_at"
+)
+
+
+class AnalysisStore:
+    """
+    Persistent history of IVR analyses.
+
+    Every completed analysis (browser upload, Twilio call or VOXO call) is
+    stored with its transcript, flowchart, metrics and summary. Key metrics
+    are copied into indexed columns so history can be filtered by phone
+    number, time, source, complexity and customer experience score.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def _conn(self):
+        db.ensure_schema(self.path, 'analysis_store', SCHEMA)
+        return db.connect(self.path)
+
+    def save(self, transcript, flowchart, metrics, summary, visualization_data,
+             source='upload', phone_number=None, call_sid=None, dtmf_sequence=None):
+        """
+        Store a completed analysis
+
+        Args:
+            transcript (str): The IVR transcript
+            flowchart (str): The Mermaid flowchart
+            metrics (dict): IVRAnalytics.get_metrics() output
+            summary (dict): IVRAnalytics.get_summary() output
+            visualization_data (dict): IVRAnalytics.get_visualization_data() output
+            source (str): Where the audio came from ('upload', 'twilio' or 'voxo')
+            phone_number (str): The dialled number for call analyses
+            call_sid (str): The Twilio CallSid or VOXO call id
+            dtmf_sequence (list): DTMF digits pressed during the call
+
+        Returns:
+            int: The id of the stored analysis
+        """
+        now = time.time()
+        complexity = metrics.get('complexity', {})
+        cx = metrics.get('customer_experience', {})
+        cursor = self._conn().execute(
+            """
+            INSERT INTO analyses (
+                source, call_sid, phone_number, transcript, flowchart, metrics, summary,
+                visualization_data, dtmf_sequence, complexity_rating, cx_score,
+                issues_found, total_nodes, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                source, call_sid, phone_number, transcript, flowchart,
+                json.dumps(metrics), json.dumps(summary), json.dumps(visualization_data),
+                json.dumps(dtmf_sequence or []),
+                complexity.get('complexity_rating'), cx.get('overall_cx_score'),
+                len(metrics.get('potential_issues', [])), complexity.get('total_nodes'),
+                now, now
+            )
+        )
+        logger.info(f"Stored analysis {cursor.lastrowid} (source: {source})")
+        return cursor.lastrowid
+
+    def get(self, analysis_id):
+        """Return a full analysis by id, or None"""
+        row = self._conn().execute("SELECT * FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+        return self._full_row(row) if row else None
+
+    def latest(self):
+        """Return the most recent analysis, or None"""
+        row = self._conn().execute(
+            "SELECT * FROM analyses ORDER BY created_at DESC LIMIT 1"
+        ).fetchone()
+        return self._full_row(row) if row else None
+
+    def query(self, phone_number=None, source=None, call_sid=None, since=None, until=None,
+              min_complexity=None, max_complexity=None, min_cx_score=None, max_cx_score=None,
+              page=1, per_page=20):
+        """
+        Return one page of analyses matching the given filters, newest first
+
+        Args:
+            phone_number (str): Only analyses of this dialled number
+            source (str): Only analyses from this source
+            call_sid (str): Only analyses of this call
+            since (float): Only analyses created at or after this Unix timestamp
+            until (float): Only analyses created before this Unix timestamp
+            min_complexity (int): Minimum complexity rating (1-5)
+            max_complexity (int): Maximum complexity rating (1-5)
+            min_cx_score (float): Minimum customer experience score
+            max_cx_score (float): Maximum customer experience score
+            page (int): 1-based page number
+            per_page (int): Page size (capped at MAX_PAGE_SIZE)
+
+        Returns:
+            dict: 'items', 'page', 'per_page', 'total' and 'pages'
+        """
+        filters = [
+            ('phone_number = ?', phone_number),
+            ('source = ?', source),
+            ('call_sid = ?', call_sid),
+            ('created_at >= ?', since),
+            ('created_at < ?', until),
+            ('complexity_rating >= ?', min_complexity),
+            ('complexity_rating <= ?', max_complexity),
+            ('cx_score >= ?', min_cx_score),
+            ('cx_score <= ?', max_cx_score),
+        ]
+        clauses = [clause for clause, value in filters if value is not None]
+        params = [value for _, value in filters if value is not None]
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+        page = max(1, int(page))
+        per_page = max(1, min(MAX_PAGE_SIZE, int(per_page)))
+
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM analyses {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {LIST_COLUMNS} FROM analyses {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page]
+        ).fetchall()
+
+        items = []
+        for row in rows:
+            item = dict(row)
+            item['summary'] = json.loads(item['summary'])
+            items.append(item)
+
+        return {
+            'items': items,
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'pages': (total + per_page - 1) // per_page
+        }
+
+    def _full_row(self, row):
+        """Decode the JSON columns of a full analysis row"""
+        analysis = dict(row)
+        for key in ('metrics', 'summary', 'visualization_data', 'dtmf_sequence'):
+            analysis[key] = json.loads(analysis[key])
+        return analysis
+
+
+# Shared store for this process
+analysis_store = AnalysisStore()
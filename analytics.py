@@ -7,6 +7,11 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever a change to the analysis (or to what insights.html renders from it)
+# changes the output for the same transcript and flowchart; cached results and
+# browser ETags are keyed on it.
+ANALYTICS_VERSION = '1'
+
 class IVRAnalytics:
     """
     Analyze IVR (Interactive Voice Response) transcripts and flowcharts
@@ -0,0 +1,92 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from analytics import IVRAnalytics, ANALYTICS_VERSION
+from metrics import cache_hits, cache_misses
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Number of analytics results kept in memory per process
+ANALYTICS_CACHE_SIZE = int(os.getenv('ANALYTICS_CACHE_SIZE', 256))
+
+def content_key(transcript, flowchart):
+    """
+    Hash the inputs of an analysis together with the analytics version
+
+    Args:
+        transcript (str): The IVR transcript
+        flowchart (str): The Mermaid flowchart
+
+    Returns:
+        str: A hex SHA-256 digest identifying the analytics output
+    """
+    digest = hashlib.sha256()
+    for part in (ANALYTICS_VERSION, transcript or '', flowchart or ''):
+        encoded = part.encode('utf-8')
+        # Length-prefix each part so ('ab', 'c') and ('a', 'bc') hash differently
+        digest.update(len(encoded).to_bytes(8, 'big'))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class AnalyticsCache:
+    """
+    LRU cache of IVRAnalytics results keyed by content_key().
+
+    Analytics are a pure function of (transcript, flowchart, version), so a
+    result computed once can be reused for every later view of the same data.
+    """
+
+    def __init__(self, max_size=ANALYTICS_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+
+    def get(self, key):
+        """Return a cached result and mark it as recently used, or None"""
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        """Store a result, evicting the least recently used entry when full"""
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def analyze(self, transcript, flowchart):
+        """
+        Return analytics for a transcript and flowchart, computing them on a miss
+
+        Returns:
+            dict: 'key', 'metrics', 'summary' and 'visualization_data'
+        """
+        key = content_key(transcript, flowchart)
+        result = self.get(key)
+        if result is not None:
+            cache_hits.inc(cache='analytics')
+            logger.debug(f"Analytics cache hit for {key[:12]}")
+            return result
+
+        cache_misses.inc(cache='analytics')
+        logger.debug(f"Analytics cache miss for {key[:12]}")
+        analytics = IVRAnalytics(transcript, flowchart)
+        result = {
+            'key': key,
+            'metrics': analytics.get_metrics(),
+            'summary': analytics.get_summary(),
+            'visualization_data': analytics.get_visualization_data()
+        }
+        self.put(key, result)
+        return result
+
+
+# Shared cache for this process
+analytics_cache = AnalyticsCache()
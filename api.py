@@ -1,175 +1,254 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+"""
+JSON API under /api: the analysis history, batch uploads, outbound
+campaigns, DTMF tree exploration, OpenAI scheduler stats and admission
+control stats
+"""
+
 import os
-import tempfile
-from werkzeug.utils import secure_filename
-from werkzeug.exceptions import RequestEntityTooLarge
-from transcriber import transcribe_audio
-from flow_builder import generate_flowchart
-from dotenv import load_dotenv
+import json
+import math
+import time
 import logging
-from flask_cors import CORS
-
-# Import API blueprint
-from api import api
-
-# Load environment variables
-load_dotenv()
-
-# Configure application
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
-
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limit uploads to 16MB
-app.config['ALLOWED_EXTENSIONS'] = {'mp3', 'wav', 'ogg', 'm4a'}
-app.secret_key = os.getenv("SECRET_KEY", os.urandom(24))
-
-# For Render free tier (no persistent disk), use temp directory
-if os.getenv('RENDER', 'False').lower() == 'true':
-    app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
-    app.config['USE_TEMP_FILES'] = True
-else:
-    # Local development uses local uploads directory
-    app.config['UPLOAD_FOLDER'] = 'uploads'
-    app.config['USE_TEMP_FILES'] = False
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG if os.getenv('FLASK_DEBUG', 'False').lower() == 'true' else logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+import threading
+from flask import Blueprint, request, jsonify, url_for, g, Response, stream_with_context
+from analysis_store import analysis_store
+from scheduler import openai_scheduler, priority
+from admission import admission, client_key
+from batch import BatchRun, read_batch, BATCH_MAX_BYTES
+import campaign
+import explorer
+
+# Configure logger
 logger = logging.getLogger(__name__)
 
-# Register the API blueprint
-app.register_blueprint(api, url_prefix='/api')
-
-def allowed_file(filename):
-    """Check if the file has an allowed extension"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    transcript = None
-    flowchart = None
-    error = None
-
-    # Ensure upload directory exists (for local development)
-    if not app.config['USE_TEMP_FILES']:
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-    if request.method == 'POST':
-        logger.debug("Received POST request")
-        
-        # Check if file part exists in request
-        if 'file' not in request.files:
-            logger.debug("No file part in the request")
-            return render_template('index.html', error="No file uploaded.")
-
-        file = request.files['file']
-        
-        # Check if file was selected
-        if file.filename == '':
-            logger.debug("No selected file")
-            return render_template('index.html', error="No file selected.")
-
-        # Validate file type
-        if not allowed_file(file.filename):
-            logger.debug(f"Invalid file type: {file.filename}")
-            return render_template('index.html', error="Invalid file type. Please upload MP3, WAV, OGG, or M4A files.")
-
-        try:
-            # Save file securely (using different methods based on environment)
-            if app.config['USE_TEMP_FILES']:
-                # Create a temporary file with the right extension
-                suffix = '.' + file.filename.rsplit('.', 1)[1].lower()
-                # We need to create a named temporary file that doesn't get deleted when closed
-                temp_file = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
-                file.save(temp_file.name)
-                filepath = temp_file.name
-                logger.debug(f"Saved file to temporary location: {filepath}")
+api = Blueprint('api', __name__)
+
+def number_field(data, name, default, minimum, maximum=None, kind=int):
+    """
+    A numeric field of a JSON request body
+
+    Args:
+        data (dict): The request body
+        name (str): The field
+        default: Its value when the field is missing
+        minimum: Smallest accepted value
+        maximum: Largest accepted value (None for no limit)
+        kind (type): int or float
+
+    Raises:
+        ValueError: The field is not a number in range (the message names it, for a 400)
+    """
+    value = data.get(name, default)
+    try:
+        if isinstance(value, bool):
+            raise TypeError(name)
+        value = kind(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value) or value < minimum or (maximum is not None and value > maximum):
+        limits = f"between {minimum} and {maximum}" if maximum is not None else f"at least {minimum}"
+        raise ValueError(f"{name} must be {limits}")
+    return value
+
+@api.route('/analyses', methods=['GET'])
+def list_analyses():
+    """Return a filtered, paginated page of the analysis history"""
+    try:
+        result = analysis_store.query(
+            phone_number=request.args.get('phone_number'),
+            source=request.args.get('source'),
+            call_sid=request.args.get('call_sid'),
+            since=request.args.get('since', type=float),
+            until=request.args.get('until', type=float),
+            min_complexity=request.args.get('min_complexity', type=int),
+            max_complexity=request.args.get('max_complexity', type=int),
+            min_cx_score=request.args.get('min_cx_score', type=float),
+            max_cx_score=request.args.get('max_cx_score', type=float),
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', 20, type=int)
+        )
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error querying analyses: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/analyses/<int:analysis_id>', methods=['GET'])
+def get_analysis(analysis_id):
+    """Return a single stored analysis"""
+    analysis = analysis_store.get(analysis_id)
+    if not analysis:
+        return jsonify({'error': 'Analysis not found'}), 404
+    return jsonify(analysis)
+
+@api.route('/batch', methods=['POST'])
+def batch_upload():
+    """Analyse many recordings (audio files or ZIP archives), streaming an NDJSON line per file as it finishes"""
+    # A folder of recordings is far larger than one upload
+    request.max_content_length = BATCH_MAX_BYTES
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'Send the recordings as multipart/form-data file parts'}), 400
+
+    started = time.time()
+    client = client_key()
+    # Someone is waiting on the stream, but a batch must not crowd out single uploads
+    with priority('standard', tenant=client):
+        run = BatchRun(client if g.get('admitted') else None)
+    try:
+        # Recordings start through the pipeline while the rest of the body arrives
+        for name, stored, error in read_batch(request.stream, boundary, request.max_form_memory_size):
+            if stored is None:
+                run.fail(name, error)
             else:
-                # Standard file saving for local development
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                logger.debug(f"Saved file to: {filepath}")
-
-            # Transcribe audio
-            try:
-                transcript = transcribe_audio(filepath)
-                logger.debug(f"Generated transcript: {transcript}")
-                
-                # Generate flowchart
-                try:
-                    flowchart = generate_flowchart(transcript)
-                    logger.debug("Flowchart generated successfully")
-                    
-                    # Remove triple backticks and 'mermaid' tag if present
-                    if flowchart.startswith("```") and "```" in flowchart:
-                        flowchart = "\n".join(flowchart.split("\n")[1:])
-                        if flowchart.endswith("```"):
-                            flowchart = flowchart[:-3]
-                    
-                    logger.debug(f"Processed flowchart: {flowchart}")
-                except Exception as e:
-                    logger.error(f"Error generating flowchart: {str(e)}")
-                    error = f"Error generating flowchart: {str(e)}"
-            except Exception as e:
-                logger.error(f"Error transcribing audio: {str(e)}")
-                error = f"Error transcribing audio: {str(e)}"
-            
-            # Clean up temporary file if using temp files
-            if app.config['USE_TEMP_FILES'] and os.path.exists(filepath):
-                try:
-                    os.unlink(filepath)
-                    logger.debug(f"Deleted temporary file: {filepath}")
-                except Exception as e:
-                    logger.warning(f"Could not delete temporary file: {str(e)}")
-        
-        except RequestEntityTooLarge:
-            logger.error("File too large")
-            error = "File too large. Maximum size is 16MB."
-        except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}")
-            error = f"An unexpected error occurred: {str(e)}"
-
-    return render_template('index.html', transcript=transcript, flowchart=flowchart, error=error)
-
-@app.route('/static/<path:filename>')
-def serve_static(filename):
-    """Serve static files"""
-    return send_from_directory('static', filename)
-
-@app.errorhandler(413)
-def request_entity_too_large(error):
-    """Handle file too large error"""
-    logger.error("File too large (413)")
-    return render_template('index.html', error="File too large. Maximum size is 16MB."), 413
-
-@app.errorhandler(500)
-def internal_server_error(error):
-    """Handle internal server errors"""
-    logger.error(f"Internal server error: {str(error)}")
-    return render_template('index.html', error="Internal server error. Please try again later."), 500
-
-@app.errorhandler(404)
-def page_not_found(error):
-    """Handle 404 errors"""
-    logger.error(f"Page not found: {request.path}")
-    return render_template('index.html', error="Page not found."), 404
-
-if __name__ == '__main__':
-    # Check for API key
-    if not os.getenv("OPENAI_API_KEY"):
-        logger.critical("OPENAI_API_KEY not set in environment variables")
-        print("ERROR: OPENAI_API_KEY not set. Please set it in your .env file.")
-        exit(1)
-    
-    # Get port from environment variable (for cloud platforms)
-    port = int(os.getenv('PORT', 5000))
-    
-    # Use environment variable to control debug mode
-    debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
-    
-    # Run the application
-    app.run(host='0.0.0.0', port=port, debug=debug_mode)
\ No newline at end of file
+                run.submit(name, stored)
+    except ValueError as e:
+        run.close()
+        logger.warning(f"Malformed batch upload: {str(e)}")
+        return jsonify({'error': 'Malformed upload. Please try again.'}), 400
+    except BaseException:
+        run.close()
+        raise
+
+    def lines():
+        counts = {'complete': 0, 'failed': 0}
+        try:
+            for result in run.results():
+                counts[result['status']] += 1
+                if result['status'] == 'complete':
+                    result['insights_url'] = url_for('web.insights', analysis_id=result['analysis_id'])
+                yield json.dumps(result) + '\n'
+            yield json.dumps({
+                'done': True, 'files': sum(counts.values()), **counts, 'seconds': round(time.time() - started, 1)
+            }) + '\n'
+        finally:
+            run.close()
+
+    logger.info(f"Batch upload from {client} received in {time.time() - started:.1f}s")
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+@api.route('/campaigns', methods=['POST'])
+def start_campaign():
+    """Start an outbound crawl of a list of numbers in the background (needs API_TOKEN)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('numbers'), list):
+        return jsonify({'error': 'numbers must be a non-empty list'}), 400
+    numbers = [str(n).strip() for n in data['numbers'] if str(n).strip()]
+    if not numbers:
+        return jsonify({'error': 'numbers must be a non-empty list'}), 400
+
+    provider_name = data.get('provider', 'twilio')
+    try:
+        options = {
+            'max_concurrency': number_field(
+                data, 'max_concurrency', os.getenv('CAMPAIGN_MAX_CONCURRENCY', 5), 1, 100
+            ),
+            'per_destination': number_field(data, 'per_destination', 1, 1, 10),
+            'max_attempts': number_field(data, 'max_attempts', 3, 1, 10),
+            'backoff': number_field(data, 'backoff', 60, 0, 24 * 60 * 60, kind=float)
+        }
+        provider = campaign.make_provider(
+            provider_name,
+            webhook_url=os.getenv('WEBHOOK_URL', request.url_root.rstrip('/')),
+            time_scale=number_field(data, 'time_scale', 1.0, 0.001, 1000, kind=float)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    crawl = campaign.Campaign(
+        providers=[(provider, options['max_concurrency'])],
+        numbers=numbers,
+        per_destination=options['per_destination'],
+        retry_policy=campaign.RetryPolicy(max_attempts=options['max_attempts'], backoff=options['backoff']),
+        # Admission took the first number's call; each further one is charged as it is dialled
+        client=client_key() if g.get('admitted') else None
+    )
+    crawl.sink = campaign.SqliteSink(crawl.id)
+    campaign.create_campaign_record(crawl.id, provider_name, len(numbers), options)
+
+    def run_campaign():
+        try:
+            crawl.run()
+        finally:
+            campaign.finish_campaign_record(crawl.id)
+
+    threading.Thread(target=run_campaign, name=f"campaign-{crawl.id}", daemon=True).start()
+    logger.info(f"Started campaign {crawl.id} with {len(numbers)} number(s) via {provider_name}")
+    return jsonify({
+        'campaign_id': crawl.id,
+        'total': len(numbers),
+        'status_url': url_for('api.campaign_status', campaign_id=crawl.id)
+    }), 202
+
+@api.route('/campaigns/<campaign_id>', methods=['GET'])
+def campaign_status(campaign_id):
+    """Return a campaign's progress and, optionally, a page of its results"""
+    progress = campaign.get_campaign_progress(campaign_id)
+    if not progress:
+        return jsonify({'error': 'Campaign not found'}), 404
+    if request.args.get('results'):
+        progress['results'] = campaign.get_campaign_results(
+            campaign_id,
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', 100, type=int)
+        )
+    return jsonify(progress)
+
+@api.route('/ivr-trees', methods=['POST'])
+def explore_ivr_tree():
+    """Start mapping a number's DTMF tree in the background (needs API_TOKEN)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'number is required'}), 400
+    number = str(data.get('number', '')).strip()
+    if not number:
+        return jsonify({'error': 'number is required'}), 400
+
+    provider_name = data.get('provider', 'twilio')
+    try:
+        max_depth = number_field(data, 'max_depth', 4, 1, 8)
+        max_parallel = number_field(data, 'max_parallel', 2, 1, 10)
+        provider = campaign.make_provider(
+            provider_name,
+            webhook_url=os.getenv('WEBHOOK_URL', request.url_root.rstrip('/')),
+            time_scale=number_field(data, 'time_scale', 1.0, 0.001, 1000, kind=float)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    tree_explorer = explorer.IVRExplorer(
+        number,
+        provider,
+        max_depth=max_depth,
+        max_parallel=max_parallel,
+        refresh=bool(data.get('refresh', False)),
+        # Admission took the first call; each further one is charged as it is placed
+        client=client_key() if g.get('admitted') else None
+    )
+    threading.Thread(target=tree_explorer.run, name=f"explorer-{number}", daemon=True).start()
+    logger.info(f"Started DTMF exploration of {number} via {provider_name}")
+    return jsonify({
+        'number': number,
+        'status_url': url_for('api.get_ivr_tree', number=number)
+    }), 202
+
+@api.route('/ivr-trees/<number>', methods=['GET'])
+def get_ivr_tree(number):
+    """Return the explored part of a number's DTMF tree"""
+    nodes = explorer.load_nodes(number)
+    if not nodes:
+        return jsonify({'error': 'No explored menus for this number'}), 404
+    return jsonify({
+        'number': number,
+        'nodes': nodes,
+        'flowchart': explorer.tree_to_mermaid(nodes)
+    })
+
+@api.route('/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Return OpenAI queue depth and wait times per priority class for this worker"""
+    return jsonify(openai_scheduler.stats())
+
+@api.route('/admission', methods=['GET'])
+def admission_stats():
+    """Return in-flight and queued work against the admission limits of this worker"""
+    return jsonify(admission.stats())
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for EchoMap
+
+Serves the same Flask application as the WSGI entry point, but the two
+routes that wait on slow upstream APIs are coroutines: POST / (Whisper and
+GPT-4) and POST /make-call (Twilio). While they wait, they hold no thread,
+so one worker can keep hundreds of such requests open. Every other route -
+the CPU-bound /insights page, the Twilio and VOXO webhooks, the JSON API and
+the Server-Sent Events streams - runs its unchanged Flask view on a bounded
+thread pool, exactly as under WSGI. Request bodies are read without blocking
+the event loop before any view runs - except uploads to POST /, which are
+validated while they arrive - and /media-stream is served as a native ASGI
+WebSocket.
+
+Run it with any ASGI server, e.g.:
+
+    uvicorn asgi:app --port 8000
+
+or through run.py with SERVER_INTERFACE=asgi.
+"""
+
+import io
+import os
+import sys
+import json
+import asyncio
+import logging
+import tempfile
+import contextvars
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, jsonify, g
+from werkzeug.exceptions import NotFound, MethodNotAllowed, ClientDisconnected
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import web
+from app import app as flask_app
+from web import receive_upload, upload_error, duplicate_upload_response, upload_analysis_response, publish_stage
+from calls import call_placed
+from admission import admission, audio_cost, client_key
+from analysis_store import analysis_store
+from analytics_cache import analytics_cache
+from upload_store import upload_store
+from media_stream import MediaStreamSession
+from metrics import cache_hits, cache_misses
+from pipeline import transcribe_upload_async, generate_flowchart_once_async, save_upload_analysis
+from scheduler import priority
+from tracing import stage
+from twilio_integration import place_call_async
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Threads for the synchronous Flask views (each open SSE stream holds one)
+ASGI_SYNC_THREADS = int(os.getenv('ASGI_SYNC_THREADS', 32))
+
+# Request bodies larger than this are spooled to disk instead of held in memory
+ASGI_SPOOL_BYTES = int(os.getenv('ASGI_SPOOL_BYTES', 1024 * 1024))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_SYNC_THREADS, thread_name_prefix='asgi-sync')
+
+# Open event streams may take half the sync pool here (the WSGI default suits 4 gunicorn threads)
+flask_app.config['SSE_MAX_STREAMS'] = int(os.getenv('SSE_MAX_STREAMS', max(1, ASGI_SYNC_THREADS // 2)))
+
+# The coroutine views do not go through flask_app.wsgi_app, so they trust the
+# proxies create_app() does themselves; ProxyFix only rewrites the environ here
+_hops = flask_app.config['TRUSTED_PROXIES']
+_proxy_fix = ProxyFix(lambda environ, start_response: None, x_for=_hops, x_proto=_hops) if _hops else None
+
+
+async def in_thread(fn, *args, context=None):
+    """
+    Run blocking code on the sync pool with the caller's context (request, trace, priority)
+
+    Args:
+        context (contextvars.Context): Run in this context instead of a copy of
+            the current one, so state set by earlier calls is kept
+    """
+    # Not `context or ...`: a Context is a mapping, and one with no variables set is falsy
+    if context is None:
+        context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, context.run, fn, *args)
+
+
+async def index():
+    """POST / without holding a thread while Whisper and GPT-4 work"""
+    if request.method != 'POST':
+        return await in_thread(web.index)
+
+    logger.info("Received POST request for file upload")
+    # The body is parsed off the event loop as it arrives (see ReceiveStream): the
+    # audio is validated and stored by content hash; identical uploads share one copy
+    def receive():
+        with stage('upload_save', 'upload'):
+            return receive_upload()
+    stored, upload_id, is_ajax, error = await in_thread(receive)
+    if error is not None:
+        return error
+
+    tenant = client_key()
+    try:
+        filepath = stored['path']
+        logger.info(f"Stored upload {stored['digest'][:12]} at {filepath}")
+
+        # The same recording was analysed before: answer without reprocessing it
+        analysis = await in_thread(analysis_store.get, stored['analysis_id']) if stored['analysis_id'] else None
+        if analysis:
+            cache_hits.inc(cache='upload')
+            await in_thread(upload_store.release, stored['digest'])
+            return await in_thread(duplicate_upload_response, analysis, upload_id, is_ajax)
+
+        cache_misses.inc(cache='upload')
+        if g.get('admitted'):
+            # The recording's length is known now: it is what transcription will cost
+            await in_thread(admission.charge, tenant, audio_cost(stored['duration']))
+
+        # Transcribe audio
+        logger.info(f"Starting transcription for file: {filepath}")
+        await in_thread(publish_stage, upload_id, 'transcribing')
+        try:
+            try:
+                # Someone is waiting on this page: ahead of call and crawl work
+                with priority('interactive', tenant=tenant), stage('transcription', 'upload'):
+                    transcript = await transcribe_upload_async(filepath, stored['digest'])
+            finally:
+                # Only transcription reads the file; unpin it for the garbage collector
+                await in_thread(upload_store.release, stored['digest'])
+            logger.info(f"Transcription complete. Transcript length: {len(transcript)} characters")
+
+            # Generate flowchart
+            logger.info("Starting flowchart generation")
+            await in_thread(publish_stage, upload_id, 'generating_flowchart')
+            try:
+                with priority('interactive', tenant=tenant):
+                    flowchart = await generate_flowchart_once_async(transcript)
+                logger.info(f"Flowchart generated. Length: {len(flowchart)} characters")
+            except Exception as e:
+                logger.error(f"Error generating flowchart: {str(e)}", exc_info=True)
+                return await in_thread(upload_error, f"Error generating flowchart: {str(e)}", 500, is_ajax, upload_id)
+        except Exception as e:
+            logger.error(f"Error transcribing audio: {str(e)}", exc_info=True)
+            return await in_thread(upload_error, f"Error transcribing audio: {str(e)}", 500, is_ajax, upload_id)
+
+        # Analytics are CPU-bound: run them, the store and the page render off the event loop
+        logger.info("Starting analytics generation")
+        await in_thread(publish_stage, upload_id, 'analyzing')
+        try:
+            def analyze():
+                with stage('analytics', 'upload'):
+                    result = analytics_cache.analyze(transcript, flowchart)
+                analysis_id = save_upload_analysis(stored['digest'], transcript, flowchart, result)
+                return upload_analysis_response(analysis_id, transcript, flowchart, result, upload_id, is_ajax)
+            return await in_thread(analyze)
+        except Exception as e:
+            logger.error(f"Error generating insights: {str(e)}", exc_info=True)
+            return await in_thread(upload_error, f"Error generating insights: {str(e)}", 500, is_ajax, upload_id)
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}", exc_info=True)
+        return await in_thread(upload_error, f"An unexpected error occurred: {str(e)}", 500, is_ajax, upload_id)
+
+
+async def make_call():
+    """POST /make-call without holding a thread while Twilio creates the call"""
+    to_number = request.form.get('to_number')
+    if not to_number:
+        return jsonify({'error': 'Phone number required'}), 400
+
+    try:
+        webhook_url = os.getenv('WEBHOOK_URL', request.url_root.rstrip('/'))
+        logger.info(f"Using webhook URL: {webhook_url}")
+        call = await place_call_async(to_number, webhook_url)
+        return await in_thread(call_placed, call, to_number)
+
+    except Exception as e:
+        logger.error(f"Error initiating call: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+# Flask endpoints served by a coroutine instead of their WSGI view
+ASYNC_VIEWS = {'web.index': index, 'calls.make_call': make_call}
+
+# Endpoints that read their body while it arrives instead of after read_body()
+STREAMED_BODY_ENDPOINTS = {'web.index', 'api.batch_upload'}
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    A request body read from the ASGI receive channel as a view consumes it
+
+    Read by the view on the sync pool; each read waits on the event loop for
+    the next chunk the client sends, so an upload rejected from its first
+    bytes is never received in full.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._chunk = memoryview(b'')
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self._chunk = memoryview(message.get('body', b''))
+            self._more = message.get('more_body', False)
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+def build_environ(scope, body, length):
+    """WSGI environ for an ASGI HTTP scope whose body has been read into a file (or is None)"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': quote(scope.get('root_path', '')),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    if length is not None:
+        # The body as actually received; above MAX_CONTENT_LENGTH Flask answers 413
+        environ['CONTENT_LENGTH'] = str(length)
+    return environ
+
+
+async def read_body(scope, receive):
+    """
+    Read a request body into a spooled file without blocking the event loop
+
+    Stops reading once MAX_CONTENT_LENGTH is exceeded: the request is then
+    answered with Flask's 413 handler and the rest is never buffered.
+
+    Returns:
+        tuple: (file positioned at 0, bytes received or None if there was no body)
+    """
+    limit = flask_app.config.get('MAX_CONTENT_LENGTH')
+    declared = dict(scope.get('headers', [])).get(b'content-length')
+    body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_BYTES)
+    if limit is not None and declared is not None and declared.isdigit() and int(declared) > limit:
+        return body, int(declared)
+
+    length = 0
+    more = True
+    while more:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        length += len(chunk)
+        if limit is not None and length > limit:
+            break
+        if chunk:
+            body.write(chunk)
+        more = message.get('more_body', False)
+    body.seek(0)
+    return body, length if length or declared is not None else None
+
+
+def start_response_into(holder):
+    def start_response(status, headers, exc_info=None):
+        holder['status'] = int(status.split(' ', 1)[0])
+        holder['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    return start_response
+
+
+def call_handler(handler, error):
+    """Call a Flask exception handler the way it expects: while the error is being handled"""
+    try:
+        raise error
+    except Exception:
+        return handler(error)
+
+
+async def dispatch_async(view, environ):
+    """
+    Run a coroutine view through Flask's request handling
+
+    Mirrors Flask.wsgi_app(): before_request hooks (metrics, trace, profile),
+    error handlers, after_request hooks and teardown all apply as usual.
+    They read and write the shared database and files, so they run on the
+    sync pool, all in one context that the view's task starts from. A
+    request profile follows the view onto the event loop thread.
+    """
+    if _proxy_fix is not None:
+        _proxy_fix(environ, None)
+    context = contextvars.copy_context()
+    ctx = flask_app.request_context(environ)
+    profile = None
+    error = None
+
+    def start():
+        ctx.push()
+        rv = flask_app.preprocess_request()
+        if g.get('profile') is not None:
+            g.profile.suspend()
+        return rv, g.get('profile')
+
+    try:
+        try:
+            try:
+                rv, profile = await in_thread(start, context=context)
+                if rv is None:
+                    if profile is not None:
+                        profile.resume()
+                    try:
+                        # The task runs in a copy of the request's context
+                        rv = await context.run(asyncio.ensure_future, view())
+                    finally:
+                        if profile is not None:
+                            profile.suspend()
+            except Exception as e:
+                rv = await in_thread(call_handler, flask_app.handle_user_exception, e, context=context)
+            response = await in_thread(flask_app.finalize_request, rv, context=context)
+        except Exception as e:
+            error = e
+            response = await in_thread(call_handler, flask_app.handle_exception, e, context=context)
+        holder = {}
+        body = await in_thread(
+            lambda: b''.join(response(environ, start_response_into(holder))), context=context
+        )
+        return holder, body
+    finally:
+        if error is not None and flask_app.should_ignore_error(error):
+            error = None
+        await in_thread(ctx.pop, error, context=context)
+
+
+async def http(scope, receive, send):
+    environ = build_environ(scope, None, None)
+    try:
+        endpoint, _ = flask_app.url_map.bind_to_environ(environ).match()
+    except (NotFound, MethodNotAllowed):
+        endpoint = None
+
+    if endpoint in STREAMED_BODY_ENDPOINTS and scope['method'] == 'POST':
+        body = ReceiveStream(receive, asyncio.get_running_loop())
+        environ['wsgi.input'] = body
+        # The client's Content-Length is not trusted: MAX_CONTENT_LENGTH is
+        # enforced on the bytes actually read
+        environ['wsgi.input_terminated'] = True
+    else:
+        body, length = await read_body(scope, receive)
+        environ = build_environ(scope, body, length)
+    try:
+        view = ASYNC_VIEWS.get(endpoint)
+        if view is not None:
+            holder, content = await dispatch_async(view, environ)
+            await send({'type': 'http.response.start', 'status': holder['status'], 'headers': holder['headers']})
+            await send({'type': 'http.response.body', 'body': content})
+            return
+
+        # Everything else is the plain WSGI app; its body (e.g. an SSE stream
+        # under stream_with_context) is iterated in the same context it started in
+        context = contextvars.copy_context()
+        holder = {}
+        chunks = await in_thread(flask_app.wsgi_app, environ, start_response_into(holder), context=context)
+        try:
+            iterator = iter(chunks)
+            await send({'type': 'http.response.start', 'status': holder['status'], 'headers': holder['headers']})
+            while True:
+                chunk = await in_thread(next, iterator, None, context=context)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                await in_thread(chunks.close, context=context)
+    finally:
+        body.close()
+
+
+async def websocket(scope, receive, send):
+    if scope['path'] != '/media-stream':
+        await send({'type': 'websocket.close', 'code': 1000})
+        return
+
+    # Same session logic as the Flask-Sock route; handle() writes the call store, so it runs off the loop
+    context = contextvars.copy_context()
+    session = MediaStreamSession()
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.connect':
+                await send({'type': 'websocket.accept'})
+            elif message['type'] == 'websocket.receive':
+                text = message.get('text') or (message.get('bytes') or b'').decode('utf-8')
+                if not await in_thread(session.handle, json.loads(text), context=context):
+                    await send({'type': 'websocket.close', 'code': 1000})
+                    break
+            else:
+                logger.info("Media stream connection closed by Twilio")
+                break
+    except Exception as e:
+        logger.error(f"Error in media stream: {str(e)}", exc_info=True)
+    finally:
+        # Also finalises streams that dropped without a stop message
+        await in_thread(session.close, context=context)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'http':
+        await http(scope, receive, send)
+    elif scope['type'] == 'websocket':
+        await websocket(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""
+Incremental validation of uploaded audio
+
+AudioProbe is fed an upload's bytes as they arrive and reads just enough of
+the container to check it: the magic bytes (WAV, MP3, OGG or M4A), the codec,
+the sample rate and channels, and the duration - from the header where the
+format records it (WAV data size, MP3 Xing/VBRI frame count, OGG granule
+positions, MP4 mvhd) or estimated from the bytes received at the stream's
+bitrate. feed() raises AudioError as soon as the bytes seen so far prove the
+file invalid or too long, so a bad upload can be refused without reading the
+rest. 16-bit PCM WAV files are also checked for silence.
+
+Only the header structures being parsed are buffered (at most the MP4 moov
+box, MAX_MOOV_BYTES); audio payload is counted and dropped.
+
+Check files by hand:
+
+    python audio_probe.py recording.mp3 menu.wav
+"""
+
+import os
+import math
+import struct
+import logging
+import argparse
+import numpy as np
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Longest recording accepted for analysis (seconds)
+MAX_AUDIO_SECONDS = int(os.getenv('MAX_AUDIO_SECONDS', 30 * 60))
+
+# Sample rates accepted (Hz); telephony audio is 8kHz
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 96000
+
+# 16-bit PCM recordings whose loudest sample stays below this level are rejected (dBFS)
+SILENCE_DBFS = float(os.getenv('SILENCE_DBFS', -50))
+
+# Largest MP4 'moov' box buffered to read its codec and duration
+MAX_MOOV_BYTES = 4 * 1024 * 1024
+
+# Largest WAV header chunk or OGG page read into memory
+MAX_HEADER_BYTES = 64 * 1024
+
+# Bytes searched for the first MP3 frame after an ID3 tag
+MAX_SYNC_SCAN = 64 * 1024
+
+WAV_CODECS = {1: 'pcm', 3: 'float', 6: 'alaw', 7: 'mulaw'}
+MP4_CODECS = {b'mp4a': 'aac', b'alac': 'alac'}
+
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0),
+}
+MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+MP3_VERSIONS = {3: 1, 2: 2, 0: 2.5}
+
+
+class AudioError(ValueError):
+    """The upload is not audio we can analyse; the message is shown to the user"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class AudioProbe:
+    """
+    Validates an audio file from its bytes as they arrive
+
+    Args:
+        max_seconds (float): Longest duration accepted
+    """
+
+    def __init__(self, max_seconds=MAX_AUDIO_SECONDS):
+        self.max_seconds = max_seconds
+        self.size = 0
+        self.info = {}
+        # Estimated duration for formats without one in the header: bytes after
+        # _audio_start at _bytes_per_second
+        self._audio_start = None
+        self._bytes_per_second = None
+        self._peak = None
+        self._buffer = bytearray()
+        self._eof = False
+        self._parser = self._parse()
+        self._parsing = True
+        self._advance()
+
+    def feed(self, chunk):
+        """
+        Add the next bytes of the file
+
+        Raises:
+            AudioError: The bytes so far show the file is invalid or too long
+        """
+        self.size += len(chunk)
+        if self._parsing:
+            self._buffer += chunk
+            self._advance()
+        if 'duration' not in self.info:
+            self._check_duration(self.estimated_duration(), final=False)
+
+    def finish(self):
+        """
+        Validate the complete file
+
+        Returns:
+            dict: 'format', 'extension', 'codec', 'sample_rate', 'channels',
+                'duration' (seconds) and 'size' (bytes)
+
+        Raises:
+            AudioError: The file is truncated, invalid, too long or silent
+        """
+        self._eof = True
+        if self._parsing:
+            self._advance()
+        if 'duration' not in self.info:
+            duration = self.estimated_duration()
+            if duration is None:
+                raise AudioError("Could not determine the length of the recording.")
+            self.info['duration'] = duration
+        self._check_duration(self.info['duration'])
+        if self.info['duration'] <= 0:
+            raise AudioError("The recording contains no audio.")
+        if self._peak is not None and 20 * math.log10(max(self._peak, 1) / 32768) < SILENCE_DBFS:
+            raise AudioError("The recording is silent.")
+        return dict(self.info, size=self.size)
+
+    def estimated_duration(self):
+        """Duration implied by the bytes received so far, for formats without one in the header"""
+        if self._bytes_per_second and self._audio_start is not None:
+            return max(0, self.size - self._audio_start) / self._bytes_per_second
+        return None
+
+    def _check_duration(self, duration, final=True):
+        """
+        Args:
+            final (bool): The duration is the whole file's, not just what has arrived so far
+        """
+        if duration is not None and duration > self.max_seconds:
+            length = _clock(duration) if final else f"over {_clock(self.max_seconds)}"
+            raise AudioError(f"Recording too long: {length} (max {_clock(self.max_seconds)}).", status=413)
+
+    def _advance(self):
+        """Run the parser until it needs more bytes than have arrived"""
+        try:
+            next(self._parser)
+        except StopIteration:
+            self._parsing = False
+            self._buffer = bytearray()
+
+    def _set_format(self, fmt, codec, sample_rate, channels):
+        if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+            raise AudioError(f"Unsupported sample rate: {sample_rate}Hz.")
+        if channels < 1:
+            raise AudioError("The recording has no audio channels.")
+        self.info.update(format=fmt, extension=fmt, codec=codec, sample_rate=sample_rate, channels=channels)
+
+    def _set_duration(self, duration, final=True):
+        self.info['duration'] = duration
+        self._check_duration(duration, final)
+
+    # Byte source for the parser generators: each waits (yields) until enough has arrived
+
+    def _peek(self, n):
+        while len(self._buffer) < n and not self._eof:
+            yield
+        return bytes(self._buffer[:n])
+
+    def _take(self, n):
+        while len(self._buffer) < n:
+            if self._eof:
+                raise AudioError("The file is truncated or corrupt.")
+            yield
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def _skip(self, n):
+        while len(self._buffer) < n:
+            n -= len(self._buffer)
+            self._buffer.clear()
+            if self._eof:
+                raise AudioError("The file is truncated or corrupt.")
+            yield
+        del self._buffer[:n]
+
+    def _take_some(self, limit):
+        """Up to `limit` bytes as soon as any are available; b'' at the end of the file"""
+        while not self._buffer and not self._eof:
+            yield
+        data = bytes(self._buffer[:limit])
+        del self._buffer[:limit]
+        return data
+
+    def _at_end(self):
+        while not self._buffer and not self._eof:
+            yield
+        return not self._buffer and self._eof
+
+    def _parse(self):
+        head = yield from self._peek(12)
+        if len(head) < 12:
+            raise AudioError("The file is empty or truncated.")
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            yield from self._parse_wav()
+        elif head[:3] == b'ID3' or (head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+            yield from self._parse_mp3()
+        elif head[:4] == b'OggS':
+            yield from self._parse_ogg()
+        elif head[4:8] == b'ftyp':
+            yield from self._parse_mp4()
+        else:
+            raise AudioError("Not a recognised audio file. Please upload MP3, WAV, OGG, or M4A files.")
+
+    def _parse_wav(self):
+        yield from self._skip(12)
+        offset = 12
+        fmt = None
+        while True:
+            if (yield from self._at_end()):
+                raise AudioError("The WAV file has no audio data.")
+            chunk_id, size = struct.unpack('<4sI', (yield from self._take(8)))
+            offset += 8
+            if chunk_id == b'fmt ':
+                if not 16 <= size <= MAX_HEADER_BYTES:
+                    raise AudioError("The WAV file has an invalid format header.")
+                fmt = yield from self._take(size + size % 2)
+                tag, channels, rate, byte_rate, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+                if tag == 0xFFFE and size >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE: the codec is the first two bytes of the subformat GUID
+                    tag = struct.unpack('<H', fmt[24:26])[0]
+                if tag not in WAV_CODECS:
+                    raise AudioError(f"Unsupported WAV codec (format {tag:#06x}).")
+                self._set_format('wav', WAV_CODECS[tag], rate, channels)
+                if byte_rate <= 0:
+                    raise AudioError("The WAV file has an invalid format header.")
+                pcm16 = WAV_CODECS[tag] == 'pcm' and bits == 16
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise AudioError("The WAV file has no format header.")
+                self._audio_start = offset
+                self._bytes_per_second = byte_rate
+                # Streamed WAVs leave the size at 0 or 0xFFFFFFFF; then the bytes received count
+                if 0 < size < 0xFFFFFFFF:
+                    self._set_duration(size / byte_rate)
+                else:
+                    size = None
+                yield from self._scan_pcm(size, pcm16)
+                return
+            else:
+                if size > MAX_HEADER_BYTES * 16:
+                    raise AudioError("The WAV file is corrupt.")
+                yield from self._skip(size + size % 2)
+            offset += size + size % 2
+
+    def _scan_pcm(self, size, pcm16):
+        """Read the data chunk, tracking the loudest 16-bit sample"""
+        if pcm16:
+            self._peak = 0
+        remaining = size
+        carry = b''
+        while remaining is None or remaining > 0:
+            data = yield from self._take_some(remaining or 65536)
+            if not data:
+                if remaining is not None:
+                    raise AudioError("The file is truncated or corrupt.")
+                return
+            if remaining is not None:
+                remaining -= len(data)
+            if pcm16:
+                data = carry + data
+                even = len(data) - len(data) % 2
+                carry = data[even:]
+                if even:
+                    samples = np.frombuffer(data[:even], dtype='<i2').astype(np.int32)
+                    self._peak = max(self._peak, int(np.abs(samples).max()))
+
+    def _parse_mp3(self):
+        offset = 0
+        head = yield from self._peek(10)
+        if head[:3] == b'ID3':
+            # ID3v2 tag: syncsafe size, plus a footer when flag 0x10 is set
+            size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+            size += 10 + (10 if head[5] & 0x10 else 0)
+            yield from self._skip(size)
+            offset += size
+
+        # Padding or junk may precede the first frame
+        scanned = 0
+        while True:
+            header = yield from self._peek(4)
+            if len(header) < 4:
+                raise AudioError("The MP3 file has no audio frames.")
+            frame = _mp3_frame(header)
+            if frame is not None:
+                break
+            scanned += 1
+            if scanned > MAX_SYNC_SCAN:
+                raise AudioError("The MP3 file has no audio frames.")
+            yield from self._skip(1)
+            offset += 1
+
+        if frame['layer'] != 3:
+            raise AudioError(f"Unsupported MPEG audio layer {frame['layer']}; only MP3 (layer III) is accepted.")
+        self._set_format('mp3', 'mp3', frame['sample_rate'], frame['channels'])
+        self.info['bitrate'] = frame['bitrate']
+        self._audio_start = offset
+        self._bytes_per_second = frame['bitrate'] / 8
+
+        data = yield from self._take(frame['length'])
+        frames = _mp3_frame_count(data, frame)
+        if frames:
+            self._set_duration(frames * frame['samples'] / frame['sample_rate'])
+
+        # A second frame right after the first rules out a stray sync pattern
+        following = yield from self._peek(4)
+        if len(following) == 4:
+            second = _mp3_frame(following)
+            if second is None or second['sample_rate'] != frame['sample_rate']:
+                raise AudioError("The MP3 file is corrupt.")
+
+    def _parse_ogg(self):
+        granule_rate = None
+        pre_skip = 0
+        first = True
+        while not (yield from self._at_end()):
+            header = yield from self._take(27)
+            if header[:4] != b'OggS':
+                raise AudioError("The OGG file is corrupt.")
+            granule = struct.unpack('<q', header[6:14])[0]
+            lacing = yield from self._take(header[26])
+            body_size = sum(lacing)
+            if first:
+                body = yield from self._take(body_size)
+                if body[:7] == b'\x01vorbis' and len(body) >= 16:
+                    channels, rate = struct.unpack('<BI', body[11:16])
+                    self._set_format('ogg', 'vorbis', rate, channels)
+                    granule_rate = rate
+                elif body[:8] == b'OpusHead' and len(body) >= 16:
+                    channels, pre_skip, rate = struct.unpack('<BHI', body[9:16])
+                    # Opus always decodes at 48kHz; the input rate is informational
+                    self._set_format('ogg', 'opus', rate or 48000, channels)
+                    granule_rate = 48000
+                else:
+                    raise AudioError("Unsupported OGG codec; only Vorbis and Opus are accepted.")
+                first = False
+            else:
+                yield from self._skip(body_size)
+            # Each page's granule position is the sample count so far
+            if granule > 0:
+                self._set_duration(max(0, granule - pre_skip) / granule_rate, final=False)
+        if first:
+            raise AudioError("The OGG file has no audio stream.")
+
+    def _parse_mp4(self):
+        moov = False
+        while not (yield from self._at_end()):
+            size, kind = struct.unpack('>I4s', (yield from self._take(8)))
+            header = 8
+            if size == 1:
+                size = struct.unpack('>Q', (yield from self._take(8)))[0]
+                header = 16
+            elif size == 0:
+                # Runs to the end of the file
+                if kind == b'moov':
+                    raise AudioError("The M4A file is corrupt.")
+                break
+            if size < header:
+                raise AudioError("The M4A file is corrupt.")
+            if kind == b'moov':
+                if size > MAX_MOOV_BYTES:
+                    raise AudioError("The M4A file's metadata is too large.")
+                self._read_moov((yield from self._take(size - header)))
+                moov = True
+            else:
+                yield from self._skip(size - header)
+        if not moov:
+            raise AudioError("The M4A file is truncated or corrupt (no movie header).")
+
+    def _read_moov(self, moov):
+        duration = None
+        for kind, payload in _mp4_boxes(moov):
+            if kind == b'mvhd':
+                duration = _mp4_duration(payload)
+            elif kind == b'trak':
+                track = _mp4_sound_track(payload)
+                if track is not None:
+                    codec, rate, channels, track_duration = track
+                    if codec not in MP4_CODECS:
+                        raise AudioError(f"Unsupported M4A codec '{codec.decode('latin-1')}'; AAC or ALAC is required.")
+                    self._set_format('m4a', MP4_CODECS[codec], rate, channels)
+                    duration = duration if duration is not None else track_duration
+        if 'codec' not in self.info:
+            raise AudioError("The M4A file has no audio track.")
+        if duration is None:
+            raise AudioError("Could not determine the length of the recording.")
+        self._set_duration(duration)
+
+
+def _clock(seconds):
+    """Seconds as m:ss"""
+    return f"{int(seconds) // 60}:{int(seconds) % 60:02d}"
+
+
+def _mp3_frame(header):
+    """Decode an MPEG audio frame header; None if the bytes are not one"""
+    if header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = MP3_VERSIONS.get((header[1] >> 3) & 0x03)
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    if version is None or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 0x01
+    mono = header[3] >> 6 == 3
+    if layer != 3:
+        return {'layer': layer, 'sample_rate': sample_rate, 'channels': 1 if mono else 2}
+    kbps = MP3_BITRATES[1 if version == 1 else 2][bitrate_index]
+    coefficient = 144 if version == 1 else 72
+    return {
+        'layer': layer,
+        'version': version,
+        'bitrate': kbps * 1000,
+        'sample_rate': sample_rate,
+        'channels': 1 if mono else 2,
+        'samples': 1152 if version == 1 else 576,
+        'length': coefficient * kbps * 1000 // sample_rate + padding,
+        # Xing/Info header position: after the frame header and side information
+        'side_info': (32 if not mono else 17) if version == 1 else (17 if not mono else 9),
+    }
+
+
+def _mp3_frame_count(data, frame):
+    """Frame count from a Xing/Info or VBRI header in the first frame, if present"""
+    xing = 4 + frame['side_info']
+    if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+        flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+        if flags & 0x01:
+            return struct.unpack('>I', data[xing + 8:xing + 12])[0]
+    if data[36:40] == b'VBRI' and len(data) >= 54:
+        return struct.unpack('>I', data[50:54])[0]
+    return None
+
+
+def _mp4_boxes(data):
+    """Child boxes of an MP4 box payload as (type, payload)"""
+    offset = 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        header = 8
+        if size == 1 and offset + 16 <= len(data):
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header or offset + size > len(data):
+            raise AudioError("The M4A file is corrupt.")
+        yield kind, data[offset + header:offset + size]
+        offset += size
+
+
+def _mp4_child(data, *path):
+    """Payload of the first box along a path of box types, or None"""
+    for kind in path:
+        data = next((payload for child, payload in _mp4_boxes(data) if child == kind), None)
+        if data is None:
+            return None
+    return data
+
+
+def _mp4_duration(payload):
+    """Seconds from an mvhd or mdhd box"""
+    if payload[0] == 1:
+        timescale, duration = struct.unpack('>IQ', payload[20:32])
+    else:
+        timescale, duration = struct.unpack('>II', payload[12:20])
+    return duration / timescale if timescale else None
+
+
+def _mp4_sound_track(trak):
+    """(codec, sample rate, channels, duration) of a sound track; None for other tracks"""
+    handler = _mp4_child(trak, b'mdia', b'hdlr')
+    if handler is None or handler[8:12] != b'soun':
+        return None
+    header = _mp4_child(trak, b'mdia', b'mdhd')
+    stsd = _mp4_child(trak, b'mdia', b'minf', b'stbl', b'stsd')
+    if stsd is None or len(stsd) < 8:
+        raise AudioError("The M4A file's audio track has no sample description.")
+    codec, entry = next(_mp4_boxes(stsd[8:]), (None, b''))
+    if codec is None or len(entry) < 28:
+        raise AudioError("The M4A file's audio track has no sample description.")
+    # AudioSampleEntry: reserved and data reference, version fields, then channels and rate (16.16)
+    channels = struct.unpack('>H', entry[16:18])[0]
+    rate = struct.unpack('>I', entry[24:28])[0] >> 16
+    return codec, rate, channels, _mp4_duration(header) if header else None
+
+
+def probe_file(path, chunk_size=64 * 1024):
+    """
+    Validate an audio file on disk
+
+    Returns:
+        dict: As AudioProbe.finish()
+
+    Raises:
+        AudioError: The file is not audio we can analyse
+    """
+    probe = AudioProbe()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            probe.feed(chunk)
+    return probe.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check audio files the way uploads are checked")
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+    for path in args.files:
+        try:
+            info = probe_file(path)
+            print(f"{path}: {info['format']}/{info['codec']} {info['sample_rate']}Hz "
+                  f"{info['channels']}ch {info['duration']:.1f}s")
+        except AudioError as e:
+            print(f"{path}: rejected - {e}")
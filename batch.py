@@ -0,0 +1,336 @@
+"""
+Batch uploads: many recordings in one request, results streamed as NDJSON
+
+POST /api/batch takes a multipart form with any number of file parts, each
+an audio recording or a ZIP archive of them (e.g. a zipped folder). Each
+recording is validated and stored while the body is read, as for POST /,
+and handed to a pool of BATCH_CONCURRENCY pipeline workers as soon as it is
+stored, so the first files are being transcribed while the rest upload.
+The response is application/x-ndjson: one line per recording as it
+finishes, fastest first, then a summary line:
+
+    {"file": "menus/main.wav", "status": "complete", "analysis_id": 7, ...}
+    {"file": "menus/broken.mp3", "status": "failed", "error": "The file is truncated or corrupt."}
+    {"done": true, "files": 2, "complete": 1, "failed": 1, "seconds": 41.3}
+
+For example:
+
+    curl -N -F file=@menus.zip -F file=@after-hours.wav http://localhost:5000/api/batch
+"""
+
+import os
+import zlib
+import logging
+import zipfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, NeedData, Epilogue
+from audio_probe import AudioProbe, AudioError
+from upload_store import upload_store, CHUNK_SIZE
+from analysis_store import analysis_store
+from analytics_cache import analytics_cache
+from admission import admission, audio_cost
+from pipeline import transcribe_upload, generate_flowchart_once, save_upload_analysis
+from metrics import cache_hits, cache_misses
+from tracing import stage
+from jobs import bind
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Recordings of one batch run through the pipeline at the same time
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+
+# Files accepted in one batch, counting those inside archives
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 100))
+
+# Largest batch request body (bytes); single uploads keep MAX_CONTENT_LENGTH
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 512 * 1024 * 1024))
+
+# Largest single recording, the Whisper API limit (bytes)
+MAX_FILE_BYTES = 25 * 1024 * 1024
+
+AUDIO_EXTENSIONS = {'mp3', 'wav', 'ogg', 'm4a'}
+ARCHIVE_EXTENSIONS = {'zip'}
+
+# A corrupt, encrypted or unsupported archive member
+ARCHIVE_ERRORS = (zipfile.BadZipFile, zlib.error, RuntimeError, NotImplementedError, EOFError, OSError)
+
+
+def extension(name):
+    """The lower-case extension of a file name, '' if it has none"""
+    return name.rsplit('.', 1)[1].lower() if '.' in name else ''
+
+
+class Recording:
+    """
+    One recording of a batch, validated and spooled into the upload store as it arrives
+
+    Args:
+        name (str): The file name (or archive path) the results are reported under
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        self.spool = upload_store.spool(extension(name))
+        self.probe = AudioProbe()
+
+    def write(self, data):
+        """Add the next bytes; a rejected recording ignores the rest of its data"""
+        if self.error:
+            return
+        try:
+            if self.spool.size + len(data) > MAX_FILE_BYTES:
+                raise AudioError(f"File too large. Maximum size is {MAX_FILE_BYTES // (1024 * 1024)}MB.")
+            self.probe.feed(data)
+            self.spool.write(data)
+        except AudioError as e:
+            self.error = str(e)
+            self.spool.abort()
+
+    def finish(self):
+        """
+        Returns:
+            tuple: (stored upload with its 'duration', or None, error message or None)
+        """
+        try:
+            if self.error:
+                return None, self.error
+            info = self.probe.finish()
+            return dict(self.spool.commit(info['extension']), duration=info['duration']), None
+        except AudioError as e:
+            return None, str(e)
+        finally:
+            self.spool.abort()
+
+
+def archive_members(archive, limit):
+    """
+    The recordings in a ZIP archive, each read through a Recording
+
+    Directories and hidden or macOS metadata files are skipped; other files
+    that are not audio are reported as errors.
+
+    Args:
+        archive (file): The spooled archive
+        limit (int): Files to accept; later ones are reported as errors unread
+
+    Yields:
+        tuple: (name, stored upload or None, error message or None)
+    """
+    try:
+        members = zipfile.ZipFile(archive)
+    except ARCHIVE_ERRORS as e:
+        logger.warning(f"Unreadable batch archive: {str(e)}")
+        yield None, None, "Not a valid ZIP archive."
+        return
+    with members:
+        for info in members.infolist():
+            base = os.path.basename(info.filename)
+            if info.is_dir() or not base or base.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            if limit <= 0:
+                yield info.filename, None, "Too many files in one batch."
+                continue
+            limit -= 1
+            if extension(base) not in AUDIO_EXTENSIONS:
+                yield info.filename, None, "Invalid file type. Please upload MP3, WAV, OGG, or M4A files."
+                continue
+            if info.file_size > MAX_FILE_BYTES:
+                yield info.filename, None, f"File too large. Maximum size is {MAX_FILE_BYTES // (1024 * 1024)}MB."
+                continue
+            recording = Recording(info.filename)
+            try:
+                with members.open(info) as f:
+                    while not recording.error:
+                        chunk = f.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        recording.write(chunk)
+            except ARCHIVE_ERRORS as e:
+                logger.warning(f"Unreadable archive member {info.filename}: {str(e)}")
+                recording.error = "Could not extract the file from the archive."
+            yield (info.filename, *recording.finish())
+
+
+def read_batch(stream, boundary, max_form_memory_size=None, max_files=BATCH_MAX_FILES):
+    """
+    Read a batch upload, yielding each recording as soon as it is stored
+
+    Audio parts are validated and stored while they stream in; ZIP parts are
+    spooled to a temporary file and unpacked once complete.
+
+    Args:
+        stream: The request body
+        boundary (str): The multipart boundary
+        max_form_memory_size (int): Largest non-file form field held in memory
+        max_files (int): Files accepted; later ones are reported as errors
+
+    Yields:
+        tuple: (name, stored upload with its 'duration' or None, error message or None).
+            Stored uploads are pinned: release them once processed.
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size)
+    count = 0
+    part = None  # Recording, spooled archive or None (data ignored)
+    name = None
+
+    def finish_part():
+        nonlocal count
+        if isinstance(part, Recording):
+            yield (part.name, *part.finish())
+            return
+        part.seek(0)
+        with part:
+            for member, stored, error in archive_members(part, max_files - count):
+                if member:
+                    count += 1
+                yield (f"{name}/{member}" if member else name), stored, error
+
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    part, name = None, event.filename
+                    kind = extension(name)
+                    if not name:
+                        # An empty file input
+                        pass
+                    elif count >= max_files:
+                        yield name, None, "Too many files in one batch."
+                    elif kind in ARCHIVE_EXTENSIONS:
+                        # Its members are counted as they are read
+                        part = tempfile.TemporaryFile()
+                    elif kind not in AUDIO_EXTENSIONS:
+                        count += 1
+                        yield name, None, "Invalid file type. Please upload MP3, WAV, OGG, or M4A files."
+                    else:
+                        count += 1
+                        part = Recording(name)
+                elif isinstance(event, Data):
+                    if part is not None:
+                        part.write(event.data)
+                        if not event.more_data:
+                            yield from finish_part()
+                            part = None
+                else:
+                    # A form field: nothing a batch needs
+                    part = None
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    finally:
+        # Interrupted mid-part (client gone, body too large): leave nothing behind
+        if isinstance(part, Recording):
+            part.spool.abort()
+        elif part is not None:
+            part.close()
+
+
+def analyze_recording(stored, charge=None):
+    """
+    Run a stored batch recording through the pipeline, or answer it from its earlier analysis
+
+    Args:
+        stored (dict): The pinned upload from read_batch(); released here
+        charge (callable): Called with the recording's duration before it is transcribed
+
+    Returns:
+        dict: 'analysis_id', 'duplicate', 'duration', 'transcript' and 'flowchart'
+    """
+    try:
+        analysis = analysis_store.get(stored['analysis_id']) if stored['analysis_id'] else None
+        if analysis:
+            cache_hits.inc(cache='upload')
+            return {
+                'analysis_id': analysis['id'], 'duplicate': True, 'duration': round(stored['duration'], 1),
+                'transcript': analysis['transcript'], 'flowchart': analysis['flowchart']
+            }
+        cache_misses.inc(cache='upload')
+        if charge:
+            charge(stored['duration'])
+        with stage('transcription', 'batch'):
+            transcript = transcribe_upload(stored['path'], stored['digest'])
+    finally:
+        # Only transcription reads the file; unpin it for the garbage collector
+        upload_store.release(stored['digest'])
+
+    flowchart = generate_flowchart_once(transcript)
+    with stage('analytics', 'batch'):
+        result = analytics_cache.analyze(transcript, flowchart)
+    analysis_id = save_upload_analysis(stored['digest'], transcript, flowchart, result)
+    return {
+        'analysis_id': analysis_id, 'duplicate': False, 'duration': round(stored['duration'], 1),
+        'transcript': transcript, 'flowchart': flowchart
+    }
+
+
+class BatchRun:
+    """
+    The pipeline work of one batch: recordings are submitted as they are
+    stored, and results come back in the order they finish
+
+    Create it inside the caller's scheduler.priority() block: the workers
+    run with the caller's priority class, tenant and trace.
+
+    The batch request was admitted at the cost of one request; each recording
+    that is transcribed is charged its audio, and every one after the first
+    the GPT-4 work of another request too.
+
+    Args:
+        client (str): Charge the recordings to this client's admission bucket
+        concurrency (int): Recordings processed at the same time
+    """
+
+    def __init__(self, client=None, concurrency=BATCH_CONCURRENCY):
+        self.client = client
+        self._lock = threading.Lock()
+        self._transcribed = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='echomap-batch')
+        self._analyze = bind(analyze_recording)
+        self._futures = {}
+        self._failed = []
+
+    def submit(self, name, stored):
+        """Queue a stored recording for the pipeline"""
+        charge = self._charge if self.client else None
+        self._futures[self._executor.submit(self._analyze, stored, charge)] = (name, stored)
+
+    def _charge(self, seconds):
+        """Charge a recording about to be transcribed to the client"""
+        with self._lock:
+            cost = audio_cost(seconds) + (1.0 if self._transcribed else 0.0)
+            self._transcribed += 1
+        admission.charge(self.client, cost)
+
+    def fail(self, name, error):
+        """Report a file that was rejected before processing"""
+        self._failed.append({'file': name, 'status': 'failed', 'error': error})
+
+    def results(self):
+        """
+        Yields:
+            dict: Per file, 'file' and 'status' ('complete' with the fields of
+                analyze_recording(), or 'failed' with an 'error'); rejected
+                files first, then recordings as they finish
+        """
+        yield from self._failed
+        for future in as_completed(self._futures):
+            name, _ = self._futures[future]
+            try:
+                yield dict({'file': name, 'status': 'complete'}, **future.result())
+            except Exception as e:
+                logger.error(f"Batch recording {name} failed: {str(e)}", exc_info=True)
+                yield {'file': name, 'status': 'failed', 'error': str(e)}
+
+    def close(self):
+        """Cancel recordings not yet started (e.g. the client went away) and unpin them"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for future, (_, stored) in self._futures.items():
+            if future.cancelled():
+                upload_store.release(stored['digest'])
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for analytics, the end-to-end pipeline and cold start
+
+Times IVRAnalytics stage by stage (flowchart parsing, each analysis,
+summary, visualization data) on synthetic IVRs from a single menu up to
+crawl-sized trees, and runs the full upload (POST /) and
+/transcription-callback flows through the Flask app against a local
+stand-in for the OpenAI API. Every upload and callback uses a fresh
+recording and transcript, so the upload dedupe, singleflight and analytics
+caches do not hide the work. The startup suite imports the app in fresh
+interpreters, as an autoscaled worker does, and times the import (per
+module the app imports directly) and the first request.
+
+Results are written as JSON. Against a baseline, any benchmark whose median
+grew by more than the threshold is reported as a regression:
+
+    python benchmarks.py --output baseline.json
+    python benchmarks.py --baseline baseline.json --threshold 0.15 --fail-on-regression
+
+Timings are seconds; the OpenAI stand-in's latency (--openai-latency) is
+included in the end-to-end figures.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from corpus import build_ivr, speech, to_pcm, wav_bytes
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Synthetic IVR sizes as (menu depth, options per menu); 'crawl' matches a
+# full explorer.py crawl at its default depth
+SIZES = {
+    'tiny': (1, 2),
+    'small': (2, 3),
+    'medium': (3, 4),
+    'large': (3, 8),
+    'crawl': (4, 6),
+}
+
+# IVRAnalytics.analyze() steps, in the order it runs them
+ANALYSIS_STEPS = (
+    'analyze_complexity', 'analyze_menu_options', 'analyze_potential_issues', 'analyze_sentiment',
+    'analyze_path_efficiency', 'analyze_customer_experience', 'analyze_best_practices',
+    'generate_recommendations'
+)
+
+# A median this much slower than the baseline is a regression
+DEFAULT_THRESHOLD = 0.10
+
+def synthetic_ivr(size, seed=0):
+    """Return (transcript, flowchart) for a named size"""
+    ivr = build_ivr(*SIZES[size], seed=seed)
+    return ivr['transcript'], ivr['flowchart']
+
+
+def summarize(samples):
+    """Median, p95, min and mean of a list of durations"""
+    ordered = sorted(samples)
+    return {
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'min': ordered[0],
+        'mean': statistics.fmean(ordered),
+        'runs': len(ordered)
+    }
+
+
+def bench_analytics(sizes, repeat):
+    """
+    Time each IVRAnalytics stage per size
+
+    Returns:
+        dict: Summary per benchmark name, e.g. 'analytics.large.analyze_sentiment'
+    """
+    from analytics import IVRAnalytics
+    results = {}
+    for size in sizes:
+        transcript, flowchart = synthetic_ivr(size)
+        timings = {}
+        for _ in range(repeat):
+            started = time.perf_counter()
+            # Build the object without __init__, which runs every step at once
+            analytics = IVRAnalytics.__new__(IVRAnalytics)
+            analytics.transcript, analytics.flowchart, analytics.metrics = transcript, flowchart, {}
+            analytics._parse_flowchart()
+            steps = [('parse', started, time.perf_counter())]
+            for name in ANALYSIS_STEPS:
+                begin = time.perf_counter()
+                getattr(analytics, name)()
+                steps.append((name, begin, time.perf_counter()))
+            for name in ('get_summary', 'get_visualization_data'):
+                begin = time.perf_counter()
+                getattr(analytics, name)()
+                steps.append((name.replace('get_', ''), begin, time.perf_counter()))
+            steps.append(('total', started, time.perf_counter()))
+            for name, begin, end in steps:
+                timings.setdefault(name, []).append(end - begin)
+        for name, samples in timings.items():
+            results[f"analytics.{size}.{name}"] = summarize(samples)
+        logger.info(f"analytics/{size}: {len(flowchart.splitlines())} flowchart lines, "
+                    f"median total {results[f'analytics.{size}.total']['median'] * 1000:.1f}ms")
+    return results
+
+
+class OpenAIStandIn:
+    """
+    Local HTTP server answering the two OpenAI endpoints the pipeline uses
+
+    Transcriptions return the configured transcript and chat completions the
+    configured flowchart, each after `latency` seconds. A unique line is
+    appended to every transcript so each request is new content. Subclasses
+    answer differently by overriding transcribe() and complete().
+    """
+
+    def __init__(self, latency=0.0, port=0):
+        self.latency = latency
+        self.transcript = ''
+        self.flowchart = ''
+        self.requests = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                stand_in.requests += 1
+                time.sleep(stand_in.latency)
+                if self.path.endswith('/audio/transcriptions'):
+                    body = {'text': stand_in.transcribe(data, self.headers.get('Content-Type', ''))}
+                elif self.path.endswith('/chat/completions'):
+                    content = stand_in.complete(json.loads(data or b'{}'))
+                    body = {
+                        'id': f"chatcmpl-{uuid.uuid4().hex}", 'object': 'chat.completion',
+                        'created': int(time.time()), 'model': 'gpt-4',
+                        'choices': [{'index': 0, 'finish_reason': 'stop',
+                                     'message': {'role': 'assistant', 'content': content}}],
+                        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+                    }
+                else:
+                    self.send_error(404)
+                    return
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def transcribe(self, data, content_type):
+        """Text for a transcription request (multipart body with the audio file)"""
+        return f"{self.transcript}\nReference {uuid.uuid4().hex[:8]}."
+
+    def complete(self, request):
+        """Reply to a chat completion request"""
+        return self.flowchart
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def wait_for_analysis(call_sid, timeout=60):
+    """Wait until the background pipeline has finished a call"""
+    from call_store import call_store
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = (call_store.get(call_sid) or {}).get('transcription_status')
+        if status in ('complete', 'failed'):
+            return status
+        time.sleep(0.005)
+    raise TimeoutError(f"Call {call_sid} was not analysed within {timeout}s")
+
+
+def bench_pipeline(sizes, repeat, latency):
+    """
+    Time the upload and transcription-callback flows end to end per size
+
+    Returns:
+        dict: Summary per benchmark name, e.g. 'pipeline.medium.upload'
+    """
+    results = {}
+    with OpenAIStandIn(latency) as stand_in:
+        os.environ['OPENAI_BASE_URL'] = stand_in.url
+        os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+        # Every upload comes from one test client; the benchmark measures the pipeline, not the rate limit
+        os.environ.setdefault('ADMISSION_ENABLED', 'false')
+        from app import app
+        client = app.test_client()
+        # Uploads are checked as audio, so the payload is a real (synthetic speech) WAV
+        audio = bytearray(wav_bytes(to_pcm(speech("Thank you for calling. Press 1 for sales."))))
+
+        for size in sizes:
+            stand_in.transcript, stand_in.flowchart = synthetic_ivr(size)
+            uploads, callbacks = [], []
+            for _ in range(repeat):
+                # Fresh samples every time, or the upload would be answered as a duplicate
+                audio[-16:] = uuid.uuid4().bytes
+                data = {'file': (io.BytesIO(bytes(audio)), 'benchmark.wav')}
+                started = time.perf_counter()
+                response = client.post('/', data=data, headers={'Accept': 'application/json'})
+                uploads.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise RuntimeError(f"Upload failed ({response.status_code}): {response.get_data(as_text=True)[:200]}")
+
+                call_sid = f"CA{uuid.uuid4().hex}"
+                started = time.perf_counter()
+                response = client.post('/transcription-callback', data={
+                    'CallSid': call_sid, 'RecordingSid': f"RE{uuid.uuid4().hex}",
+                    'TranscriptionText': f"{stand_in.transcript}\nReference {uuid.uuid4().hex[:8]}.",
+                    'TranscriptionStatus': 'completed'
+                })
+                if wait_for_analysis(call_sid) != 'complete':
+                    raise RuntimeError(f"Pipeline failed for benchmark call {call_sid}")
+                callbacks.append(time.perf_counter() - started)
+
+            results[f"pipeline.{size}.upload"] = summarize(uploads)
+            results[f"pipeline.{size}.transcription_callback"] = summarize(callbacks)
+            logger.info(f"pipeline/{size}: upload median {results[f'pipeline.{size}.upload']['median'] * 1000:.1f}ms, "
+                        f"callback median {results[f'pipeline.{size}.transcription_callback']['median'] * 1000:.1f}ms")
+    return results
+
+
+# Run in a fresh interpreter: import the app, then serve one page
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/')
+print(json.dumps({'import_app': imported - started, 'first_request': time.perf_counter() - imported}))
+"""
+
+
+def parse_importtime(output):
+    """
+    Read `python -X importtime` output
+
+    Returns:
+        list: (module, depth, cumulative seconds) in the order imports finished
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append((name.strip(), depth, int(cumulative) / 1e6))
+    return modules
+
+
+def bench_startup(repeat):
+    """
+    Time cold starts: importing the app and its first request, in fresh interpreters
+
+    Returns:
+        dict: Summaries 'startup.import_app', 'startup.first_request' and
+            'startup.import.<module>' for each module app.py imports directly
+    """
+    samples = {}
+    slowest = []
+    root = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+                             capture_output=True, text=True, cwd=root)
+        if run.returncode != 0:
+            raise RuntimeError(f"Starting the app failed: {run.stderr[-500:]}")
+        timings = json.loads(run.stdout.strip().splitlines()[-1])
+        for name, seconds in timings.items():
+            samples.setdefault(f"startup.{name}", []).append(seconds)
+        modules = parse_importtime(run.stderr)
+        # Modules imported while app.py loads are the ones nested one level under it
+        app_index = next(i for i, (name, depth, _) in enumerate(modules) if name == 'app' and depth == 0)
+        start = app_index
+        while start > 0 and modules[start - 1][1] > 0:
+            start -= 1
+        for name, depth, seconds in modules[start:app_index]:
+            if depth == 1:
+                samples.setdefault(f"startup.import.{name}", []).append(seconds)
+        slowest = sorted(modules[start:app_index], key=lambda m: m[2], reverse=True)
+
+    results = {name: summarize(values) for name, values in samples.items()}
+    logger.info(f"startup: import median {results['startup.import_app']['median'] * 1000:.1f}ms, "
+                f"first request median {results['startup.first_request']['median'] * 1000:.1f}ms; slowest imports: "
+                + ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, _, seconds in slowest[:8]))
+    return results
+
+
+def environment():
+    """Describe where the benchmarks ran"""
+    from analytics import ANALYTICS_VERSION
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'analytics_version': ANALYTICS_VERSION
+    }
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, thresholds=None):
+    """
+    Compare medians with a baseline run
+
+    Args:
+        results (dict): Benchmark summaries of this run
+        baseline (dict): Benchmark summaries of the baseline run
+        threshold (float): Allowed relative slowdown (0.10 = 10%)
+        thresholds (dict): Per-benchmark overrides, by name prefix
+
+    Returns:
+        list: One dict per benchmark present in both runs ('name', 'baseline',
+            'current', 'change', 'threshold', 'regression'), slowest change first
+    """
+    thresholds = thresholds or {}
+    rows = []
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        limit = threshold
+        for prefix, value in thresholds.items():
+            if name.startswith(prefix):
+                limit = value
+        before, now = baseline[name]['median'], summary['median']
+        change = (now - before) / before if before else 0.0
+        rows.append({
+            'name': name, 'baseline': before, 'current': now, 'change': change,
+            'threshold': limit, 'regression': change > limit
+        })
+    return sorted(rows, key=lambda row: row['change'], reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark IVR analytics, the end-to-end pipeline and cold start")
+    parser.add_argument('--suite', choices=('all', 'analytics', 'pipeline', 'startup'), default='all')
+    parser.add_argument('--sizes', default=','.join(SIZES), help="Comma-separated sizes: " + ', '.join(SIZES))
+    parser.add_argument('--repeat', type=int, default=20, help="Runs per analytics benchmark")
+    parser.add_argument('--pipeline-repeat', type=int, default=10, help="Runs per end-to-end benchmark")
+    parser.add_argument('--startup-repeat', type=int, default=5, help="Fresh interpreters started by the startup suite")
+    parser.add_argument('--openai-latency', type=float, default=0.0, help="Stand-in OpenAI latency in seconds")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--baseline', help="Compare with results from an earlier run")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="Allowed median slowdown (0.10 = 10%%)")
+    parser.add_argument('--thresholds', help='Per-benchmark thresholds as JSON, e.g. \'{"pipeline.": 0.25}\'')
+    parser.add_argument('--fail-on-regression', action='store_true', help="Exit with status 1 on a regression")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+    unknown = set(sizes) - set(SIZES)
+    if unknown:
+        parser.error(f"Unknown sizes: {', '.join(sorted(unknown))}")
+
+    workdir = None
+    if args.suite in ('all', 'pipeline', 'startup') and not os.getenv('DATABASE_PATH'):
+        # Keep benchmark calls, uploads and analyses out of the real database
+        workdir = tempfile.mkdtemp(prefix='echomap-bench-')
+        os.environ['DATABASE_PATH'] = os.path.join(workdir, 'bench.db')
+        os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+
+    try:
+        results = {}
+        if args.suite in ('all', 'analytics'):
+            results.update(bench_analytics(sizes, args.repeat))
+        if args.suite in ('all', 'pipeline'):
+            # The app logs every request at INFO; keep the benchmark output readable
+            logging.getLogger().setLevel(logging.WARNING)
+            results.update(bench_pipeline(sizes, args.pipeline_repeat, args.openai_latency))
+            logging.getLogger().setLevel(logging.INFO)
+        if args.suite in ('all', 'startup'):
+            results.update(bench_startup(args.startup_repeat))
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Wrote {len(results)} results to {args.output}")
+
+    print(f"{'benchmark':52} {'median':>10} {'p95':>10}")
+    for name, summary in results.items():
+        print(f"{name:52} {summary['median'] * 1000:9.2f}ms {summary['p95'] * 1000:9.2f}ms")
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    rows = compare(results, baseline, args.threshold, json.loads(args.thresholds) if args.thresholds else None)
+    regressions = [row for row in rows if row['regression']]
+    print(f"\nCompared with {args.baseline}:")
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['name']:52} {row['baseline'] * 1000:9.2f}ms -> {row['current'] * 1000:9.2f}ms "
+              f"{row['change']:+7.1%}{flag}")
+    print(f"{len(regressions)} regression(s) beyond threshold")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+import os
+import hmac
+import json
+import time
+import logging
+import db
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# How long call state is kept after its last update (seconds)
+CALL_STATE_TTL = int(os.getenv('CALL_STATE_TTL', 24 * 60 * 60))
+
+# How often expired rows are purged by each process (seconds)
+PURGE_INTERVAL = 5 * 60
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS calls (
+        call_sid TEXT PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'initiated',
+        data TEXT NOT NULL DEFAULT '{}',
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_calls_expires_at ON calls (expires_at)",
+]
+
+
+class CallStore:
+    """
+    Server-side call state keyed by CallSid (or VOXO call id).
+
+    Twilio callbacks do not carry the browser's cookie, so everything a call
+    accumulates - status, a timeline of DTMF digits and recording segments,
+    transcript and analysis - lives here instead of in the Flask session.
+    Rows expire CALL_STATE_TTL seconds after their last update and are shared
+    by all gunicorn workers through the SQLite database.
+    """
+
+    def __init__(self, path=None, ttl=CALL_STATE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._last_purge = 0
+
+    def _conn(self):
+        db.ensure_schema(self.path, 'call_store', SCHEMA)
+        return db.connect(self.path)
+
+    def get(self, call_sid):
+        """
+        Look up the state of a call
+
+        Args:
+            call_sid (str): The Twilio CallSid or VOXO call id
+
+        Returns:
+            dict: The call state with 'call_sid', 'status' and data fields, or None
+        """
+        if not call_sid:
+            return None
+        row = self._conn().execute(
+            "SELECT call_sid, status, data, created_at, updated_at FROM calls "
+            "WHERE call_sid = ? AND expires_at > ?",
+            (call_sid, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        state = json.loads(row['data'])
+        state.update({
+            'call_sid': row['call_sid'],
+            'status': row['status'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        })
+        return state
+
+    def update(self, call_sid, status=None, **fields):
+        """
+        Create or update a call, merging fields into its stored data
+
+        Args:
+            call_sid (str): The Twilio CallSid or VOXO call id
+            status (str): New call status (unchanged if None)
+            **fields: JSON-serialisable values to store on the call
+
+        Returns:
+            dict: The updated call state
+        """
+        if not call_sid:
+            return None
+        now = time.time()
+        conn = self._conn()
+        with db.transaction(conn):
+            row = conn.execute(
+                "SELECT status, data FROM calls WHERE call_sid = ? AND expires_at > ?",
+                (call_sid, now)
+            ).fetchone()
+            data = json.loads(row['data']) if row else {}
+            data.update(fields)
+            new_status = status or (row['status'] if row else 'initiated')
+            conn.execute(
+                """
+                INSERT INTO calls (call_sid, status, data, created_at, updated_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (call_sid) DO UPDATE SET
+                    status = excluded.status,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at,
+                    expires_at = excluded.expires_at
+                """,
+                (call_sid, new_status, json.dumps(data), now, now, now + self.ttl)
+            )
+        self._maybe_purge()
+        data.update({'call_sid': call_sid, 'status': new_status})
+        return data
+
+    def append_dtmf(self, call_sid, digits):
+        """
+        Append DTMF digits to a call's sequence and timeline
+
+        Returns:
+            list: The full DTMF sequence for the call
+        """
+        def append(data):
+            data.setdefault('dtmf_sequence', []).append(digits)
+            data.setdefault('timeline', []).append({'type': 'dtmf', 'digits': digits, 'at': time.time()})
+        return self._modify(call_sid, append)['dtmf_sequence']
+
+    def append_recording(self, call_sid, recording_sid, url, duration=None):
+        """
+        Add a recording segment to a call's timeline
+
+        Twilio retries recording callbacks, so a segment whose RecordingSid is
+        already on the timeline is not added twice. A new segment closes the
+        call's open <Record> (see calls.record_segment).
+
+        Returns:
+            list: The call's timeline of 'dtmf' and 'recording' entries, in order
+        """
+        def append(data):
+            timeline = data.setdefault('timeline', [])
+            if any(entry.get('recording_sid') == recording_sid for entry in timeline):
+                return
+            data['recording_open'] = False
+            timeline.append({
+                'type': 'recording', 'recording_sid': recording_sid, 'url': url,
+                'duration': duration, 'at': time.time()
+            })
+        return self._modify(call_sid, append)['timeline']
+
+    def store_recording(self, call_sid, url):
+        """
+        Store a call's recording URL (VOXO)
+
+        Returns:
+            bool: True if an analysis was waiting for the recording (see
+                wait_for_recording); it is marked 'processing' again and
+                the caller runs it
+        """
+        waiting = []
+
+        def store(data):
+            data['recording'] = {'url': url, 'timestamp': time.time()}
+            if url and data.get('transcription_status') == 'awaiting_recording':
+                data['transcription_status'] = 'processing'
+                waiting.append(call_sid)
+        self._modify(call_sid, store)
+        return bool(waiting)
+
+    def wait_for_recording(self, call_sid):
+        """
+        Return a call's recording URL, or mark the call as waiting for it
+
+        Checked and marked in one transaction with store_recording(), so a
+        recording that arrives meanwhile is either returned here or starts
+        the waiting analysis there.
+
+        Returns:
+            str: The recording URL, or None if the call now waits for it
+        """
+        def wait(data):
+            if not (data.get('recording') or {}).get('url'):
+                data['transcription_status'] = 'awaiting_recording'
+        return (self._modify(call_sid, wait).get('recording') or {}).get('url')
+
+    def start_stream(self, call_sid, token, stream_sid):
+        """
+        Attach a live media stream to a call that was offered one (see twilio_ivr)
+
+        The stream must present the token stored on the call with its <Stream>,
+        and a call takes one stream only; an unknown call is not created.
+
+        Returns:
+            bool: True if the stream was accepted; its live transcript then
+                supersedes transcribing the call's recordings
+        """
+        now = time.time()
+        conn = self._conn()
+        with db.transaction(conn):
+            row = conn.execute(
+                "SELECT data FROM calls WHERE call_sid = ? AND expires_at > ?",
+                (call_sid, now)
+            ).fetchone()
+            data = json.loads(row['data']) if row else {}
+            expected = data.get('stream_token')
+            if not expected or not token or data.get('stream_sid') or \
+                    not hmac.compare_digest(expected.encode(), str(token).encode()):
+                return False
+            data.update(live_analysis=True, stream_sid=stream_sid)
+            conn.execute(
+                "UPDATE calls SET data = ?, updated_at = ?, expires_at = ? WHERE call_sid = ?",
+                (json.dumps(data), now, now + self.ttl, call_sid)
+            )
+        return True
+
+    def _modify(self, call_sid, change):
+        """Apply change(data) to a call's data inside a write transaction and return the data"""
+        now = time.time()
+        conn = self._conn()
+        with db.transaction(conn):
+            row = conn.execute(
+                "SELECT data FROM calls WHERE call_sid = ? AND expires_at > ?",
+                (call_sid, now)
+            ).fetchone()
+            data = json.loads(row['data']) if row else {}
+            change(data)
+            conn.execute(
+                """
+                INSERT INTO calls (call_sid, status, data, created_at, updated_at, expires_at)
+                VALUES (?, 'in-progress', ?, ?, ?, ?)
+                ON CONFLICT (call_sid) DO UPDATE SET
+                    data = excluded.data,
+                    updated_at = excluded.updated_at,
+                    expires_at = excluded.expires_at
+                """,
+                (call_sid, json.dumps(data), now, now, now + self.ttl)
+            )
+        return data
+
+    def purge_expired(self):
+        """Delete expired calls and return how many were removed"""
+        cursor = self._conn().execute("DELETE FROM calls WHERE expires_at <= ?", (time.time(),))
+        if cursor.rowcount:
+            logger.info(f"Purged {cursor.rowcount} expired call(s)")
+        return cursor.rowcount
+
+    def _maybe_purge(self):
+        """Purge expired rows at most once per PURGE_INTERVAL in this process"""
+        if time.time() - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = time.time()
+            self.purge_expired()
+
+
+# Shared store for this process
+call_store = CallStore()
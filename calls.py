@@ -0,0 +1,422 @@
+"""
+Outbound calls and the Twilio and VOXO webhooks that drive them, plus the
+/media-stream WebSocket for live analysis
+"""
+
+import os
+import re
+import json
+import secrets
+import logging
+import threading
+from functools import partial
+from flask import Blueprint, current_app, request, jsonify, Response, url_for
+from twilio.twiml.voice_response import VoiceResponse, Start
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
+from voxo_integration import initiate_call_and_record
+from twilio_integration import place_call, TERMINAL_STATUSES
+from events import broker
+from call_store import call_store
+from analysis_store import analysis_store
+from pipeline import process_call_transcript, process_call_recordings, process_voxo_transcription, record_failure
+from recordings import recording_segments
+import tracing
+import jobs
+from media_stream import MediaStreamSession
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+calls = Blueprint('calls', __name__)
+
+# How long a call that ended while recording waits for its last segment's callback (seconds)
+RECORDING_WAIT_SECONDS = int(os.getenv('RECORDING_WAIT_SECONDS', 30))
+
+# WebSocket routes; attached to the app by create_app()
+sock = Sock()
+
+@calls.route('/call-ivr', methods=['POST'])
+def call_ivr():
+    """Start a recorded VOXO call and return its handle immediately"""
+    phone_number = request.form.get('phone_number')
+    if not phone_number:
+        return jsonify({'error': 'Phone number required'}), 400
+    try:
+        call_id = initiate_call_and_record(phone_number)
+        tracing.set_key(call_id)
+        call_store.update(call_id, status='initiated', provider='voxo', to_number=phone_number)
+        broker.publish(call_id, 'status', {'status': 'initiated'})
+        logger.info(f"VOXO call initiated with id: {call_id}")
+
+        # Recording, transcription and analysis arrive later through /voxo-webhook
+        return jsonify({
+            'call_id': call_id,
+            'status': 'initiated',
+            'status_url': url_for('calls.call_status', call_sid=call_id),
+            'events_url': url_for('web.events', channel=call_id)
+        }), 202
+    except Exception as e:
+        logger.error(f"Error initiating VOXO call: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@calls.route('/voxo-webhook', methods=['POST'])
+def voxo_webhook():
+    """Handle VOXO call events; analysis runs in the background"""
+    data = request.get_json(silent=True) or {}
+    event_type = data.get('eventType')
+    call_id = data.get('callId') or data.get('call_id', '')
+    tracing.set_key(call_id)
+    logger.info(f"Received VOXO webhook event: {event_type} for call {call_id}")
+
+    # VOXO retries deliveries it did not see acknowledged; process each event once
+    delivery_key = f"voxo:{call_id}:{event_type}"
+    if call_id and not jobs.claim(delivery_key):
+        return '', 200
+
+    if event_type == 'STARTCALL':
+        logger.info(f"Call started: {data}")
+        call_store.update(call_id, status='in-progress', provider='voxo')
+        broker.publish(call_id, 'status', {'status': 'in-progress'})
+    elif event_type == 'RECORDING_AVAILABLE':
+        recording_url = data.get('recordingUrl')
+        logger.info(f"Recording available: {recording_url}")
+        waiting = call_store.store_recording(call_id, recording_url)
+        call_store.update(call_id, status='completed')
+        broker.publish(call_id, 'status', {'status': 'completed'})
+        broker.publish(call_id, 'stage', {'stage': 'recorded'})
+        if waiting:
+            # The transcription event came first, without a transcript: analyse the recording now
+            jobs.submit(
+                process_voxo_transcription, call_id,
+                release_key=delivery_key, on_error=partial(record_failure, call_id)
+            )
+    elif event_type == 'TRANSCRIPTION_AVAILABLE':
+        transcript = data.get('transcription') or ''
+        logger.info(f"Transcription available: {transcript[:100]}...")
+        if call_id:
+            call_store.update(call_id, transcription_status='processing')
+            jobs.submit(
+                process_voxo_transcription, call_id, transcript,
+                release_key=delivery_key, on_error=partial(record_failure, call_id)
+            )
+    else:
+        logger.warning(f"Unhandled VOXO event type: {event_type}")
+    return '', 200
+
+@calls.route('/call-status', methods=['GET', 'POST'])
+def call_status():
+    """Handle Twilio call status updates"""
+    call_sid = request.values.get('CallSid', '')
+    call_status = request.values.get('CallStatus', '')
+    
+    logger.info(f"Call {call_sid} status updated to: {call_status}")
+    
+    # Store call status in the server-side call store
+    if call_sid and call_status:
+        call = call_store.update(call_sid, status=call_status)
+        broker.publish(call_sid, 'status', {'status': call_status})
+        logger.info(f"Stored call status for {call_sid}: {call_status}")
+
+        # Once the call is over, transcribe all of its recording segments together
+        if call_status == 'completed' and not call.get('live_analysis'):
+            transcribe_recordings(call_sid, call)
+    
+    # For GET requests, return the current status
+    if request.method == 'GET':
+        # Get the latest DTMF, transcript and analysis for this call
+        call_sid = call_sid or request.args.get('call_sid', '')
+        call = call_store.get(call_sid) or {}
+        dtmf_sequence = call.get('dtmf_sequence', [])
+        transcript = call.get('transcript', '')
+        analysis = {}
+        if call.get('analysis_id'):
+            analysis = analysis_store.get(call['analysis_id']) or {}
+        current_status = call.get('status', 'initiated')  # Default to initiated if not set
+        
+        # Get the current transcription status
+        transcription_status = call.get('transcription_status', 'pending')
+        if transcription_status == 'pending' and current_status in ['in-progress', 'answered']:
+            transcription_status = 'in-progress'
+        
+        logger.info(f"Returning status for {call_sid}: {current_status}")
+        return jsonify({
+            'status': current_status,
+            'dtmf': dtmf_sequence[-1] if dtmf_sequence else None,
+            'transcript': transcript,
+            'analysis': analysis,
+            'transcription_status': transcription_status,
+            'transcription_error': call.get('transcription_error')
+        })
+    
+    return ('', 200)
+
+def call_placed(call, to_number):
+    """Store and announce a newly placed Twilio call; returns the /make-call response"""
+    tracing.set_key(call.sid)
+    
+    # Store initial call status
+    call_store.update(call.sid, status='initiated', provider='twilio', to_number=to_number)
+    broker.publish(call.sid, 'status', {'status': 'initiated'})
+    logger.info(f"Call initiated with SID: {call.sid}, status: {call.status}")
+    
+    return jsonify({
+        'message': 'Call initiated successfully',
+        'call_sid': call.sid,
+        'status': call.status
+    })
+
+@calls.route('/make-call', methods=['POST'])
+def make_call():
+    """Initiate a new call to the specified number"""
+    to_number = request.form.get('to_number')
+    if not to_number:
+        return jsonify({'error': 'Phone number required'}), 400
+
+    try:
+        webhook_url = os.getenv('WEBHOOK_URL', request.url_root.rstrip('/'))
+        logger.info(f"Using webhook URL: {webhook_url}")
+        return call_placed(place_call(to_number, webhook_url), to_number)
+        
+    except Exception as e:
+        logger.error(f"Error initiating call: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+def record_segment(response, call_sid):
+    """
+    Add a <Record> verb for the next segment of the call
+
+    Each menu visited is recorded as its own segment; segments are transcribed
+    by our Whisper pipeline once the call ends (see recordings.py), so
+    Twilio's own transcription - limited to two minutes - is not requested.
+    The call is marked as recording until the segment's callback arrives.
+    """
+    call_store.update(call_sid, recording_open=True)
+    response.record(
+        action='/recording-callback',
+        method='POST',
+        maxLength='300',  # 5 minutes max
+        playBeep=False,  # Don't play beep since we're recording IVR
+        trim='trim-silence',  # Trim silence from the recording
+        detect_speech=True,  # Enable speech detection
+        detect_silence=True,  # Enable silence detection
+        detect_silence_timeout=2  # Timeout in seconds for silence detection
+    )
+
+def media_stream_url():
+    """Public WebSocket URL of the /media-stream endpoint"""
+    base = os.getenv('WEBHOOK_URL', request.url_root).rstrip('/')
+    return re.sub(r'^http', 'ws', base) + '/media-stream'
+
+def transcribe_recordings(call_sid, call):
+    """
+    Queue transcription of a finished call's segments, once all have arrived
+
+    Twilio often reports the call completed before the callback of its last
+    <Record>. While a segment is still open this waits for that callback,
+    which calls here again, or for RECORDING_WAIT_SECONDS if it never comes
+    (e.g. the caller hung up before the <Record> started).
+    """
+    if call.get('recording_open'):
+        timer = threading.Timer(RECORDING_WAIT_SECONDS, jobs.bind(start_transcription), args=(call_sid,))
+        timer.daemon = True
+        timer.start()
+        return
+    start_transcription(call_sid)
+
+def start_transcription(call_sid):
+    """Transcribe and analyse the call's recording segments (at most once per call)"""
+    segment_count = len(recording_segments((call_store.get(call_sid) or {}).get('timeline', [])))
+    if not segment_count:
+        return
+    delivery_key = f"twilio-recordings:{call_sid}"
+    if jobs.claim(delivery_key):
+        logger.info(f"Transcribing {segment_count} recording segment(s) for call {call_sid}")
+        jobs.submit(
+            process_call_recordings, call_sid,
+            release_key=delivery_key, on_error=partial(record_failure, call_sid)
+        )
+
+@calls.route('/twilio-ivr', methods=['POST'])
+def twilio_ivr():
+    """Handle incoming Twilio calls with IVR flow"""
+    try:
+        response = VoiceResponse()
+        call_sid = request.values.get('CallSid', '')
+        answered_by = request.values.get('AnsweredBy', '')
+        logger.info(f"New call initiated with SID: {call_sid}, Answered by: {answered_by}")
+        
+        # Store initial call status
+        call = call_store.update(call_sid, status='in-progress', answered_by=answered_by)
+        broker.publish(call_sid, 'status', {'status': 'in-progress'})
+        
+        # Fork the call audio to the live analysis WebSocket, which only accepts
+        # a stream that presents this call's token
+        if current_app.config['LIVE_ANALYSIS'] and call_sid:
+            stream_token = secrets.token_urlsafe(24)
+            call_store.update(call_sid, stream_token=stream_token)
+            start = Start()
+            stream = start.stream(url=media_stream_url(), track='both_tracks')
+            stream.parameter(name='token', value=stream_token)
+            response.append(start)
+        
+        # Check if it's a machine (campaign and explorer calls always dial IVRs)
+        if answered_by == 'machine_start' or call.get('automated'):
+            logger.info("Machine detected, starting recording")
+            # Start recording immediately for machine
+            record_segment(response, call_sid)
+        else:
+            # For human answers, play a brief message
+            response.say("Thank you for calling. This is an automated system. Please press any key to continue.",
+                       voice='alice',
+                       language='en-US')
+            
+            # Gather DTMF input
+            gather = response.gather(
+                input='dtmf',
+                timeout=5,  # Wait up to 5 seconds for input
+                action='/handle-dtmf',
+                method='POST'
+            )
+            
+            # If no input is received, start recording anyway
+            record_segment(response, call_sid)
+        
+        logger.info(f"Generated TwiML response for call {call_sid}")
+        return Response(str(response), mimetype='text/xml')
+        
+    except Exception as e:
+        logger.error(f"Error in twilio_ivr: {str(e)}", exc_info=True)
+        error_response = VoiceResponse()
+        error_response.say("We're sorry, but an error occurred. Please try your call again later.",
+                         voice='alice',
+                         language='en-US')
+        error_response.hangup()
+        return Response(str(error_response), mimetype='text/xml')
+
+@sock.route('/media-stream', bp=calls)
+def media_stream(ws):
+    """Receive Twilio Media Streams audio and analyse the call while it runs"""
+    session = MediaStreamSession()
+    try:
+        while True:
+            message = ws.receive()
+            if message is None or not session.handle(json.loads(message)):
+                break
+    except ConnectionClosed:
+        logger.info("Media stream connection closed by Twilio")
+    except Exception as e:
+        logger.error(f"Error in media stream: {str(e)}", exc_info=True)
+    finally:
+        # Also finalises streams that dropped without a stop message
+        session.close()
+
+@calls.route('/handle-dtmf', methods=['POST'])
+def handle_dtmf():
+    """Handle DTMF input from the IVR"""
+    try:
+        response = VoiceResponse()
+        digits = request.values.get('Digits', '')
+        call_sid = request.values.get('CallSid', '')
+        
+        logger.info(f"DTMF received for call {call_sid}: {digits}")
+        
+        # Store the DTMF input with the call
+        call_store.append_dtmf(call_sid, digits)
+        broker.publish(call_sid, 'dtmf', {'digits': digits})
+        
+        # Start recording after DTMF input
+        record_segment(response, call_sid)
+        
+        return Response(str(response), mimetype='text/xml')
+        
+    except Exception as e:
+        logger.error(f"Error in handle_dtmf: {str(e)}", exc_info=True)
+        error_response = VoiceResponse()
+        error_response.hangup()
+        return Response(str(error_response), mimetype='text/xml')
+
+@calls.route('/recording-callback', methods=['POST'])
+def recording_callback():
+    """Handle the completed recording"""
+    try:
+        response = VoiceResponse()
+        recording_url = request.values.get('RecordingUrl', '')
+        recording_sid = request.values.get('RecordingSid', '')
+        call_sid = request.values.get('CallSid', '')
+        
+        logger.info(f"Recording completed - SID: {recording_sid}, URL: {recording_url}")
+        
+        # Add the segment to the call's timeline
+        call_store.append_recording(
+            call_sid, recording_sid, recording_url, duration=request.values.get('RecordingDuration', type=int)
+        )
+        broker.publish(call_sid, 'stage', {'stage': 'recorded', 'recording_sid': recording_sid})
+
+        # The caller hung up while recording: nothing more will be recorded
+        call = call_store.get(call_sid) or {}
+        if call.get('status') in TERMINAL_STATUSES:
+            if not call.get('live_analysis'):
+                transcribe_recordings(call_sid, call)
+            return Response(str(response), mimetype='text/xml')
+
+        # Offer another menu choice; each one is recorded as a new segment
+        response.gather(
+            input='dtmf',
+            timeout=5,
+            action='/handle-dtmf',
+            method='POST'
+        )
+
+        # No further input: end the call (transcription starts on the completed status)
+        response.say("Thank you for your call. The recording is complete.",
+                    voice='alice',
+                    language='en-US')
+        response.hangup()
+        
+        return Response(str(response), mimetype='text/xml')
+        
+    except Exception as e:
+        logger.error(f"Error in recording_callback: {str(e)}", exc_info=True)
+        error_response = VoiceResponse()
+        error_response.hangup()
+        return Response(str(error_response), mimetype='text/xml')
+
+@calls.route('/transcription-callback', methods=['POST'])
+def transcription_callback():
+    """
+    Acknowledge a completed Twilio transcription and analyse it in the background
+
+    Recordings are now transcribed with Whisper once the call ends; this
+    remains for calls whose <Record> still requested Twilio transcription.
+    """
+    transcription_text = request.values.get('TranscriptionText', '')
+    transcription_status = request.values.get('TranscriptionStatus', 'completed')
+    call_sid = request.values.get('CallSid', '')
+    recording_sid = request.values.get('RecordingSid', '')
+
+    logger.info(f"Transcription received for call {call_sid} (recording {recording_sid})")
+    logger.debug(f"Transcription preview: {transcription_text[:100]}...")
+
+    try:
+        # Twilio retries callbacks it considers timed out; run the pipeline once per recording
+        delivery_key = f"twilio-transcription:{recording_sid or call_sid}"
+        if not jobs.claim(delivery_key):
+            return Response(str(VoiceResponse()), mimetype='text/xml')
+
+        if transcription_status == 'failed' or not transcription_text.strip():
+            logger.warning(f"No usable transcription for call {call_sid} (status: {transcription_status})")
+            call_store.update(call_sid, transcription_status='failed')
+            broker.publish(call_sid, 'error', {'error': 'Twilio could not transcribe the recording'})
+        else:
+            call_store.update(call_sid, transcription_status='processing')
+            jobs.submit(
+                process_call_transcript, call_sid, transcription_text,
+                release_key=delivery_key, on_error=partial(record_failure, call_sid)
+            )
+
+    except Exception as e:
+        logger.error(f"Error accepting transcription: {str(e)}", exc_info=True)
+        broker.publish(call_sid, 'error', {'error': f"Error processing transcription: {str(e)}"})
+
+    return Response(str(VoiceResponse()), mimetype='text/xml')
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Outbound IVR crawl campaigns
+
+Dials a list of numbers through one or more telephony providers while
+enforcing a concurrency cap per provider and per destination, retries
+busy/unanswered/failed calls with exponential backoff, and writes one
+result per number to a results sink.
+
+Run with --simulate to benchmark crawl throughput offline:
+
+    python campaign.py --simulate --numbers 500 --concurrency 25 --time-scale 0.01
+"""
+
+import os
+import json
+import time
+import uuid
+import heapq
+import random
+import logging
+import argparse
+import threading
+from collections import Counter
+import db
+from admission import admission, CALL_COST
+from call_store import call_store
+from events import broker
+from metrics import retries
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# How long to wait for a call to be dialled, recorded and analysed (seconds)
+CALL_TIMEOUT = int(os.getenv('CAMPAIGN_CALL_TIMEOUT', 15 * 60))
+
+# Call statuses that end a call without a recording
+UNANSWERED_STATUSES = {'busy', 'failed', 'no-answer', 'canceled'}
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS campaigns (
+        id TEXT PRIMARY KEY,
+        provider TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        options TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at REAL NOT NULL,
+        finished_at REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS campaign_results (
+        campaign_id TEXT NOT NULL,
+        number TEXT NOT NULL,
+        send_digits TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        call_id TEXT,
+        analysis_id INTEGER,
+        error TEXT,
+        finished_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_campaign_results_campaign ON campaign_results (campaign_id, finished_at)",
+]
+
+
+def wait_for_call_outcome(call_id, timeout=CALL_TIMEOUT):
+    """
+    Wait on a call's event channel until it is analysed or ends without a recording
+
+    Returns:
+        dict: 'status' ('analyzed', an unanswered status, 'error' or 'timeout'),
+            plus 'analysis_id' or 'error' where available
+    """
+    last_id = 0
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for event in broker.wait(call_id, last_id, timeout=min(30, max(0, deadline - time.time()))):
+            last_id = event['id']
+            data = event['data']
+            if event['event'] == 'analysis':
+                return {'status': 'analyzed', 'analysis_id': data.get('analysis_id')}
+            if event['event'] == 'error':
+                return {'status': 'error', 'error': data.get('error')}
+            if event['event'] == 'status' and data.get('status') in UNANSWERED_STATUSES:
+                return {'status': data['status']}
+    return {'status': 'timeout', 'error': f"No result within {timeout}s"}
+
+
+class TwilioProvider:
+    """Dials through Twilio; results arrive through the /twilio-ivr webhook chain"""
+
+    name = 'twilio'
+
+    def __init__(self, webhook_url=None, timeout=CALL_TIMEOUT):
+        self.webhook_url = (webhook_url or os.getenv('WEBHOOK_URL', '')).rstrip('/')
+        self.timeout = timeout
+        if not self.webhook_url:
+            raise ValueError("WEBHOOK_URL must be set to place calls outside a request")
+
+    def dial(self, number, send_digits=None):
+        from twilio_integration import place_call
+        call = place_call(number, self.webhook_url, send_digits=send_digits)
+        # Automated calls skip the human greeting in /twilio-ivr and record straight away
+        call_store.update(
+            call.sid, status='initiated', provider=self.name, to_number=number,
+            send_digits=send_digits, automated=True
+        )
+        broker.publish(call.sid, 'status', {'status': 'initiated'})
+        return call.sid
+
+    def wait(self, call_id):
+        return wait_for_call_outcome(call_id, self.timeout)
+
+
+class VoxoProvider:
+    """Dials through VOXO; results arrive through /voxo-webhook"""
+
+    name = 'voxo'
+
+    def __init__(self, timeout=CALL_TIMEOUT):
+        self.timeout = timeout
+
+    def dial(self, number, send_digits=None):
+        from voxo_integration import initiate_call_and_record
+        if send_digits:
+            raise ValueError("The VOXO provider cannot send DTMF digits")
+        call_id = initiate_call_and_record(number)
+        call_store.update(call_id, status='initiated', provider=self.name, to_number=number, automated=True)
+        broker.publish(call_id, 'status', {'status': 'initiated'})
+        return call_id
+
+    def wait(self, call_id):
+        return wait_for_call_outcome(call_id, self.timeout)
+
+
+class SimulatedProvider:
+    """
+    Offline stand-in for a telephony provider.
+
+    Each call "lasts" a random duration drawn from call_duration (seconds,
+    multiplied by time_scale) and ends with an outcome drawn from
+    outcome_weights. Nothing is dialled, recorded or stored.
+    """
+
+    name = 'simulated'
+
+    DEFAULT_OUTCOMES = {'analyzed': 0.85, 'busy': 0.05, 'no-answer': 0.07, 'failed': 0.03}
+
+    def __init__(self, call_duration=(30, 90), outcome_weights=None, time_scale=1.0, seed=None):
+        self.call_duration = call_duration
+        self.outcome_weights = outcome_weights or self.DEFAULT_OUTCOMES
+        self.time_scale = time_scale
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def dial(self, number, send_digits=None):
+        return f"SIM{uuid.uuid4().hex[:29]}"
+
+    def wait(self, call_id):
+        with self._lock:
+            duration = self._random.uniform(*self.call_duration)
+            status = self._random.choices(list(self.outcome_weights), weights=list(self.outcome_weights.values()))[0]
+        time.sleep(duration * self.time_scale)
+        return {'status': status}
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter for calls that did not produce an analysis"""
+
+    def __init__(self, max_attempts=3, backoff=60, multiplier=2, max_backoff=15 * 60,
+                 retry_on=('busy', 'no-answer', 'failed', 'error', 'timeout')):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.retry_on = set(retry_on)
+
+    def should_retry(self, outcome, attempt):
+        return outcome['status'] in self.retry_on and attempt < self.max_attempts
+
+    def delay(self, attempt):
+        base = min(self.max_backoff, self.backoff * self.multiplier ** (attempt - 1))
+        return base * random.uniform(0.9, 1.1)
+
+
+class JsonlSink:
+    """Append one JSON line per result to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+class SqliteSink:
+    """Store results in the campaign_results table of the shared database"""
+
+    def __init__(self, campaign_id, path=None):
+        self.campaign_id = campaign_id
+        self.path = path
+
+    def write(self, result):
+        db.ensure_schema(self.path, 'campaign', SCHEMA)
+        db.connect(self.path).execute(
+            """
+            INSERT INTO campaign_results
+                (campaign_id, number, send_digits, status, attempts, call_id, analysis_id, error, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (self.campaign_id, result['number'], result.get('send_digits'), result['status'],
+             result['attempts'], result.get('call_id'), result.get('analysis_id'),
+             result.get('error'), result['finished_at'])
+        )
+
+
+class Campaign:
+    """
+    Scheduler for a batch of outbound calls.
+
+    Each provider gets as many worker threads as its concurrency cap. Workers
+    take the earliest task that is due and whose destination is below
+    per_destination active calls, so one slow IVR never holds more than its
+    share of lines. Failed attempts are re-queued according to the retry
+    policy; the final result for each task goes to the sink.
+
+    Tasks can be added with submit() while the campaign runs (the DTMF
+    explorer does this); call close() once no more will be added.
+    """
+
+    def __init__(self, providers, numbers=(), per_destination=1, retry_policy=None, sink=None,
+                 campaign_id=None, destination_key=None, on_result=None, client=None):
+        """
+        Args:
+            providers (list): (provider, max_concurrent_calls) pairs
+            numbers (iterable): Numbers to dial; the campaign is closed after
+                adding them unless empty
+            per_destination (int): Maximum simultaneous calls per destination
+            retry_policy (RetryPolicy): Retry behaviour (defaults to RetryPolicy())
+            sink: Object with a write(result) method, or None
+            campaign_id (str): Identifier used in results (generated if omitted)
+            destination_key (callable): Maps a number to its destination key
+            on_result (callable): Called with each final result after the sink
+            client (str): Charge the first call to every number after the first
+                to this client's admission bucket (see admission.py)
+        """
+        self.id = campaign_id or uuid.uuid4().hex
+        self.providers = providers
+        self.per_destination = per_destination
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.sink = sink
+        self.destination_key = destination_key or (lambda number: number)
+        self.on_result = on_result
+        self.client = client
+
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = 0
+        self._remaining = 0
+        self._closed = False
+        self._active_destinations = Counter()
+        self._active_providers = Counter()
+        self._max_active = Counter()
+        self._outcomes = Counter()
+        self._retries = 0
+        self._dialled = 0
+        self._started_at = None
+        self._finished_at = None
+        self._thread = None
+
+        numbers = list(numbers)
+        for number in numbers:
+            self.submit(number)
+        if numbers:
+            self.close()
+
+    def submit(self, number, send_digits=None, **context):
+        """Queue a call; extra keyword arguments are copied into its result"""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Campaign is closed")
+            self._push(time.time(), {'number': number, 'send_digits': send_digits, 'attempt': 1, 'context': context})
+            self._remaining += 1
+            self._condition.notify_all()
+
+    def close(self):
+        """Declare that no more tasks will be submitted"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def run(self):
+        """Run the campaign to completion and return its stats"""
+        self._started_at = time.time()
+        logger.info(f"Campaign {self.id} starting with {self._remaining} call(s)")
+        threads = []
+        for provider, max_concurrent in self.providers:
+            for i in range(max_concurrent):
+                thread = threading.Thread(
+                    target=self._worker, args=(provider,), name=f"campaign-{provider.name}-{i}", daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self._finished_at = time.time()
+        stats = self.stats()
+        logger.info(f"Campaign {self.id} finished: {stats}")
+        return stats
+
+    def start(self):
+        """Run the campaign in a background thread"""
+        self._thread = threading.Thread(target=self.run, name=f"campaign-{self.id}", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stats(self):
+        """Return progress and throughput figures"""
+        with self._condition:
+            end = self._finished_at or time.time()
+            elapsed = end - self._started_at if self._started_at else 0
+            finished = sum(self._outcomes.values())
+            return {
+                'campaign_id': self.id,
+                'remaining': self._remaining,
+                'finished': finished,
+                'outcomes': dict(self._outcomes),
+                'retries': self._retries,
+                'max_active_per_provider': dict(self._max_active),
+                'elapsed_seconds': round(elapsed, 3),
+                'calls_per_minute': round(finished / elapsed * 60, 2) if elapsed else 0
+            }
+
+    def _push(self, ready_at, task):
+        self._sequence += 1
+        heapq.heappush(self._queue, (ready_at, self._sequence, task))
+
+    def _take_task(self):
+        """Pop the first due task whose destination has a free slot; return (task, wait)"""
+        now = time.time()
+        skipped = []
+        task = None
+        wait = None
+        while self._queue:
+            ready_at, sequence, candidate = self._queue[0]
+            if ready_at > now:
+                wait = ready_at - now
+                break
+            heapq.heappop(self._queue)
+            if self._active_destinations[self.destination_key(candidate['number'])] < self.per_destination:
+                task = candidate
+                break
+            skipped.append((ready_at, sequence, candidate))
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return task, wait
+
+    def _worker(self, provider):
+        while True:
+            with self._condition:
+                while True:
+                    if self._remaining == 0 and self._closed:
+                        return
+                    task, wait = self._take_task()
+                    if task is not None:
+                        break
+                    self._condition.wait(wait)
+                destination = self.destination_key(task['number'])
+                self._active_destinations[destination] += 1
+                self._active_providers[provider.name] += 1
+                self._max_active[provider.name] = max(self._max_active[provider.name], self._active_providers[provider.name])
+                charge = self.client and task['attempt'] == 1 and self._dialled > 0
+                self._dialled += task['attempt'] == 1
+
+            if charge:
+                admission.charge(self.client, CALL_COST)
+            outcome = self._attempt(provider, task)
+
+            result = None
+            with self._condition:
+                self._active_destinations[destination] -= 1
+                self._active_providers[provider.name] -= 1
+                if self.retry_policy.should_retry(outcome, task['attempt']):
+                    self._retries += 1
+                    delay = self.retry_policy.delay(task['attempt'])
+                    retries.inc(operation='campaign_call')
+                    logger.info(f"Retrying {task['number']} in {delay:.0f}s after {outcome['status']}")
+                    self._push(time.time() + delay, dict(task, attempt=task['attempt'] + 1))
+                else:
+                    self._outcomes[outcome['status']] += 1
+                    result = dict(
+                        task['context'],
+                        campaign_id=self.id,
+                        number=task['number'],
+                        send_digits=task['send_digits'],
+                        attempts=task['attempt'],
+                        provider=provider.name,
+                        finished_at=time.time(),
+                        **outcome
+                    )
+                self._condition.notify_all()
+
+            if result is not None:
+                self._deliver(result)
+
+    def _attempt(self, provider, task):
+        """Dial one task and wait for its outcome"""
+        try:
+            call_id = provider.dial(task['number'], send_digits=task['send_digits'])
+            outcome = provider.wait(call_id)
+            outcome['call_id'] = call_id
+            return outcome
+        except Exception as e:
+            logger.error(f"Call to {task['number']} failed: {str(e)}", exc_info=True)
+            return {'status': 'error', 'error': str(e)}
+
+    def _deliver(self, result):
+        """Hand a final result to the sink and callback, then count the task as done"""
+        try:
+            if self.sink is not None:
+                self.sink.write(result)
+            if self.on_result is not None:
+                self.on_result(result)
+        except Exception as e:
+            logger.error(f"Error delivering campaign result: {str(e)}", exc_info=True)
+        finally:
+            with self._condition:
+                self._remaining -= 1
+                self._condition.notify_all()
+
+
+def create_campaign_record(campaign_id, provider, total, options, path=None):
+    """Register a campaign in the shared database so any worker can report on it"""
+    db.ensure_schema(path, 'campaign', SCHEMA)
+    db.connect(path).execute(
+        "INSERT INTO campaigns (id, provider, total, options, created_at) VALUES (?, ?, ?, ?, ?)",
+        (campaign_id, provider, total, json.dumps(options), time.time())
+    )
+
+def finish_campaign_record(campaign_id, path=None):
+    db.ensure_schema(path, 'campaign', SCHEMA)
+    db.connect(path).execute(
+        "UPDATE campaigns SET status = 'finished', finished_at = ? WHERE id = ?", (time.time(), campaign_id)
+    )
+
+def get_campaign_progress(campaign_id, path=None):
+    """Return a campaign's record with per-status result counts, or None"""
+    db.ensure_schema(path, 'campaign', SCHEMA)
+    conn = db.connect(path)
+    row = conn.execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+    if row is None:
+        return None
+    campaign = dict(row)
+    campaign['options'] = json.loads(campaign['options'])
+    counts = conn.execute(
+        "SELECT status, COUNT(*) AS n FROM campaign_results WHERE campaign_id = ? GROUP BY status", (campaign_id,)
+    ).fetchall()
+    campaign['outcomes'] = {r['status']: r['n'] for r in counts}
+    campaign['finished'] = sum(campaign['outcomes'].values())
+    return campaign
+
+def get_campaign_results(campaign_id, page=1, per_page=100, path=None):
+    """Return one page of a campaign's results in completion order"""
+    db.ensure_schema(path, 'campaign', SCHEMA)
+    per_page = max(1, min(500, int(per_page)))
+    rows = db.connect(path).execute(
+        "SELECT * FROM campaign_results WHERE campaign_id = ? ORDER BY finished_at LIMIT ? OFFSET ?",
+        (campaign_id, per_page, (max(1, int(page)) - 1) * per_page)
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+def make_provider(name, **options):
+    """Create a provider by name ('twilio', 'voxo' or 'simulated')"""
+    if name == 'twilio':
+        return TwilioProvider(webhook_url=options.get('webhook_url'))
+    if name == 'voxo':
+        return VoxoProvider()
+    if name == 'simulated':
+        return SimulatedProvider(time_scale=options.get('time_scale', 1.0), seed=options.get('seed'))
+    raise ValueError(f"Unknown telephony provider: {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an outbound IVR crawl campaign")
+    parser.add_argument('numbers_file', nargs='?', help="File with one phone number per line")
+    parser.add_argument('--provider', default='twilio', choices=['twilio', 'voxo', 'simulated'])
+    parser.add_argument('--simulate', action='store_true', help="Shortcut for --provider simulated")
+    parser.add_argument('--numbers', type=int, default=200, help="Number of fake numbers when simulating")
+    parser.add_argument('--destinations', type=int, default=50, help="Distinct fake destinations when simulating")
+    parser.add_argument('--concurrency', type=int, default=10, help="Maximum simultaneous calls")
+    parser.add_argument('--per-destination', type=int, default=1, help="Maximum simultaneous calls per number")
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=60, help="Initial retry delay in seconds")
+    parser.add_argument('--time-scale', type=float, default=0.01, help="Simulated time multiplier")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--results', help="Write results as JSON lines to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    provider_name = 'simulated' if args.simulate else args.provider
+    if args.numbers_file:
+        with open(args.numbers_file) as f:
+            numbers = [line.strip() for line in f if line.strip()]
+    elif provider_name == 'simulated':
+        numbers = [f"+1555{i % args.destinations:07d}" for i in range(args.numbers)]
+    else:
+        parser.error("numbers_file is required unless simulating")
+
+    backoff = args.backoff * (args.time_scale if provider_name == 'simulated' else 1)
+    campaign = Campaign(
+        providers=[(make_provider(provider_name, time_scale=args.time_scale, seed=args.seed), args.concurrency)],
+        numbers=numbers,
+        per_destination=args.per_destination,
+        retry_policy=RetryPolicy(max_attempts=args.max_attempts, backoff=backoff),
+        sink=JsonlSink(args.results) if args.results else None
+    )
+    print(json.dumps(campaign.run(), indent=2))
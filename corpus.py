@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Synthetic IVR corpus generator
+
+Builds IVR trees of a given menu depth and fan-out in explorer.py's nested
+format ({'prompt', 'options': {digit: subtree}}) and derives from each one
+what the pipeline would see for that IVR: the combined transcript, the
+Mermaid flowchart and, optionally, the call audio. The audio is 8 kHz mono
+16-bit PCM: every prompt sentence is a burst of speech-like harmonic
+syllables (seeded by its text, so a sentence always sounds the same, as
+real IVR prompts do) and every key press is a DTMF tone pair, so the VAD,
+DTMF detector and prompt fingerprints handle it like a real recording.
+
+Write a corpus of 20 IVRs with audio:
+
+    python corpus.py corpus/ --count 20 --depth 2 --fanout 3
+
+Audio is 16 KB per second; a depth 3, fan-out 4 IVR is about 12 minutes.
+"""
+
+import os
+import re
+import json
+import wave
+import random
+import hashlib
+import logging
+import argparse
+import numpy as np
+from media_stream import SAMPLE_RATE, DTMF_LOW, DTMF_HIGH, DTMF_KEYS
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+DEPARTMENTS = ['billing', 'technical support', 'sales', 'account services', 'claims', 'orders',
+               'returns', 'appointments', 'pharmacy', 'payments', 'shipping', 'our directory']
+
+COMPANY_NAMES = ['Acme', 'Northwind', 'Contoso', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Vandelay',
+                 'Stark', 'Wayne', 'Tyrell', 'Soylent']
+COMPANY_KINDS = ['Health', 'Bank', 'Telecom', 'Insurance', 'Airlines', 'Energy', 'Pharmacy', 'Retail']
+
+# Pauses in the synthesized audio, in seconds; longer than the VAD's
+# hangover between sentences so each sentence is its own utterance
+SENTENCE_PAUSE = 0.8
+KEY_TONE = 0.15
+KEY_PAUSE = 0.1
+
+# Peak level of speech and of each DTMF frequency (full scale = 1)
+SPEECH_LEVEL = 0.3
+TONE_LEVEL = 0.25
+
+
+def synthetic_tree(depth, fanout, seed=0, company=None):
+    """
+    Build a nested IVR tree ({'prompt', 'options': {digit: subtree}}, see explorer.py)
+
+    Args:
+        depth (int): Menu levels below the greeting
+        fanout (int): Options per menu (digits 1-9, then 0)
+        seed (int): Seed for the departments behind each option
+        company (str): Name used in the greeting, if any
+
+    Returns:
+        dict: The root menu
+    """
+    rng = random.Random(seed)
+    greeting = f"Thank you for calling {company}. " if company else 'Thank you for calling. '
+
+    def menu(level, path):
+        options = {}
+        if level < depth:
+            for index in range(fanout):
+                digit = str((index + 1) % 10)
+                description = rng.choice(DEPARTMENTS)
+                child = menu(level + 1, path + digit)
+                child['description'] = description
+                options[digit] = child
+        if options:
+            choices = ' '.join(f"For {child['description']}, press {digit}." for digit, child in options.items())
+            prompt = f"{greeting if not path else ''}{choices} To repeat this menu, press star."
+        else:
+            prompt = "Please hold while we connect you to the next available representative."
+        return {'prompt': prompt, 'options': options}
+
+    return menu(0, '')
+
+
+def tree_nodes(tree):
+    """Flatten a nested tree into explorer nodes keyed by digit prefix"""
+    nodes = {}
+
+    def walk(node, prefix):
+        nodes[prefix] = {
+            'prefix': prefix,
+            'status': 'menu' if node['options'] else 'leaf',
+            'description': node.get('description', ''),
+            'transcript': node['prompt'],
+            'options': [{'number': d, 'description': c['description']} for d, c in node['options'].items()]
+        }
+        for digit, child in node['options'].items():
+            walk(child, prefix + digit)
+
+    walk(tree, '')
+    return nodes
+
+
+def company_name(index):
+    """A distinct company name for the index-th IVR of a corpus"""
+    name = f"{COMPANY_NAMES[index % len(COMPANY_NAMES)]} {COMPANY_KINDS[index // len(COMPANY_NAMES) % len(COMPANY_KINDS)]}"
+    cycle = index // (len(COMPANY_NAMES) * len(COMPANY_KINDS))
+    return f"{name} {cycle + 1}" if cycle else name
+
+
+def build_ivr(depth, fanout, seed=0, company=None, index=0):
+    """
+    Generate one IVR and the transcript and flowchart the pipeline should produce for it
+
+    Returns:
+        dict: 'id', 'company', 'number', 'depth', 'fanout', 'seed', 'tree',
+            'nodes' (explorer nodes by prefix), 'transcript', 'flowchart'
+    """
+    from explorer import tree_to_mermaid, combined_transcript
+    tree = synthetic_tree(depth, fanout, seed=seed, company=company)
+    nodes = tree_nodes(tree)
+    return {
+        'id': f"ivr-{index:04d}",
+        'company': company,
+        'number': f"+1555{index:07d}",
+        'depth': depth,
+        'fanout': fanout,
+        'seed': seed,
+        'tree': tree,
+        'nodes': nodes,
+        'transcript': combined_transcript(nodes),
+        'flowchart': tree_to_mermaid(nodes)
+    }
+
+
+def generate(count, depth, fanout, seed=0):
+    """Generate count IVRs of the same shape, each with its own company and option mix"""
+    return [
+        build_ivr(depth, fanout, seed=seed + index, company=company_name(index), index=index)
+        for index in range(count)
+    ]
+
+
+def sentences(text):
+    """Split a prompt into the sentences spoken as separate utterances"""
+    return [part for part in re.split(r'(?<=[.!?])\s+', text.strip()) if part]
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float64)
+
+
+def speech(text):
+    """
+    Speech-like audio for a sentence: voiced syllables with moving formants
+
+    The same text always yields the same samples.
+    """
+    rng = np.random.default_rng(int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little'))
+    syllables = max(4, int(len(text.split()) * 1.5))
+    pieces = []
+    for _ in range(syllables):
+        n = int(SAMPLE_RATE * rng.uniform(0.08, 0.16))
+        t = np.arange(n) / SAMPLE_RATE
+        f0 = rng.uniform(100, 200)
+        harmonics = np.arange(1, int(3400 / f0) + 1)
+        formants = rng.uniform((300, 900, 2000), (900, 2200, 3200))
+        weights = 0.05 + sum(np.exp(-((harmonics * f0 - f) / 150) ** 2) for f in formants)
+        phases = rng.uniform(0, 2 * np.pi, len(harmonics))
+        syllable = (weights[:, None] * np.sin(2 * np.pi * f0 * harmonics[:, None] * t + phases[:, None])).sum(axis=0)
+        syllable *= np.sin(np.pi * np.arange(n) / n) / max(np.abs(syllable).max(), 1e-9)
+        pieces.extend([syllable, silence(rng.uniform(0.0, 0.03))])
+    return SPEECH_LEVEL * np.concatenate(pieces)
+
+
+def dtmf(keys):
+    """DTMF tones for a sequence of keys, each followed by a short pause"""
+    t = np.arange(int(KEY_TONE * SAMPLE_RATE)) / SAMPLE_RATE
+    pieces = []
+    for key in keys:
+        row = next(i for i, keys_in_row in enumerate(DTMF_KEYS) if key in keys_in_row)
+        column = DTMF_KEYS[row].index(key)
+        pieces.extend([
+            TONE_LEVEL * (np.sin(2 * np.pi * DTMF_LOW[row] * t) + np.sin(2 * np.pi * DTMF_HIGH[column] * t)),
+            silence(KEY_PAUSE)
+        ])
+    return np.concatenate(pieces) if pieces else silence(0)
+
+
+def to_pcm(samples):
+    """Convert float samples (full scale = 1) to int16 PCM"""
+    return np.clip(np.round(samples * 32767), -32768, 32767).astype(np.int16)
+
+
+def prompt_audio(prompt):
+    """A menu prompt as audio: each sentence followed by a pause"""
+    return np.concatenate([np.concatenate([speech(s), silence(SENTENCE_PAUSE)]) for s in sentences(prompt)])
+
+
+def segment_audio(nodes, prefix):
+    """
+    The recording segment of one menu: the key pressed to reach it, then its prompt
+
+    Returns:
+        np.ndarray: int16 PCM at SAMPLE_RATE
+    """
+    return to_pcm(np.concatenate([silence(SENTENCE_PAUSE), dtmf(prefix[-1:]), silence(SENTENCE_PAUSE),
+                                  prompt_audio(nodes[prefix]['transcript'])]))
+
+
+def ivr_audio(nodes):
+    """
+    Audio of a whole IVR in transcript order (see explorer.combined_transcript):
+    every menu is reached by dialling its full digit prefix
+
+    Returns:
+        np.ndarray: int16 PCM at SAMPLE_RATE
+    """
+    pieces = []
+    for prefix in sorted(nodes, key=lambda p: (len(p), p)):
+        pieces.extend([dtmf(prefix), silence(SENTENCE_PAUSE), prompt_audio(nodes[prefix]['transcript'])])
+    return to_pcm(np.concatenate(pieces))
+
+
+def wav_bytes(pcm):
+    """Encode int16 PCM as a WAV file in memory"""
+    import io
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm.astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def write_corpus(directory, ivrs, audio=True):
+    """
+    Write IVRs to a corpus directory
+
+    Each IVR gets <id>.json (tree and metadata), <id>.txt (transcript),
+    <id>.mmd (flowchart) and, with audio, <id>.wav; manifest.json lists them.
+
+    Returns:
+        str: Path of the manifest
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = []
+    for ivr in ivrs:
+        files = {'tree': f"{ivr['id']}.json", 'transcript': f"{ivr['id']}.txt", 'flowchart': f"{ivr['id']}.mmd"}
+        with open(os.path.join(directory, files['tree']), 'w', encoding='utf-8') as f:
+            json.dump({key: ivr[key] for key in ('id', 'company', 'number', 'depth', 'fanout', 'seed', 'tree')}, f)
+        with open(os.path.join(directory, files['transcript']), 'w', encoding='utf-8') as f:
+            f.write(ivr['transcript'])
+        with open(os.path.join(directory, files['flowchart']), 'w', encoding='utf-8') as f:
+            f.write(ivr['flowchart'])
+        if audio:
+            files['audio'] = f"{ivr['id']}.wav"
+            with open(os.path.join(directory, files['audio']), 'wb') as f:
+                f.write(wav_bytes(ivr_audio(ivr['nodes'])))
+        manifest.append({'id': ivr['id'], 'company': ivr['company'], 'number': ivr['number'],
+                         'nodes': len(ivr['nodes']), 'files': files})
+        logger.info(f"{ivr['id']} ({ivr['company']}): {len(ivr['nodes'])} menus")
+
+    path = os.path.join(directory, 'manifest.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def load_corpus(directory):
+    """
+    Read a corpus written by write_corpus()
+
+    Returns:
+        list: IVRs as returned by build_ivr(), plus 'audio_path' (None without audio)
+    """
+    with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    ivrs = []
+    for entry in manifest:
+        with open(os.path.join(directory, entry['files']['tree']), encoding='utf-8') as f:
+            ivr = json.load(f)
+        ivr['nodes'] = tree_nodes(ivr['tree'])
+        for key in ('transcript', 'flowchart'):
+            with open(os.path.join(directory, entry['files'][key]), encoding='utf-8') as f:
+                ivr[key] = f.read()
+        audio = entry['files'].get('audio')
+        ivr['audio_path'] = os.path.join(directory, audio) if audio else None
+        ivrs.append(ivr)
+    return ivrs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic IVR corpus")
+    parser.add_argument('directory', help="Output directory")
+    parser.add_argument('--count', type=int, default=10, help="IVRs to generate")
+    parser.add_argument('--depth', type=int, default=2, help="Menu levels below the greeting")
+    parser.add_argument('--fanout', type=int, default=3, help="Options per menu (at most 10)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-audio', action='store_true', help="Skip the WAV files")
+    args = parser.parse_args()
+    if not 1 <= args.fanout <= 10:
+        parser.error("--fanout must be between 1 and 10")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    manifest = write_corpus(args.directory, generate(args.count, args.depth, args.fanout, args.seed),
+                            audio=not args.no_audio)
+    print(f"Wrote {args.count} IVRs to {args.directory} ({manifest})")
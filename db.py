@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import logging
+from dotenv import load_dotenv
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Load environment variables for command-line tools (app.py loads them for the server)
+load_dotenv()
+
+def default_database_path():
+    """Return the SQLite database path shared by all workers on this host"""
+    if os.getenv('DATABASE_PATH'):
+        return os.getenv('DATABASE_PATH')
+    # Render free tier has no persistent disk, so keep the database in the temp directory
+    if os.getenv('RENDER', 'False').lower() == 'true':
+        return os.path.join(tempfile.gettempdir(), 'echomap.db')
+    return os.path.join('instance', 'echomap.db')
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_initialized_schemas = set()
+
+def connect(path=None):
+    """
+    Return a SQLite connection for the current thread and process
+
+    Connections are cached per thread and re-opened after a fork, so the
+    same database can be shared safely by gunicorn workers and their threads.
+    The connection runs in autocommit mode; use transaction() for atomic
+    read-modify-write sequences.
+
+    Args:
+        path (str): Database file path (defaults to default_database_path())
+
+    Returns:
+        sqlite3.Connection: A connection with WAL journaling enabled
+    """
+    path = path or default_database_path()
+    pid = os.getpid()
+    connections = getattr(_local, 'connections', None)
+    if connections is None or getattr(_local, 'pid', None) != pid:
+        connections = _local.connections = {}
+        _local.pid = pid
+
+    conn = connections.get(path)
+    if conn is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        connections[path] = conn
+        logger.debug(f"Opened SQLite connection to {path} (pid {pid})")
+    return conn
+
+def ensure_schema(path, name, statements):
+    """
+    Run a module's CREATE statements once per process and database
+
+    Args:
+        path (str): Database file path
+        name (str): Unique schema name, e.g. 'call_store'
+        statements (list): SQL statements to execute (must be idempotent)
+    """
+    path = path or default_database_path()
+    key = (os.getpid(), path, name)
+    if key in _initialized_schemas:
+        return
+    with _schema_lock:
+        if key in _initialized_schemas:
+            return
+        conn = connect(path)
+        for statement in statements:
+            conn.execute(statement)
+        _initialized_schemas.add(key)
+
+class transaction:
+    """Context manager running a block in a write transaction (BEGIN IMMEDIATE)"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
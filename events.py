@@ -0,0 +1,165 @@
+import os
+import json
+import logging
+import threading
+import time
+import db
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# How long events are kept so reconnecting clients can catch up (seconds)
+EVENT_TTL = int(os.getenv('EVENT_TTL', 60 * 60))
+
+# How often a waiting stream checks the database for events published by other workers
+POLL_INTERVAL = 0.5
+
+# Event types that end a stream (the page has nothing left to wait for)
+TERMINAL_EVENTS = {'analysis', 'error'}
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        channel TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        event TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (channel, id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at)",
+]
+
+
+class EventBroker:
+    """
+    Publish/subscribe broker for progress events.
+
+    Events are grouped into channels (a Twilio CallSid, a VOXO call id or an
+    upload id) and numbered per channel so that a client can resume a stream
+    with the Last-Event-ID header after reconnecting. Events are stored in the
+    shared SQLite database, so a Twilio callback handled by one gunicorn
+    worker reaches a stream served by another; subscribers in the publishing
+    process are woken immediately, others within POLL_INTERVAL.
+    """
+
+    def __init__(self, path=None, ttl=EVENT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._condition = threading.Condition()
+        self._last_purge = 0
+
+    def _conn(self):
+        db.ensure_schema(self.path, 'events', SCHEMA)
+        return db.connect(self.path)
+
+    def publish(self, channel, event, data=None):
+        """
+        Publish an event to a channel and wake up any waiting subscribers
+
+        Args:
+            channel (str): Channel name (CallSid or upload id)
+            event (str): Event type, e.g. 'status', 'stage', 'analysis'
+            data (dict): JSON-serialisable payload
+
+        Returns:
+            int: The id assigned to the event
+        """
+        if not channel:
+            return None
+
+        conn = self._conn()
+        with db.transaction(conn):
+            event_id = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM events WHERE channel = ?", (channel,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO events (channel, id, event, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                (channel, event_id, event, json.dumps(data or {}), time.time())
+            )
+
+        with self._condition:
+            self._condition.notify_all()
+
+        self._maybe_purge()
+        logger.debug(f"Published {event} event {event_id} on channel {channel}")
+        return event_id
+
+    def events_since(self, channel, last_id=0):
+        """Return the events on a channel with an id greater than last_id"""
+        rows = self._conn().execute(
+            "SELECT id, event, data, created_at FROM events WHERE channel = ? AND id > ? ORDER BY id",
+            (channel, last_id)
+        ).fetchall()
+        return [{
+            'id': row['id'],
+            'event': row['event'],
+            'data': json.loads(row['data']),
+            'timestamp': row['created_at']
+        } for row in rows]
+
+    def wait(self, channel, last_id=0, timeout=15):
+        """
+        Block until a channel has events newer than last_id or the timeout expires
+
+        Returns:
+            list: The new events (empty on timeout)
+        """
+        deadline = time.time() + timeout
+        while True:
+            events = self.events_since(channel, last_id)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return events
+            with self._condition:
+                self._condition.wait(min(POLL_INTERVAL, remaining))
+
+    def _maybe_purge(self):
+        """Delete expired events at most once a minute in this process"""
+        if time.time() - self._last_purge > 60:
+            self._last_purge = time.time()
+            self._conn().execute("DELETE FROM events WHERE created_at <= ?", (time.time() - self.ttl,))
+
+
+def format_sse(event):
+    """Format an event dict as a Server-Sent Events message"""
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def stream(broker, channel, last_id=0, max_duration=300, keepalive=15):
+    """
+    Generate Server-Sent Events for a channel
+
+    The stream ends after a terminal event ('analysis' or 'error') or after
+    max_duration seconds, at which point the browser's EventSource reconnects
+    and resumes from the last event id it received.
+
+    Args:
+        broker (EventBroker): Broker to read events from
+        channel (str): Channel name
+        last_id (int): Id of the last event the client has already seen
+        max_duration (int): Maximum lifetime of a single stream in seconds
+        keepalive (int): Seconds between keep-alive comments on an idle stream
+
+    Yields:
+        str: SSE formatted messages
+    """
+    # Ask the browser to reconnect quickly once a stream is closed
+    yield "retry: 2000\n\n"
+
+    deadline = time.time() + max_duration
+    while time.time() < deadline:
+        events = broker.wait(channel, last_id, timeout=min(keepalive, max(0, deadline - time.time())))
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+        for event in events:
+            last_id = event['id']
+            yield format_sse(event)
+            if event['event'] in TERMINAL_EVENTS:
+                return
+
+
+# Shared broker for this process
+broker = EventBroker()
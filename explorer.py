@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Automated DTMF tree exploration
+
+Maps an IVR by calling it repeatedly: each call navigates to one menu with
+Twilio sendDigits, the recording is transcribed and analysed as usual, and
+the menu options IVRAnalytics finds in the transcript become the next
+prefixes to explore. Every prefix is dialled at most once - explored
+prefixes are memoized in the shared database, so later crawls of the same
+number only pay for menus that have not been seen - and independent
+branches are dialled in parallel through a Campaign.
+
+Run against a simulated IVR:
+
+    python explorer.py --simulate --max-parallel 4
+"""
+
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+import db
+from analytics import IVRAnalytics
+from analytics_cache import analytics_cache
+from analysis_store import analysis_store
+from campaign import Campaign, RetryPolicy, SimulatedProvider, make_provider
+from admission import admission, CALL_COST
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Pause before each digit so the menu prompt can play ('w' is half a second)
+DEFAULT_PROMPT_WAIT = 'w' * 10
+
+# Options that lead to people, emergencies or navigation rather than new menus
+SKIP_PATTERN = re.compile(
+    r'\b(representative|agent|operator|associate|emergency|911|repeat|previous menu|main menu|hang up)\b',
+    re.IGNORECASE
+)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS ivr_tree_nodes (
+        number TEXT NOT NULL,
+        prefix TEXT NOT NULL,
+        status TEXT NOT NULL,
+        description TEXT,
+        transcript TEXT,
+        options TEXT NOT NULL DEFAULT '[]',
+        call_id TEXT,
+        analysis_id INTEGER,
+        explored_at REAL NOT NULL,
+        PRIMARY KEY (number, prefix)
+    )
+    """,
+]
+
+
+def menu_options_from_transcript(transcript):
+    """
+    Return the options of the last menu heard in a transcript
+
+    A call that navigated with sendDigits hears the menus on its path in
+    order, so the last one found by IVRAnalytics.analyze_menu_options is the
+    menu at the dialled prefix.
+
+    Returns:
+        list: [{'number': digit, 'description': text}, ...]
+    """
+    menus = IVRAnalytics(transcript, '').get_metrics()['menu_options']['menu_structure']
+    if not menus:
+        return []
+    # Only single keys can be pressed; multi-digit matches are times, amounts, etc.
+    return [option for option in menus[-1]['options'] if len(option['number']) == 1]
+
+
+def digits_to_send(prefix, prompt_wait=DEFAULT_PROMPT_WAIT):
+    """Build a Twilio sendDigits string that waits for each prompt before pressing a key"""
+    return ''.join(prompt_wait + digit for digit in prefix)
+
+
+def _same_menu(a, b):
+    return [(o['number'], o['description']) for o in a] == [(o['number'], o['description']) for o in b]
+
+
+class IVRExplorer:
+    """Breadth-first, parallel exploration of one number's DTMF tree"""
+
+    def __init__(self, number, provider, max_depth=4, max_parallel=2, prompt_wait=DEFAULT_PROMPT_WAIT,
+                 skip_pattern=SKIP_PATTERN, refresh=False, retry_policy=None, path=None, client=None):
+        """
+        Args:
+            number (str): The IVR number to map
+            provider: Telephony provider (see campaign.py); must support send_digits
+            max_depth (int): Deepest prefix length to dial
+            max_parallel (int): Simultaneous calls to the number
+            prompt_wait (str): sendDigits pause before each key
+            skip_pattern (re.Pattern): Option descriptions that are not explored
+            refresh (bool): Ignore memoized prefixes and dial everything again
+            retry_policy (RetryPolicy): Retries for failed calls
+            path (str): Database path for the prefix memo
+            client (str): Charge every call after the first to this client's
+                admission bucket (see admission.py)
+        """
+        self.number = number
+        self.provider = provider
+        self.max_depth = max_depth
+        self.max_parallel = max_parallel
+        self.prompt_wait = prompt_wait
+        self.skip_pattern = skip_pattern
+        self.refresh = refresh
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=2, backoff=30)
+        self.path = path
+        self.client = client
+
+        self.nodes = {}
+        self.calls_made = 0
+        self.memo_hits = 0
+        self._memo = {}
+        self._pending = set()
+        self._lock = threading.RLock()
+        self._campaign = None
+
+    def run(self):
+        """
+        Explore the tree and return it
+
+        Returns:
+            dict: 'number', 'nodes' (by prefix), 'calls_made', 'memo_hits',
+                'flowchart' and 'analysis_id'
+        """
+        started = time.time()
+        if not self.refresh:
+            self._memo = load_nodes(self.number, self.path)
+
+        self._campaign = Campaign(
+            providers=[(self.provider, self.max_parallel)],
+            per_destination=self.max_parallel,
+            retry_policy=self.retry_policy,
+            on_result=self._on_result
+        )
+        with self._lock:
+            self._visit('', None)
+            if not self._pending:
+                self._campaign.close()
+        self._campaign.run()
+
+        flowchart = tree_to_mermaid(self.nodes)
+        analysis_id = None
+        transcript = combined_transcript(self.nodes)
+        if transcript and not self.calls_made:
+            # Every node came from the memo: the tree is the one the last exploration analysed
+            previous = analysis_store.query(phone_number=self.number, source='explorer', per_page=1)['items']
+            previous = analysis_store.get(previous[0]['id']) if previous else None
+            if previous and previous['transcript'] == transcript and previous['flowchart'] == flowchart:
+                analysis_id = previous['id']
+        if transcript and analysis_id is None:
+            result = analytics_cache.analyze(transcript, flowchart)
+            analysis_id = analysis_store.save(
+                transcript, flowchart, result['metrics'], result['summary'], result['visualization_data'],
+                source='explorer', phone_number=self.number
+            )
+
+        logger.info(
+            f"Explored {self.number}: {len(self.nodes)} node(s), {self.calls_made} call(s), "
+            f"{self.memo_hits} memoized prefix(es) in {time.time() - started:.1f}s"
+        )
+        return {
+            'number': self.number,
+            'nodes': self.nodes,
+            'calls_made': self.calls_made,
+            'memo_hits': self.memo_hits,
+            'flowchart': flowchart,
+            'analysis_id': analysis_id
+        }
+
+    def _visit(self, prefix, description):
+        """Reuse a memoized prefix or queue a call for it (caller holds the lock)"""
+        if prefix in self.nodes or prefix in self._pending:
+            return
+        memo = self._memo.get(prefix)
+        if memo is not None and memo['status'] != 'failed':
+            self.memo_hits += 1
+            self.nodes[prefix] = memo
+            self._expand(memo)
+            return
+        self._pending.add(prefix)
+        if self.client and self.calls_made:
+            admission.charge(self.client, CALL_COST)
+        self.calls_made += 1
+        self._campaign.submit(
+            self.number,
+            send_digits=digits_to_send(prefix, self.prompt_wait) or None,
+            prefix=prefix,
+            description=description
+        )
+
+    def _expand(self, node):
+        """Visit the children of a menu node (caller holds the lock)"""
+        if node['status'] != 'menu' or len(node['prefix']) >= self.max_depth:
+            return
+        for option in node['options']:
+            child = node['prefix'] + option['number']
+            if self.skip_pattern and self.skip_pattern.search(option['description']):
+                if child not in self.nodes:
+                    self.nodes[child] = self._node(child, 'skipped', option['description'])
+                continue
+            self._visit(child, option['description'])
+
+    def _on_result(self, result):
+        """Record a finished call and queue the menus it revealed"""
+        prefix = result['prefix']
+        with self._lock:
+            try:
+                if result['status'] != 'analyzed':
+                    node = self._node(prefix, 'failed', result.get('description'), call_id=result.get('call_id'))
+                else:
+                    transcript = result.get('transcript')
+                    if transcript is None and result.get('analysis_id'):
+                        transcript = (analysis_store.get(result['analysis_id']) or {}).get('transcript', '')
+                    options = menu_options_from_transcript(transcript or '')
+                    parent = self.nodes.get(prefix[:-1]) if prefix else None
+                    # The same menu again means the key did not lead anywhere new
+                    is_menu = bool(options) and not (parent and _same_menu(parent['options'], options))
+                    node = self._node(
+                        prefix, 'menu' if is_menu else 'leaf', result.get('description'),
+                        transcript=transcript, options=options if is_menu else [],
+                        call_id=result.get('call_id'), analysis_id=result.get('analysis_id')
+                    )
+                    save_node(self.number, node, self.path)
+                self.nodes[prefix] = node
+                self._expand(node)
+            finally:
+                self._pending.discard(prefix)
+                if not self._pending:
+                    self._campaign.close()
+
+    def _node(self, prefix, status, description, transcript=None, options=None, call_id=None, analysis_id=None):
+        return {
+            'prefix': prefix,
+            'status': status,
+            'description': description,
+            'transcript': transcript,
+            'options': options or [],
+            'call_id': call_id,
+            'analysis_id': analysis_id,
+            'explored_at': time.time()
+        }
+
+
+def load_nodes(number, path=None):
+    """Return the memoized nodes of a number's tree, keyed by prefix"""
+    db.ensure_schema(path, 'explorer', SCHEMA)
+    rows = db.connect(path).execute("SELECT * FROM ivr_tree_nodes WHERE number = ?", (number,)).fetchall()
+    nodes = {}
+    for row in rows:
+        node = dict(row)
+        node.pop('number')
+        node['options'] = json.loads(node['options'])
+        nodes[node['prefix']] = node
+    return nodes
+
+
+def save_node(number, node, path=None):
+    """Memoize an explored prefix"""
+    db.ensure_schema(path, 'explorer', SCHEMA)
+    db.connect(path).execute(
+        """
+        INSERT OR REPLACE INTO ivr_tree_nodes
+            (number, prefix, status, description, transcript, options, call_id, analysis_id, explored_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (number, node['prefix'], node['status'], node['description'], node['transcript'],
+         json.dumps(node['options']), node['call_id'], node['analysis_id'], node['explored_at'])
+    )
+
+
+def tree_to_mermaid(nodes):
+    """Render explored nodes as a Mermaid flowchart"""
+    def node_id(prefix):
+        return 'N' + (prefix.replace('*', 'S').replace('#', 'H') or 'root')
+
+    def label(text):
+        return (text or '').replace('"', "'").replace('[', '(').replace(']', ')')
+
+    lines = ['flowchart TD']
+    for prefix in sorted(nodes, key=lambda p: (len(p), p)):
+        node = nodes[prefix]
+        if prefix == '':
+            lines.append(f'    {node_id(prefix)}["Start"]')
+            continue
+        text = f"{prefix[-1]}: {label(node['description'])}"
+        if node['status'] != 'menu':
+            text += f" ({node['status']})"
+        lines.append(f'    {node_id(prefix)}["{text}"]')
+        lines.append(f'    {node_id(prefix[:-1])}-->{node_id(prefix)}')
+    return '\n'.join(lines)
+
+
+def combined_transcript(nodes):
+    """Join the transcripts of explored nodes in tree order, marking the keys pressed"""
+    parts = []
+    for prefix in sorted(nodes, key=lambda p: (len(p), p)):
+        transcript = nodes[prefix].get('transcript')
+        if transcript:
+            marker = f"[Pressed {' '.join(prefix)}]" if prefix else '[Start]'
+            parts.append(f"{marker} {transcript}")
+    return '\n'.join(parts)
+
+
+class SimulatedIVRProvider(SimulatedProvider):
+    """
+    Simulated provider that answers with an IVR tree instead of dialling.
+
+    The tree is a nested dict: {'prompt': str, 'options': {digit: subtree}},
+    where each subtree also carries a 'description'. A call's transcript is
+    the prompt of every menu on the path its sendDigits navigate.
+    """
+
+    def __init__(self, tree, call_duration=(20, 60), time_scale=1.0, seed=None, outcome_weights=None):
+        super().__init__(
+            call_duration=call_duration, outcome_weights=outcome_weights or {'analyzed': 1.0},
+            time_scale=time_scale, seed=seed
+        )
+        self.tree = tree
+        self.calls = 0
+        self._dialled = {}
+
+    def dial(self, number, send_digits=None):
+        call_id = super().dial(number, send_digits)
+        with self._lock:
+            self.calls += 1
+            self._dialled[call_id] = ''.join(c for c in (send_digits or '') if c in '0123456789*#')
+        return call_id
+
+    def wait(self, call_id):
+        outcome = super().wait(call_id)
+        with self._lock:
+            digits = self._dialled.pop(call_id, '')
+        if outcome['status'] == 'analyzed':
+            outcome['transcript'] = self.transcript_for(digits)
+        return outcome
+
+    def transcript_for(self, digits):
+        node = self.tree
+        parts = [node['prompt']]
+        for digit in digits:
+            child = node.get('options', {}).get(digit)
+            if child is None:
+                parts.append("Sorry, that is not a valid option.")
+                parts.append(node['prompt'])
+                break
+            node = child
+            parts.append(node['prompt'])
+        return ' '.join(parts)
+
+
+SAMPLE_TREE = {
+    'prompt': "Thank you for calling Acme. Press 1 for billing. Press 2 for technical support. Press 0 to speak to a representative.",
+    'options': {
+        '1': {
+            'description': 'billing',
+            'prompt': "You have reached billing. Press 1 to make a payment. Press 2 for your balance.",
+            'options': {
+                '1': {'description': 'make a payment', 'prompt': "Please enter your account number followed by the pound key."},
+                '2': {'description': 'your balance', 'prompt': "Your balance is available online. Goodbye."},
+            }
+        },
+        '2': {
+            'description': 'technical support',
+            'prompt': "Technical support. Press 1 for internet. Press 2 for television. Press 9 to repeat this menu.",
+            'options': {
+                '1': {'description': 'internet', 'prompt': "Please hold while we connect you to internet support."},
+                '2': {'description': 'television', 'prompt': "Please hold while we connect you to television support."},
+            }
+        },
+        '0': {'description': 'speak to a representative', 'prompt': "Please hold for the next representative."},
+    }
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map an IVR's DTMF tree automatically")
+    parser.add_argument('number', nargs='?', default='+15550000000')
+    parser.add_argument('--provider', default='twilio', choices=['twilio', 'simulated'])
+    parser.add_argument('--simulate', action='store_true', help="Explore the built-in sample tree offline")
+    parser.add_argument('--tree', help="JSON file with an IVR tree to simulate")
+    parser.add_argument('--max-depth', type=int, default=4)
+    parser.add_argument('--max-parallel', type=int, default=2)
+    parser.add_argument('--time-scale', type=float, default=0.01, help="Simulated time multiplier")
+    parser.add_argument('--refresh', action='store_true', help="Ignore memoized prefixes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.simulate or args.tree or args.provider == 'simulated':
+        tree = SAMPLE_TREE
+        if args.tree:
+            with open(args.tree) as f:
+                tree = json.load(f)
+        provider = SimulatedIVRProvider(tree, time_scale=args.time_scale)
+    else:
+        provider = make_provider(args.provider)
+
+    explorer = IVRExplorer(
+        args.number, provider, max_depth=args.max_depth, max_parallel=args.max_parallel, refresh=args.refresh
+    )
+    result = explorer.run()
+    print(result['flowchart'])
+    print(json.dumps({k: result[k] for k in ('calls_made', 'memo_hits', 'analysis_id')}, indent=2))
@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from transcriber import transcribe_audio
+from metrics import upstream_errors, retries
+from tracing import span, annotate
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Recordings downloaded at the same time by this process
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 4))
+
+# Bytes read from the network and written to disk per chunk
+FETCH_CHUNK_SIZE = 64 * 1024
+
+# Times an interrupted download is resumed with a Range request before giving up
+FETCH_MAX_RESUMES = int(os.getenv('FETCH_MAX_RESUMES', 3))
+
+# (connect, read) timeouts in seconds; the read timeout applies per chunk
+FETCH_TIMEOUT = (5, 30)
+
+# Largest recording the Whisper API accepts
+MAX_RECORDING_BYTES = 25 * 1024 * 1024
+
+_session = None
+_session_pid = None
+_slots = threading.BoundedSemaphore(FETCH_CONCURRENCY)
+
+
+def get_session():
+    """Return this process's pooled requests session for recording downloads"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        # Retries cover failures before the body starts; broken bodies are resumed below
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_CONCURRENCY * 2, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def _total_size(response, offset):
+    """Full size of the resource from Content-Range or Content-Length, if known"""
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    if response.headers.get('Content-Length'):
+        return offset + int(response.headers['Content-Length'])
+    return None
+
+
+def fetch_recording(url, path, auth=None, max_bytes=MAX_RECORDING_BYTES):
+    """
+    Stream a recording to a file in chunks
+
+    At most FETCH_CONCURRENCY downloads run at once per process. If the
+    connection drops mid-body, the download resumes from the last byte
+    written with a Range request; servers that ignore Range are re-read from
+    the start. Memory use is one chunk regardless of the recording's size.
+
+    Args:
+        url (str): Recording URL
+        path (str): Destination file
+        auth (tuple): Optional (user, password) for HTTP basic auth
+        max_bytes (int): Abort downloads larger than this
+
+    Returns:
+        int: Bytes written
+
+    Raises:
+        ValueError: If the recording is larger than max_bytes
+        requests.RequestException: If the download fails after FETCH_MAX_RESUMES resumes
+    """
+    session = get_session()
+    started = time.time()
+    with span('recording.fetch', kind=3), _slots, open(path, 'wb') as f:
+        written = 0
+        total = None
+        resumes = 0
+        while True:
+            headers = {'Range': f'bytes={written}-'} if written else {}
+            try:
+                with session.get(url, headers=headers, auth=auth, stream=True, timeout=FETCH_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if written and response.status_code != 206:
+                        logger.info(f"Server ignored Range for {url}, downloading from the start")
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+                    total = total or _total_size(response, written)
+                    if total and total > max_bytes:
+                        raise ValueError(f"Recording too large: {total / (1024 * 1024):.2f}MB (max {max_bytes // (1024 * 1024)}MB)")
+                    for chunk in response.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+                        f.write(chunk)
+                        written += len(chunk)
+                        if written > max_bytes:
+                            raise ValueError(f"Recording too large (max {max_bytes // (1024 * 1024)}MB)")
+                if total is None or written >= total:
+                    break
+                raise requests.ConnectionError(f"Connection closed after {written} of {total} bytes")
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                resumes += 1
+                if resumes > FETCH_MAX_RESUMES:
+                    upstream_errors.inc(service='recordings')
+                    logger.error(f"Giving up on {url} after {resumes - 1} resume(s): {str(e)}")
+                    raise
+                retries.inc(operation='recording_download')
+                logger.warning(f"Download of {url} interrupted at {written} bytes, resuming: {str(e)}")
+                time.sleep(0.5 * resumes)
+
+    annotate(bytes=written, resumes=resumes)
+    logger.info(f"Fetched {written} bytes from {url} in {time.time() - started:.2f}s ({resumes} resume(s))")
+    return written
+
+
+def fetch_and_transcribe(url, auth=None, suffix=None):
+    """
+    Download a recording to a temporary file and transcribe it with Whisper
+
+    Args:
+        url (str): Recording URL
+        auth (tuple): Optional (user, password) for HTTP basic auth
+        suffix (str): File extension Whisper uses to detect the format;
+            taken from the URL when not given
+
+    Returns:
+        str: The transcribed text
+    """
+    if suffix is None:
+        suffix = os.path.splitext(urlparse(url).path)[1] or '.mp3'
+    fd, path = tempfile.mkstemp(prefix='recording-', suffix=suffix)
+    os.close(fd)
+    try:
+        fetch_recording(url, path, auth=auth)
+        return transcribe_audio(path)
+    finally:
+        os.remove(path)
@@ -0,0 +1,247 @@
+import os
+import time
+import logging
+import numpy as np
+import db
+from media_stream import SAMPLE_RATE
+from metrics import cache_hits, cache_misses
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Maximum fraction of differing fingerprint bits for two prompts to be the same audio
+FINGERPRINT_MAX_BER = float(os.getenv('FINGERPRINT_MAX_BER', 0.3))
+
+# Shorter utterances are too ambiguous to match and are always transcribed
+FINGERPRINT_MIN_SECONDS = 0.5
+
+# Spectrogram frame and hop (64 ms frames, 8 ms apart at 8 kHz)
+FRAME_SIZE = 512
+HOP_SIZE = 64
+
+# Telephone band split into 12 bands wider than voice harmonic spacing; 11 bits per frame
+BAND_EDGES = np.linspace(300, 3400, 13)
+
+# Frames a repeated prompt may be shifted by and still match (VAD boundaries differ by ~250 ms)
+MAX_OFFSET = 32
+
+# Index keys pair each frame's code with the code this many frames later
+KEY_SPAN = 4
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS prompt_fingerprints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        duration REAL NOT NULL,
+        codes BLOB NOT NULL,
+        transcript TEXT NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        last_hit_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_prompt_fingerprints_duration ON prompt_fingerprints (duration)",
+    """
+    CREATE TABLE IF NOT EXISTS prompt_fingerprint_codes (
+        key INTEGER NOT NULL,
+        prompt_id INTEGER NOT NULL,
+        PRIMARY KEY (key, prompt_id)
+    ) WITHOUT ROWID
+    """,
+]
+
+
+def _band_matrix():
+    """Map rFFT bins to BAND_EDGES bands"""
+    freqs = np.fft.rfftfreq(FRAME_SIZE, 1 / SAMPLE_RATE)
+    bands = np.zeros((len(freqs), len(BAND_EDGES) - 1))
+    for band, (low, high) in enumerate(zip(BAND_EDGES[:-1], BAND_EDGES[1:])):
+        bands[(freqs >= low) & (freqs < high), band] = 1.0
+    return bands
+
+
+_BANDS = _band_matrix()
+_WINDOW = np.hanning(FRAME_SIZE)
+_BIT_WEIGHTS = 1 << np.arange(len(BAND_EDGES) - 2)
+
+
+def spectral_fingerprint(pcm):
+    """
+    Compute a binary spectral fingerprint of 8 kHz PCM
+
+    Each 8 ms step yields an 11-bit code: whether the log-energy difference
+    between each pair of adjacent bands is above its median over the
+    utterance. The code depends on the shape of the spectrum rather than its
+    level, and the median removes the channel's spectral tilt, so it
+    survives the codec noise, gain and line differences between two
+    recordings of the same prompt.
+
+    Returns:
+        np.ndarray: uint16 codes, one per frame
+    """
+    x = pcm.astype(np.float64) / 32768.0
+    if len(x) < FRAME_SIZE + 2 * HOP_SIZE:
+        return np.zeros(0, dtype=np.uint16)
+    frames = np.lib.stride_tricks.sliding_window_view(x, FRAME_SIZE)[::HOP_SIZE] * _WINDOW
+    energies = np.log((np.abs(np.fft.rfft(frames, axis=1)) ** 2) @ _BANDS + 1e-10)
+    band_diff = energies[:, :-1] - energies[:, 1:]
+    bits = band_diff > np.median(band_diff, axis=0)
+    return (bits @ _BIT_WEIGHTS).astype(np.uint16)
+
+
+def index_keys(fingerprint):
+    """
+    Distinct lookup keys of a fingerprint
+
+    Single 11-bit codes are shared by almost every prompt; pairing each code
+    with the one KEY_SPAN frames later gives 22-bit keys that few unrelated
+    prompts have in common.
+    """
+    codes = fingerprint.astype(np.int64)
+    return sorted(set(((codes[:-KEY_SPAN] << 11) | codes[KEY_SPAN:]).tolist()))
+
+
+def bit_error_rate(a, b, max_offset=MAX_OFFSET):
+    """Smallest fraction of differing bits between two fingerprints over small alignments"""
+    bits = len(BAND_EDGES) - 2
+    best = 1.0
+    for offset in range(-max_offset, max_offset + 1):
+        x = a[max(offset, 0):]
+        y = b[max(-offset, 0):]
+        n = min(len(x), len(y))
+        if n < 0.8 * min(len(a), len(b)) or n == 0:
+            continue
+        diff = np.bitwise_xor(x[:n], y[:n])
+        errors = np.unpackbits(diff.view(np.uint8)).sum()
+        best = min(best, errors / (n * bits))
+    return best
+
+
+class PromptIndex:
+    """
+    Fingerprint index of transcribed prompts.
+
+    IVRs replay the same greeting and menu audio on every call, and stock
+    prompts recur across customers on the same platform. Each transcribed
+    utterance is stored with its fingerprint; a later utterance whose
+    fingerprint is within max_ber of a stored one reuses its transcript
+    instead of going to Whisper. Candidates are found through an inverted
+    index of paired frame codes and confirmed by bit error rate.
+    """
+
+    def __init__(self, path=None, max_ber=FINGERPRINT_MAX_BER, min_seconds=FINGERPRINT_MIN_SECONDS):
+        self.path = path
+        self.max_ber = max_ber
+        self.min_seconds = min_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def _conn(self):
+        db.ensure_schema(self.path, 'fingerprints', SCHEMA)
+        return db.connect(self.path)
+
+    def lookup(self, fingerprint, duration, candidates=5):
+        """
+        Find a stored prompt matching a fingerprint
+
+        Args:
+            fingerprint (np.ndarray): Codes from spectral_fingerprint()
+            duration (float): Utterance length in seconds
+            candidates (int): Stored prompts verified by bit error rate
+
+        Returns:
+            dict: The matching prompt ('id', 'transcript', 'ber'), or None
+        """
+        keys = index_keys(fingerprint)
+        if not keys:
+            return None
+        placeholders = ','.join('?' * len(keys))
+        rows = self._conn().execute(
+            f"""
+            SELECT p.id, p.codes, p.transcript, COUNT(*) AS shared
+            FROM prompt_fingerprint_codes c
+            JOIN prompt_fingerprints p ON p.id = c.prompt_id
+            WHERE c.key IN ({placeholders}) AND p.duration BETWEEN ? AND ?
+            GROUP BY p.id
+            ORDER BY shared DESC
+            LIMIT ?
+            """,
+            (*keys, duration * 0.85, duration / 0.85, candidates)
+        ).fetchall()
+
+        best = None
+        for row in rows:
+            ber = bit_error_rate(fingerprint, np.frombuffer(row['codes'], dtype='<u2'))
+            if ber <= self.max_ber and (best is None or ber < best['ber']):
+                best = {'id': row['id'], 'transcript': row['transcript'], 'ber': ber}
+        return best
+
+    def add(self, fingerprint, duration, transcript):
+        """Store a transcribed prompt and return its id"""
+        conn = self._conn()
+        with db.transaction(conn):
+            cursor = conn.execute(
+                "INSERT INTO prompt_fingerprints (duration, codes, transcript, created_at) VALUES (?, ?, ?, ?)",
+                (duration, fingerprint.astype('<u2').tobytes(), transcript, time.time())
+            )
+            prompt_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO prompt_fingerprint_codes (key, prompt_id) VALUES (?, ?)",
+                [(key, prompt_id) for key in index_keys(fingerprint)]
+            )
+        return prompt_id
+
+    def known(self, pcm):
+        """
+        The stored transcript of an utterance that is a known prompt
+
+        Args:
+            pcm (np.ndarray): 8 kHz int16 utterance
+
+        Returns:
+            str: The prompt's transcript, or None if it has to be transcribed
+        """
+        duration = len(pcm) / SAMPLE_RATE
+        if duration < self.min_seconds:
+            return None
+
+        match = self.lookup(spectral_fingerprint(pcm), duration)
+        if match is None:
+            self.misses += 1
+            cache_misses.inc(cache='prompt')
+            return None
+        self.hits += 1
+        cache_hits.inc(cache='prompt')
+        self._conn().execute(
+            "UPDATE prompt_fingerprints SET hits = hits + 1, last_hit_at = ? WHERE id = ?",
+            (time.time(), match['id'])
+        )
+        logger.info(f"Known prompt {match['id']} (BER {match['ber']:.2f}), skipping transcription")
+        return match['transcript']
+
+    def learn(self, pcm, transcript):
+        """Store the transcript of an utterance that was not known (if it is long enough to match)"""
+        duration = len(pcm) / SAMPLE_RATE
+        if duration >= self.min_seconds:
+            self.add(spectral_fingerprint(pcm), duration, transcript)
+
+    def transcribe(self, pcm, transcribe):
+        """
+        Transcribe an utterance unless it is a known prompt
+
+        Args:
+            pcm (np.ndarray): 8 kHz int16 utterance
+            transcribe (callable): Transcribes PCM that is not in the index
+
+        Returns:
+            str: The transcript
+        """
+        transcript = self.known(pcm)
+        if transcript is None:
+            transcript = transcribe(pcm)
+            self.learn(pcm, transcript)
+        return transcript
+
+
+# Shared index for this process
+prompt_index = PromptIndex()
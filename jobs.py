@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import db
+import profiling
+from tracing import span
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Number of background threads per worker process
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+
+# How long a webhook delivery key is remembered (Twilio retries within minutes)
+DEDUPE_TTL = int(os.getenv('WEBHOOK_DEDUPE_TTL', 24 * 60 * 60))
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS webhook_deliveries (
+        key TEXT PRIMARY KEY,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_expires_at ON webhook_deliveries (expires_at)",
+]
+
+_executor = None
+_executor_pid = None
+_last_purge = 0
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """Create the background executor lazily (and again after a gunicorn fork)"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='echomap-job')
+            _executor_pid = os.getpid()
+        return _executor
+
+def claim(key, path=None, ttl=DEDUPE_TTL):
+    """
+    Claim a webhook delivery key so it is processed at most once
+
+    The claim is recorded in the shared SQLite database, so a retry that
+    lands on a different gunicorn worker sees it too.
+
+    Args:
+        key (str): Delivery key, e.g. 'twilio-transcription:<RecordingSid>'
+        path (str): Database path (defaults to db.default_database_path())
+        ttl (int): Seconds before the key may be processed again
+
+    Returns:
+        bool: True if this caller claimed the key, False if it was already claimed
+    """
+    db.ensure_schema(path, 'jobs', SCHEMA)
+    conn = db.connect(path)
+    now = time.time()
+    with db.transaction(conn):
+        conn.execute("DELETE FROM webhook_deliveries WHERE key = ? AND expires_at <= ?", (key, now))
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO webhook_deliveries (key, created_at, expires_at) VALUES (?, ?, ?)",
+            (key, now, now + ttl)
+        )
+    claimed = cursor.rowcount == 1
+    _maybe_purge(conn, now)
+    if not claimed:
+        logger.info(f"Duplicate webhook delivery ignored: {key}")
+    return claimed
+
+def _maybe_purge(conn, now):
+    """Delete expired delivery keys at most once every five minutes in this process"""
+    global _last_purge
+    if now - _last_purge > 5 * 60:
+        _last_purge = now
+        conn.execute("DELETE FROM webhook_deliveries WHERE expires_at <= ?", (now,))
+
+def release(key, path=None):
+    """Forget a claimed key so a later retry is processed again"""
+    db.ensure_schema(path, 'jobs', SCHEMA)
+    db.connect(path).execute("DELETE FROM webhook_deliveries WHERE key = ?", (key,))
+
+def bind(fn):
+    """
+    Wrap fn to run in a copy of the caller's context
+
+    Executor threads otherwise start from an empty context; this carries
+    the caller's priority class (see scheduler.priority) and trace into
+    tasks given to a ThreadPoolExecutor. A request profile is not carried:
+    the tasks may outlive the request (e.g. batch.BatchRun's recordings).
+    """
+    context = contextvars.copy_context()
+    context.run(profiling.detach)
+
+    def run(*args, **kwargs):
+        # Each call gets its own copy so tasks can run concurrently
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+def submit(fn, *args, release_key=None, on_error=None, **kwargs):
+    """
+    Run a function in the background and return immediately
+
+    Exceptions are logged rather than lost. A webhook that queued a job has
+    already been answered with a 2xx, so its provider will not deliver it
+    again: pass on_error to record the failure where users can see it (e.g.
+    pipeline.record_failure on the call). If release_key is given, the
+    delivery key is also released when the job fails, so a later delivery
+    of the same event (a manual redelivery, or a duplicate that arrives
+    after the failure) is processed again instead of ignored.
+
+    Args:
+        fn (callable): The function to run
+        *args: Positional arguments for fn
+        release_key (str): Delivery key to release if fn raises
+        on_error (callable): Called with the exception if fn raises
+        **kwargs: Keyword arguments for fn
+
+    Returns:
+        concurrent.futures.Future: The job's future
+    """
+    # The job keeps the caller's priority and trace, but not its request profile
+    context = contextvars.copy_context()
+    context.run(profiling.detach)
+
+    def traced():
+        with span(f"job {getattr(fn, '__name__', 'anonymous')}"):
+            return fn(*args, **kwargs)
+
+    def run():
+        try:
+            return context.run(traced)
+        except Exception as e:
+            logger.error(f"Background job {getattr(fn, '__name__', fn)} failed: {str(e)}", exc_info=True)
+            if on_error:
+                try:
+                    context.run(on_error, e)
+                except Exception:
+                    logger.error(f"Could not record the failure of {getattr(fn, '__name__', fn)}", exc_info=True)
+            if release_key:
+                release(release_key)
+            raise
+
+    return _get_executor().submit(run)
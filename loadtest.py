@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+HTTP load driver replaying a synthetic IVR corpus
+
+Replays the IVRs of a corpus (see corpus.py) against the app over HTTP
+with local stand-ins for the OpenAI and Twilio APIs, and reports
+throughput and p50/p95/p99 latency per route. Two scenarios are mixed:
+
+- upload: POST / with the IVR's recording; answered once transcription,
+  flowchart and analytics are done
+- call: POST /make-call to the IVR's number, then the webhooks Twilio sends
+  while a machine-answered call walks one path through the menus
+  (/twilio-ivr, then /recording-callback and /handle-dtmf per menu, then
+  /call-status). The background analysis is awaited through GET
+  /call-status and reported as "analysis (call)".
+
+The Whisper stand-in recognises the corpus' prompt audio with the app's own
+prompt fingerprints and answers with the matching sentences; the chat
+stand-in answers with the flowchart of the IVR greeting in the transcript.
+Each upload has a few samples altered so the upload cache cannot answer it.
+
+By default the app runs in this process on a threaded WSGI server with a
+throwaway database:
+
+    python corpus.py corpus/ --count 20
+    python loadtest.py corpus/ --concurrency 8 --duration 60
+
+To load an app started separately, pass its --url with fixed --openai-port
+and --twilio-port, and start the app with OPENAI_BASE_URL and
+TWILIO_API_BASE pointing at them (the driver logs both).
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import email
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import requests
+from benchmarks import OpenAIStandIn, environment
+from corpus import (load_corpus, sentences, speech, silence, to_pcm, wav_bytes, ivr_audio, segment_audio,
+                    SENTENCE_PAUSE)
+from fingerprints import PromptIndex, spectral_fingerprint
+from media_stream import SAMPLE_RATE, read_wav, split_utterances
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Scenarios and their default share of the load
+SCENARIOS = {'upload': 1, 'call': 1}
+
+# Seconds between GET /call-status polls while a call is being analysed
+POLL_INTERVAL = 0.05
+
+# Longest wait for a call's background analysis
+ANALYSIS_TIMEOUT = 120
+
+# Twilio credentials used when none are configured (the stand-in accepts any)
+STAND_IN_ACCOUNT_SID = 'AC' + '0' * 32
+STAND_IN_NUMBER = '+15550000000'
+
+GREETING_PATTERN = re.compile(r"Thank you for calling ([^.]+)\.")
+
+
+def multipart_file(data, content_type, field='file'):
+    """Extract one file field from a multipart/form-data body"""
+    message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + data)
+    for part in message.get_payload():
+        if part.get_param('name', header='content-disposition') == field:
+            return part.get_payload(decode=True)
+    raise ValueError(f"No {field} field in the request")
+
+
+class CorpusOpenAI(OpenAIStandIn):
+    """
+    OpenAI stand-in that knows the corpus
+
+    Every prompt sentence of the corpus is fingerprinted like the app
+    fingerprints utterances; transcription requests are split into
+    utterances and each one is answered with the sentence it matches.
+    Audio that matches nothing (DTMF tones) transcribes to nothing.
+    """
+
+    def __init__(self, ivrs, index_path, latency=0.0, port=0):
+        super().__init__(latency, port)
+        self.ivrs = {ivr['company']: ivr for ivr in ivrs}
+        self.index = PromptIndex(path=index_path)
+        texts = {text for ivr in ivrs for node in ivr['nodes'].values() for text in sentences(node['transcript'])}
+        for text in sorted(texts):
+            pcm = to_pcm(np.concatenate([silence(SENTENCE_PAUSE), speech(text), silence(SENTENCE_PAUSE)]))
+            for utterance in split_utterances(pcm):
+                self.index.add(spectral_fingerprint(utterance), len(utterance) / SAMPLE_RATE, text)
+        logger.info(f"OpenAI stand-in knows {len(texts)} prompt sentences of {len(ivrs)} IVRs")
+
+    def transcribe(self, data, content_type):
+        pcm = read_wav(io.BytesIO(multipart_file(data, content_type)))
+        texts = []
+        for utterance in split_utterances(pcm):
+            match = self.index.lookup(spectral_fingerprint(utterance), len(utterance) / SAMPLE_RATE)
+            if match is not None:
+                texts.append(match['transcript'])
+        return ' '.join(texts)
+
+    def complete(self, request):
+        prompt = ' '.join(m['content'] for m in request.get('messages', []) if isinstance(m.get('content'), str))
+        match = GREETING_PATTERN.search(prompt)
+        ivr = self.ivrs.get(match.group(1)) if match else None
+        return ivr['flowchart'] if ivr else 'flowchart TD\n    Nroot["Start"]'
+
+
+class TwilioStandIn:
+    """
+    Local HTTP server for the Twilio REST API calls the app makes
+
+    Creating a call answers with a queued call and nothing else: the driver
+    plays Twilio's part by sending the webhooks itself. Recordings added with
+    add_recording() are served at their RecordingUrl plus '.wav', as Twilio
+    serves them.
+    """
+
+    def __init__(self, account_sid, latency=0.0, port=0):
+        self.account_sid = account_sid
+        self.latency = latency
+        self.recordings = {}
+        self.calls = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not self.path.endswith('/Calls.json'):
+                    self.send_error(404)
+                    return
+                stand_in.calls += 1
+                time.sleep(stand_in.latency)
+                self._send(201, 'application/json', json.dumps({
+                    'sid': f"CA{uuid.uuid4().hex}", 'account_sid': stand_in.account_sid,
+                    'status': 'queued', 'direction': 'outbound-api'
+                }).encode('utf-8'))
+
+            def do_GET(self):
+                match = re.search(r'/Recordings/(RE\w+)\.wav$', self.path)
+                audio = stand_in.recordings.get(match.group(1)) if match else None
+                if audio is None:
+                    self.send_error(404)
+                    return
+                self._send(200, 'audio/wav', audio)
+
+            def _send(self, status, content_type, payload):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def add_recording(self, recording_sid, audio):
+        """Serve WAV bytes as a recording; returns its RecordingUrl"""
+        self.recordings[recording_sid] = audio
+        return f"{self.url}/2010-04-01/Accounts/{self.account_sid}/Recordings/{recording_sid}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class LoadDriver:
+    """
+    Closed-loop load: each worker runs one scenario after another against the app
+
+    Latencies are recorded per route; a request fails when it raises or
+    answers with a 4xx/5xx status.
+    """
+
+    def __init__(self, base_url, ivrs, twilio, mix=None, seed=0, analysis_timeout=ANALYSIS_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.ivrs = ivrs
+        self.twilio = twilio
+        self.mix = mix or SCENARIOS
+        self.seed = seed
+        self.analysis_timeout = analysis_timeout
+        self.samples = defaultdict(list)
+        self.scenarios = defaultdict(int)
+        self._lock = threading.Lock()
+        self._audio = {}
+
+    def record(self, route, seconds, ok):
+        with self._lock:
+            self.samples[route].append((seconds, ok))
+
+    def request(self, session, method, path, **kwargs):
+        """Send a request and record its latency under 'METHOD /path'; returns the response or None"""
+        started = time.perf_counter()
+        try:
+            response = session.request(method, f"{self.base_url}{path}", timeout=self.analysis_timeout, **kwargs)
+        except requests.RequestException as e:
+            self.record(f"{method} {path}", time.perf_counter() - started, False)
+            logger.warning(f"{method} {path} failed: {str(e)}")
+            return None
+        self.record(f"{method} {path}", time.perf_counter() - started, response.status_code < 400)
+        if response.status_code >= 400:
+            logger.warning(f"{method} {path} answered {response.status_code}: {response.text[:200]}")
+        return response
+
+    def audio(self, key, build):
+        """WAV bytes built once per IVR or segment"""
+        if key not in self._audio:
+            self._audio[key] = build()
+        return self._audio[key]
+
+    def upload_audio(self, ivr):
+        def build():
+            if ivr.get('audio_path'):
+                with open(ivr['audio_path'], 'rb') as f:
+                    return f.read()
+            return wav_bytes(ivr_audio(ivr['nodes']))
+        audio = bytearray(self.audio(ivr['id'], build))
+        # Alter the last two samples: new content for the upload cache, the same prompts for Whisper
+        audio[-4:] = os.urandom(4)
+        return bytes(audio)
+
+    def run_upload(self, session, rng, ivr):
+        self.request(session, 'POST', '/', headers={'Accept': 'application/json'},
+                     files={'file': (f"{ivr['id']}.wav", self.upload_audio(ivr), 'audio/wav')})
+
+    def run_call(self, session, rng, ivr):
+        response = self.request(session, 'POST', '/make-call', data={'to_number': ivr['number']})
+        if response is None or response.status_code != 200:
+            return
+        call_sid = response.json()['call_sid']
+        form = {'CallSid': call_sid, 'AccountSid': self.twilio.account_sid, 'To': ivr['number'],
+                'From': os.getenv('TWILIO_NUMBER', STAND_IN_NUMBER)}
+        self.request(session, 'POST', '/twilio-ivr', data=dict(form, CallStatus='in-progress',
+                                                               AnsweredBy='machine_start'))
+
+        # One recording segment per menu on a random path down the tree
+        prefix, recording_sids, call_seconds = '', [], 0
+        while True:
+            audio = self.audio((ivr['id'], prefix), lambda: wav_bytes(segment_audio(ivr['nodes'], prefix)))
+            duration = math.ceil((len(audio) - 44) / 2 / SAMPLE_RATE)
+            recording_sid = f"RE{uuid.uuid4().hex}"
+            recording_sids.append(recording_sid)
+            call_seconds += duration
+            self.request(session, 'POST', '/recording-callback', data=dict(
+                form, CallStatus='in-progress', RecordingSid=recording_sid, RecordingStatus='completed',
+                RecordingUrl=self.twilio.add_recording(recording_sid, audio), RecordingDuration=str(duration)
+            ))
+            options = ivr['nodes'][prefix]['options']
+            if not options:
+                break
+            digit = rng.choice(options)['number']
+            self.request(session, 'POST', '/handle-dtmf', data=dict(form, CallStatus='in-progress', Digits=digit))
+            prefix += digit
+
+        started = time.perf_counter()
+        self.request(session, 'POST', '/call-status', data=dict(form, CallStatus='completed',
+                                                                CallDuration=str(call_seconds)))
+        status = self.wait_for_analysis(session, call_sid)
+        self.record('analysis (call)', time.perf_counter() - started, status == 'complete')
+        for recording_sid in recording_sids:
+            self.twilio.recordings.pop(recording_sid, None)
+
+    def wait_for_analysis(self, session, call_sid):
+        """Poll GET /call-status (not recorded) until the call's analysis is done"""
+        deadline = time.time() + self.analysis_timeout
+        while time.time() < deadline:
+            try:
+                status = session.get(f"{self.base_url}/call-status", params={'call_sid': call_sid},
+                                     timeout=self.analysis_timeout).json().get('transcription_status')
+            except (requests.RequestException, ValueError):
+                status = None
+            if status in ('complete', 'failed'):
+                return status
+            time.sleep(POLL_INTERVAL)
+        logger.warning(f"Call {call_sid} was not analysed within {self.analysis_timeout}s")
+        return None
+
+    def run(self, concurrency, duration=None, iterations=None):
+        """
+        Run workers until the duration has passed or the iterations are used up
+
+        Returns:
+            float: Wall-clock seconds
+        """
+        deadline = time.perf_counter() + duration if duration else None
+        remaining = [iterations]
+        scenarios, weights = zip(*self.mix.items())
+
+        def take():
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            with self._lock:
+                if remaining[0] is None:
+                    return True
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+                return True
+
+        def worker(index):
+            rng = random.Random(self.seed + index)
+            with requests.Session() as session:
+                while take():
+                    scenario = rng.choices(scenarios, weights)[0]
+                    with self._lock:
+                        self.scenarios[scenario] += 1
+                    try:
+                        getattr(self, f"run_{scenario}")(session, rng, rng.choice(self.ivrs))
+                    except Exception as e:
+                        logger.error(f"{scenario} scenario failed: {str(e)}", exc_info=True)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,), name=f"load-{i}") for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        """
+        Summarise the recorded latencies
+
+        Returns:
+            dict: Per route 'requests', 'errors', 'throughput' (per second) and
+                'p50', 'p95', 'p99', 'max' (seconds)
+        """
+        report = {}
+        for route, samples in sorted(self.samples.items()):
+            ordered = sorted(seconds for seconds, _ in samples)
+            report[route] = {
+                'requests': len(samples),
+                'errors': sum(1 for _, ok in samples if not ok),
+                'throughput': len(samples) / elapsed,
+                'p50': percentile(ordered, 0.50),
+                'p95': percentile(ordered, 0.95),
+                'p99': percentile(ordered, 0.99),
+                'max': ordered[-1]
+            }
+        return report
+
+
+def parse_mix(text):
+    """Parse 'upload=3,call=1' into scenario weights"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {name.strip()!r} (expected {', '.join(SCENARIOS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def serve_app():
+    """Start the app on a threaded WSGI server in this process; returns its base URL"""
+    from werkzeug.serving import make_server
+    from app import app
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a synthetic IVR corpus against the app under load")
+    parser.add_argument('corpus', help="Corpus directory written by corpus.py")
+    parser.add_argument('--url', help="Base URL of a running app (default: start one in this process)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent workers")
+    parser.add_argument('--duration', type=float, help="Seconds to run (default: until --iterations)")
+    parser.add_argument('--iterations', type=int, help="Scenarios to run in total (default: 20 without --duration)")
+    parser.add_argument('--mix', default='upload=1,call=1', help="Scenario weights, e.g. upload=3,call=1")
+    parser.add_argument('--openai-latency', type=float, default=0.0, help="Stand-in OpenAI latency in seconds")
+    parser.add_argument('--twilio-latency', type=float, default=0.0, help="Stand-in Twilio latency in seconds")
+    parser.add_argument('--openai-port', type=int, default=0, help="Stand-in OpenAI port (required with --url)")
+    parser.add_argument('--twilio-port', type=int, default=0, help="Stand-in Twilio port (required with --url)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.url and not (args.openai_port and args.twilio_port):
+        parser.error("--url needs --openai-port and --twilio-port the app is configured with")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.duration is None and args.iterations is None:
+        args.iterations = 20
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ivrs = load_corpus(args.corpus)
+    workdir = tempfile.mkdtemp(prefix='echomap-load-')
+    account_sid = os.getenv('TWILIO_ACCOUNT_SID', STAND_IN_ACCOUNT_SID)
+
+    try:
+        with CorpusOpenAI(ivrs, os.path.join(workdir, 'stand-in.db'), args.openai_latency, args.openai_port) as openai_stand_in, \
+                TwilioStandIn(account_sid, args.twilio_latency, args.twilio_port) as twilio_stand_in:
+            logger.info(f"Stand-ins: OPENAI_BASE_URL={openai_stand_in.url} TWILIO_API_BASE={twilio_stand_in.url}")
+            base_url = args.url
+            if not base_url:
+                os.environ['OPENAI_BASE_URL'] = openai_stand_in.url
+                os.environ['TWILIO_API_BASE'] = twilio_stand_in.url
+                os.environ.setdefault('OPENAI_API_KEY', 'load-test')
+                os.environ.setdefault('TWILIO_ACCOUNT_SID', account_sid)
+                os.environ.setdefault('TWILIO_AUTH_TOKEN', 'load-test')
+                os.environ.setdefault('TWILIO_NUMBER', STAND_IN_NUMBER)
+                # All load comes from one address; set ADMISSION_ENABLED=true to load the rate limits too
+                os.environ.setdefault('ADMISSION_ENABLED', 'false')
+                if not os.getenv('DATABASE_PATH'):
+                    # Keep load test calls, uploads and analyses out of the real database
+                    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'load.db')
+                    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+                base_url = serve_app()
+                # The app logs every request at INFO; keep the driver's output readable
+                logging.getLogger().setLevel(logging.WARNING)
+
+            driver = LoadDriver(base_url, ivrs, twilio_stand_in, mix, args.seed)
+            elapsed = driver.run(args.concurrency, args.duration, args.iterations)
+            logging.getLogger().setLevel(logging.INFO)
+            logger.info(f"Ran {sum(driver.scenarios.values())} scenarios ({dict(driver.scenarios)}) in {elapsed:.1f}s; "
+                        f"stand-ins answered {openai_stand_in.requests} OpenAI and {twilio_stand_in.calls} Twilio calls")
+            if not args.url:
+                # The app's metrics are flushed to its database at exit; write them while it is still there
+                import metrics
+                metrics.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = driver.report(elapsed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'config': vars(args), 'seconds': elapsed, 'routes': report}, f, indent=2)
+        logger.info(f"Wrote report to {args.output}")
+
+    print(f"{'route':28} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for route, row in report.items():
+        print(f"{route:28} {row['requests']:8d} {row['errors']:6d} {row['throughput']:8.2f} "
+              + ' '.join(f"{row[key] * 1000:7.1f}ms" for key in ('p50', 'p95', 'p99', 'max')))
+    return 1 if any(row['errors'] for row in report.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""
+Live call analysis over Twilio Media Streams
+
+Twilio streams call audio to the /media-stream WebSocket as base64 μ-law
+frames (8 kHz, 20 ms each). Frames are decoded with a NumPy lookup table,
+scanned for DTMF tones and split into utterances by an energy-based voice
+activity detector. Each utterance is transcribed in the background as soon
+as it ends, so the call's transcript - and a flowchart regenerated from it -
+grow while the call is still running. When the stream stops, the stitched
+transcript goes through the usual analysis pipeline.
+
+Replay a WAV file through the same path for offline testing:
+
+    python media_stream.py recording.wav --no-transcribe
+"""
+
+import os
+import json
+import wave
+import time
+import uuid
+import base64
+import logging
+import argparse
+import tempfile
+import threading
+from functools import partial
+from collections import deque
+from concurrent.futures import wait as wait_for_futures
+import numpy as np
+import jobs
+from call_store import call_store
+from events import broker
+from scheduler import priority, call_priority
+import tracing
+from tracing import stage
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Twilio Media Streams audio format
+SAMPLE_RATE = 8000
+FRAME_SAMPLES = 160  # 20 ms
+
+# Minimum seconds between live flowchart refreshes for one call
+LIVE_FLOWCHART_INTERVAL = float(os.getenv('LIVE_FLOWCHART_INTERVAL', 10))
+
+# How long to wait for outstanding utterance transcriptions when a stream stops
+LIVE_FINISH_TIMEOUT = 120
+
+# DTMF row and column frequencies and the keys they encode
+DTMF_LOW = (697, 770, 852, 941)
+DTMF_HIGH = (1209, 1336, 1477, 1633)
+DTMF_KEYS = (
+    ('1', '2', '3', 'A'),
+    ('4', '5', '6', 'B'),
+    ('7', '8', '9', 'C'),
+    ('*', '0', '#', 'D'),
+)
+
+
+def _mulaw_decode_table():
+    """All 256 G.711 μ-law codes decoded to 16-bit PCM"""
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponent = (codes >> 4) & 0x07
+    mantissa = (codes & 0x0F).astype(np.int32)
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+MULAW_TABLE = _mulaw_decode_table()
+
+
+def decode_mulaw(payload):
+    """Decode μ-law bytes to an int16 PCM array"""
+    return MULAW_TABLE[np.frombuffer(payload, dtype=np.uint8)]
+
+
+def encode_mulaw(pcm):
+    """Encode an int16 PCM array to μ-law bytes"""
+    x = pcm.astype(np.int32)
+    sign = (x < 0).astype(np.int32) << 7
+    x = np.minimum(np.abs(x), 32635) + 0x84
+    exponent = np.clip(np.floor(np.log2(x)).astype(np.int32) - 7, 0, 7)
+    mantissa = (x >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+
+def level_db(samples):
+    """Signal level in dBFS"""
+    x = samples.astype(np.float64) / 32768.0
+    return 10 * np.log10(np.mean(x * x) + 1e-12)
+
+
+class DTMFDetector:
+    """
+    Sliding-window DTMF detector.
+
+    Evaluates the eight DTMF frequencies over a Hann-windowed 40 ms window
+    with one matrix product per frame. A key is reported when a row and a
+    column tone together carry most of the window's energy for min_windows
+    consecutive windows, and is not reported again until the tone stops.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, window=2 * FRAME_SAMPLES, min_level_db=-40,
+                 min_tone_ratio=0.6, max_twist_db=8, min_windows=2):
+        n = np.arange(window)
+        self._window = np.hanning(window)
+        freqs = np.array(DTMF_LOW + DTMF_HIGH)
+        self._basis = np.exp(-2j * np.pi * np.outer(freqs, n) / sample_rate) * self._window
+        # |X(f)|^2 / windowed energy for a pure tone; normalises the tone ratio to 1
+        self._tone_norm = self._window.sum() ** 2 / (2 * (self._window ** 2).sum())
+        self.window = window
+        self.min_level_db = min_level_db
+        self.min_tone_ratio = min_tone_ratio
+        self.max_twist_db = max_twist_db
+        self.min_windows = min_windows
+        self._buffer = np.zeros(0)
+        self._candidate = None
+        self._hits = 0
+        self._reported = None
+
+    def classify(self, x):
+        """Return the key a window of float samples encodes, or None"""
+        xw = x * self._window
+        energy = np.dot(xw, xw)
+        if 10 * np.log10(energy / self._window.dot(self._window) + 1e-12) < self.min_level_db:
+            return None
+        powers = np.abs(self._basis @ x) ** 2
+        low = int(np.argmax(powers[:4]))
+        high = int(np.argmax(powers[4:]))
+        p_low, p_high = powers[low], powers[4 + high]
+        if (p_low + p_high) / (energy * self._tone_norm) < self.min_tone_ratio:
+            return None
+        if abs(10 * np.log10(p_low / p_high)) > self.max_twist_db:
+            return None
+        return DTMF_KEYS[low][high]
+
+    def process(self, frame):
+        """
+        Feed one frame of int16 PCM
+
+        Returns:
+            tuple: (key newly detected or None, True if the window holds a tone)
+        """
+        self._buffer = np.concatenate([self._buffer, frame.astype(np.float64) / 32768.0])[-self.window:]
+        if len(self._buffer) < self.window:
+            return None, False
+        key = self.classify(self._buffer)
+        if key is None:
+            self._candidate, self._hits, self._reported = None, 0, None
+            return None, False
+        if key != self._candidate:
+            self._candidate, self._hits = key, 0
+        self._hits += 1
+        if self._hits >= self.min_windows and key != self._reported:
+            self._reported = key
+            return key, True
+        return None, True
+
+
+class VoiceActivityDetector:
+    """
+    Energy-based utterance segmentation.
+
+    A frame is speech when it is louder than both an absolute threshold and
+    the tracked noise floor plus snr_db. An utterance starts after onset_ms
+    of speech with a short pre-roll, ends after hangover_ms of non-speech and
+    is cut at max_utterance_s so long prompts are transcribed in pieces.
+    """
+
+    def __init__(self, threshold_db=-45, snr_db=9, onset_ms=60, hangover_ms=600, preroll_ms=200,
+                 min_speech_ms=250, max_utterance_s=15):
+        frame_ms = 1000 * FRAME_SAMPLES // SAMPLE_RATE
+        self.threshold_db = threshold_db
+        self.snr_db = snr_db
+        self.onset_frames = max(1, onset_ms // frame_ms)
+        self.hangover_frames = hangover_ms // frame_ms
+        self.min_speech_frames = min_speech_ms // frame_ms
+        self.max_frames = int(max_utterance_s * 1000 // frame_ms)
+        self.noise_floor_db = -60.0
+        self._preroll = deque(maxlen=preroll_ms // frame_ms)
+        self._frames = []
+        self._speech_frames = 0
+        self._silent_run = 0
+        self._onset = 0
+
+    def process(self, frame, is_tone=False):
+        """
+        Feed one frame of int16 PCM
+
+        Args:
+            frame (np.ndarray): 20 ms of audio
+            is_tone (bool): The frame holds a DTMF tone and is never speech
+
+        Returns:
+            np.ndarray: A finished utterance, or None
+        """
+        db = level_db(frame)
+        speech = not is_tone and db > max(self.threshold_db, self.noise_floor_db + self.snr_db)
+        if not speech and not is_tone:
+            # Track the background level slowly so speech does not raise it
+            self.noise_floor_db = 0.95 * self.noise_floor_db + 0.05 * db
+
+        if not self._frames:
+            # Require a few speech frames in a row so clicks and tone edges do not open an utterance
+            self._preroll.append(frame)
+            self._onset = self._onset + 1 if speech else 0
+            if self._onset >= self.onset_frames:
+                self._frames = list(self._preroll)
+                self._speech_frames = self._onset
+                self._silent_run = 0
+                self._onset = 0
+                self._preroll.clear()
+            return None
+
+        self._frames.append(frame)
+        if speech:
+            self._speech_frames += 1
+            self._silent_run = 0
+        else:
+            self._silent_run += 1
+        if self._silent_run >= self.hangover_frames or len(self._frames) >= self.max_frames:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """End the current utterance; returns it, or None if it was too short"""
+        frames, speech_frames = self._frames, self._speech_frames
+        self._frames, self._speech_frames, self._silent_run = [], 0, 0
+        if speech_frames < self.min_speech_frames:
+            return None
+        return np.concatenate(frames)
+
+
+def write_wav(path, pcm, sample_rate=SAMPLE_RATE):
+    """Write int16 mono PCM to a WAV file"""
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.astype('<i2').tobytes())
+
+
+def split_utterances(pcm, vad=None):
+    """Split 8 kHz PCM into the utterances a VoiceActivityDetector finds"""
+    vad = vad or VoiceActivityDetector()
+    utterances = []
+    for start in range(0, len(pcm) - FRAME_SAMPLES + 1, FRAME_SAMPLES):
+        utterance = vad.process(pcm[start:start + FRAME_SAMPLES])
+        if utterance is not None:
+            utterances.append(utterance)
+    utterance = vad.flush()
+    if utterance is not None:
+        utterances.append(utterance)
+    return utterances
+
+
+def transcribe_pcm(pcm):
+    """Transcribe one utterance of 8 kHz PCM with Whisper"""
+    from transcriber import transcribe_audio
+    fd, path = tempfile.mkstemp(prefix='utterance-', suffix='.wav')
+    os.close(fd)
+    try:
+        write_wav(path, pcm)
+        return transcribe_audio(path).strip()
+    finally:
+        os.remove(path)
+
+
+def transcribe_known_pcm(pcm):
+    """Transcribe an utterance, reusing the text of a known prompt when it matches"""
+    from fingerprints import prompt_index
+    with stage('transcription', 'live'):
+        return prompt_index.transcribe(pcm, transcribe_pcm)
+
+
+def generate_live_flowchart(transcript):
+    """Generate a Mermaid flowchart for a partial transcript"""
+    from flow_builder import generate_flowchart, strip_code_fences
+    with stage('flowchart', 'live'):
+        flowchart = generate_flowchart(transcript)
+    with stage('fence_strip', 'live'):
+        return strip_code_fences(flowchart)
+
+
+class LiveCallAnalyzer:
+    """
+    Grows a call's transcript and flowchart from streamed audio.
+
+    Utterances and DTMF presses are kept in arrival order; transcriptions
+    run in parallel on the background executor and are published as soon as
+    every earlier utterance is done, so the transcript only ever grows at
+    the end.
+    """
+
+    def __init__(self, call_sid, transcribe=transcribe_known_pcm, flowchart=generate_live_flowchart,
+                 flowchart_interval=LIVE_FLOWCHART_INTERVAL):
+        self.call_sid = call_sid
+        self.transcribe = transcribe
+        self.flowchart = flowchart
+        self.flowchart_interval = flowchart_interval
+        self.priority = call_priority(call_store.get(call_sid) or {})
+        self.vad = VoiceActivityDetector()
+        self.detectors = {}
+        self.frames = 0
+        self.utterances = 0
+        self.transcript = ''
+        self._entries = []
+        self._published = 0
+        self._pending_audio = {}
+        self._flowchart_running = False
+        self._flowchart_at = 0
+        self._flowchart_transcript = ''
+        self._lock = threading.RLock()
+
+    def feed(self, pcm, track='inbound'):
+        """
+        Process decoded audio from one track
+
+        The inbound track (the IVR) is segmented and transcribed; every
+        track is scanned for DTMF, which also catches the digits we send.
+        """
+        buffered = self._pending_audio.get(track)
+        if buffered is not None and len(buffered):
+            pcm = np.concatenate([buffered, pcm])
+        usable = len(pcm) - len(pcm) % FRAME_SAMPLES
+        self._pending_audio[track] = pcm[usable:]
+
+        detector = self.detectors.setdefault(track, DTMFDetector())
+        for start in range(0, usable, FRAME_SAMPLES):
+            frame = pcm[start:start + FRAME_SAMPLES]
+            key, is_tone = detector.process(frame)
+            if key:
+                self.add_dtmf(key)
+            if track == 'inbound':
+                self.frames += 1
+                utterance = self.vad.process(frame, is_tone=is_tone)
+                if utterance is not None:
+                    self._add_utterance(utterance)
+
+    def add_dtmf(self, digit):
+        """Record a key press at the current position of the transcript"""
+        logger.info(f"DTMF {digit} detected on live call {self.call_sid}")
+        call_store.append_dtmf(self.call_sid, digit)
+        broker.publish(self.call_sid, 'dtmf', {'digits': digit})
+        with self._lock:
+            self._entries.append({'text': f"[Pressed {digit}]"})
+        self._publish_ready()
+
+    def _add_utterance(self, pcm):
+        with self._lock:
+            self.utterances += 1
+            entry = {'text': None, 'seconds': len(pcm) / SAMPLE_RATE}
+            self._entries.append(entry)
+        with priority(*self.priority):
+            entry['future'] = jobs.submit(self.transcribe, pcm)
+        entry['future'].add_done_callback(lambda future: self._on_transcribed(entry, future))
+
+    def _on_transcribed(self, entry, future):
+        try:
+            entry['text'] = future.result()
+        except Exception as e:
+            logger.warning(f"Dropping an utterance of call {self.call_sid}: {str(e)}")
+            entry['text'] = ''
+        self._publish_ready()
+
+    def _publish_ready(self):
+        """Append every finished entry that has no unfinished entry before it"""
+        with self._lock:
+            added = []
+            while self._published < len(self._entries) and self._entries[self._published]['text'] is not None:
+                text = self._entries[self._published]['text']
+                if text:
+                    added.append(text)
+                self._published += 1
+            if not added:
+                return
+            self.transcript = '\n'.join(filter(None, [self.transcript] + added))
+            transcript = self.transcript
+        broker.publish(self.call_sid, 'transcript', {'transcript': transcript, 'partial': True})
+        self._maybe_refresh_flowchart()
+
+    def _maybe_refresh_flowchart(self):
+        """Regenerate the flowchart in the background, at most once per interval"""
+        with self._lock:
+            if (self.flowchart is None or self._flowchart_running
+                    or self.transcript == self._flowchart_transcript
+                    or time.time() - self._flowchart_at < self.flowchart_interval):
+                return
+            self._flowchart_running = True
+            self._flowchart_at = time.time()
+            self._flowchart_transcript = transcript = self.transcript
+
+        def refresh():
+            try:
+                flowchart = self.flowchart(transcript)
+                broker.publish(self.call_sid, 'flowchart', {'flowchart': flowchart, 'partial': True})
+            finally:
+                with self._lock:
+                    self._flowchart_running = False
+
+        with priority(*self.priority):
+            jobs.submit(refresh)
+
+    def _flush(self):
+        """Queue the last utterance and return the futures of every transcription"""
+        utterance = self.vad.flush()
+        if utterance is not None:
+            self._add_utterance(utterance)
+        with self._lock:
+            return [entry['future'] for entry in self._entries if 'future' in entry]
+
+    def finish(self, timeout=LIVE_FINISH_TIMEOUT):
+        """
+        Flush the last utterance and wait for outstanding transcriptions
+
+        Blocks, so never call it from a jobs thread: the transcriptions may
+        be queued behind it (see finish_then).
+
+        Returns:
+            str: The complete stitched transcript
+        """
+        wait_for_futures(self._flush(), timeout=timeout)
+        self._publish_ready()
+        return self.transcript
+
+    def finish_then(self, callback, timeout=LIVE_FINISH_TIMEOUT, on_error=None):
+        """
+        Flush the last utterance, then run callback(transcript) as a job once
+        every transcription has finished (or after timeout seconds)
+
+        Returns at once instead of holding a jobs thread while the
+        transcriptions wait for one.
+
+        Args:
+            callback (callable): Runs with the complete stitched transcript,
+                in the caller's context
+            timeout (float): Seconds after which it runs with what has been transcribed
+            on_error (callable): Called with the exception if callback raises
+        """
+        callback = jobs.bind(callback)
+        futures = self._flush()
+        state = {'pending': len(futures), 'fired': False}
+
+        def fire():
+            with self._lock:
+                if state['fired']:
+                    return
+                state['fired'] = True
+            timer.cancel()
+            self._publish_ready()
+            jobs.submit(callback, self.transcript, on_error=on_error)
+
+        def transcribed(future):
+            with self._lock:
+                state['pending'] -= 1
+                last = state['pending'] == 0
+            if last:
+                fire()
+
+        timer = threading.Timer(timeout, fire)
+        timer.daemon = True
+        timer.start()
+        if not futures:
+            fire()
+        for future in futures:
+            # Runs after _on_transcribed (callbacks run in the order they were added)
+            future.add_done_callback(transcribed)
+
+
+class MediaStreamSession:
+    """
+    Handles the JSON messages of one Twilio Media Streams connection
+
+    A stream is only accepted for a call placed here: its start message must
+    carry the call's stream token (a <Stream> parameter, see twilio_ivr).
+    Unless it stops cleanly with a transcript, the call falls back to
+    transcribing its recordings.
+
+    Args:
+        analyzer_factory (callable): Builds the LiveCallAnalyzer for a CallSid
+        analyze (bool): Run the analysis pipeline on the final transcript
+        authenticate (bool): Check the stream token and record the stream on
+            the call (off for offline replays)
+    """
+
+    def __init__(self, analyzer_factory=LiveCallAnalyzer, analyze=True, authenticate=True):
+        self.analyzer_factory = analyzer_factory
+        self.analyze = analyze
+        self.authenticate = authenticate
+        self.analyzer = None
+        self.stream_sid = None
+        self._stopped = False
+        self._finished = False
+
+    def handle(self, message):
+        """
+        Process one message
+
+        Returns:
+            bool: False once the stream has stopped
+        """
+        event = message.get('event')
+        if event == 'start':
+            start = message.get('start', {})
+            self.stream_sid = start.get('streamSid') or message.get('streamSid')
+            call_sid = start.get('callSid')
+            if self.authenticate:
+                token = (start.get('customParameters') or {}).get('token')
+                # The live transcript supersedes transcribing the recordings after hangup
+                if not call_sid or not call_store.start_stream(call_sid, token, self.stream_sid):
+                    logger.warning(f"Refused media stream {self.stream_sid} for call {call_sid}: no matching stream token")
+                    return False
+            call_sid = call_sid or f"STREAM{uuid.uuid4().hex[:26]}"
+            tracing.set_key(call_sid)
+            self.analyzer = self.analyzer_factory(call_sid)
+            logger.info(f"Media stream {self.stream_sid} started for call {call_sid}")
+        elif event == 'media' and self.analyzer is not None:
+            media = message.get('media', {})
+            self.analyzer.feed(decode_mulaw(base64.b64decode(media.get('payload', ''))), media.get('track', 'inbound'))
+        elif event == 'dtmf' and self.analyzer is not None:
+            self.analyzer.add_dtmf(message.get('dtmf', {}).get('digit', ''))
+        elif event == 'stop':
+            self._stopped = True
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        """
+        Finish the call's transcript and queue its final analysis (once)
+
+        Returns:
+            str: The transcript when not analysing (waits for it); None otherwise,
+                as the analysis starts once the last utterance is transcribed
+        """
+        if self._finished or self.analyzer is None:
+            return None
+        self._finished = True
+        call_sid = self.analyzer.call_sid
+        logger.info(f"Media stream {self.stream_sid} stopped for call {call_sid}")
+        if not self.analyze:
+            return self.analyzer.finish()
+        from pipeline import record_failure
+        self.analyzer.finish_then(self._finalize, on_error=partial(record_failure, call_sid))
+        return None
+
+    def _finalize(self, transcript):
+        from pipeline import process_call_transcript
+        call_sid = self.analyzer.call_sid
+        if self._stopped and transcript.strip():
+            return process_call_transcript(call_sid, transcript)
+        if not self.authenticate:
+            logger.warning(f"Live stream for call {call_sid} produced no transcript")
+            return None
+
+        # Dropped or silent: analyse the recordings as if there had been no stream
+        from calls import transcribe_recordings
+        from twilio_integration import TERMINAL_STATUSES
+        logger.warning(
+            f"Live stream for call {call_sid} {'produced no transcript' if self._stopped else 'dropped'}; "
+            f"transcribing its recordings instead"
+        )
+        call = call_store.update(call_sid, live_analysis=False)
+        # Before hangup, the completed status starts it
+        if call['status'] in TERMINAL_STATUSES:
+            transcribe_recordings(call_sid, call)
+        return None
+
+
+def read_wav(path):
+    """Read a PCM WAV file as 8 kHz mono int16, mixing down and resampling as needed"""
+    with wave.open(path, 'rb') as f:
+        if f.getsampwidth() != 2:
+            raise ValueError("Only 16-bit PCM WAV files can be replayed")
+        channels, rate = f.getnchannels(), f.getframerate()
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2').astype(np.float64)
+    pcm = pcm.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE:
+        positions = np.arange(0, len(pcm), rate / SAMPLE_RATE)
+        pcm = np.interp(positions, np.arange(len(pcm)), pcm)
+    return np.clip(np.round(pcm), -32768, 32767).astype(np.int16)
+
+
+def replay_messages(pcm, call_sid, track='inbound', token=None):
+    """Yield the Media Streams messages Twilio would send for a call's audio"""
+    stream_sid = f"MZ{uuid.uuid4().hex}"
+    yield {'event': 'connected', 'protocol': 'Call', 'version': '1.0.0'}
+    yield {'event': 'start', 'streamSid': stream_sid, 'start': {
+        'streamSid': stream_sid, 'callSid': call_sid, 'tracks': [track],
+        'customParameters': {'token': token} if token else {},
+        'mediaFormat': {'encoding': 'audio/x-mulaw', 'sampleRate': SAMPLE_RATE, 'channels': 1}
+    }}
+    payload = encode_mulaw(pcm)
+    for chunk, start in enumerate(range(0, len(payload), FRAME_SAMPLES), start=1):
+        yield {'event': 'media', 'streamSid': stream_sid, 'media': {
+            'track': track, 'chunk': str(chunk), 'timestamp': str(start * 1000 // SAMPLE_RATE),
+            'payload': base64.b64encode(payload[start:start + FRAME_SAMPLES]).decode('ascii')
+        }}
+    yield {'event': 'stop', 'streamSid': stream_sid, 'stop': {'callSid': call_sid}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a WAV file through the live Media Streams analysis")
+    parser.add_argument('wav', help="16-bit PCM WAV file")
+    parser.add_argument('--call-sid', default=None, help="Call id to publish events under")
+    parser.add_argument('--url', help="Send to a running server's WebSocket (e.g. ws://localhost:5000/media-stream)")
+    parser.add_argument('--token', help="The call's stream token, which the server requires (with --url and --call-sid)")
+    parser.add_argument('--realtime', action='store_true', help="Pace frames at 20 ms like a real call")
+    parser.add_argument('--no-transcribe', action='store_true', help="Report utterance timings instead of calling Whisper")
+    parser.add_argument('--analyze', action='store_true', help="Run the full analysis on the final transcript")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    call_sid = args.call_sid or f"REPLAY{uuid.uuid4().hex[:26]}"
+    messages = replay_messages(read_wav(args.wav), call_sid, token=args.token)
+    started = time.time()
+
+    if args.url:
+        import simple_websocket
+        ws = simple_websocket.Client.connect(args.url)
+        for message in messages:
+            ws.send(json.dumps(message))
+            if args.realtime and message['event'] == 'media':
+                time.sleep(FRAME_SAMPLES / SAMPLE_RATE)
+        ws.close()
+        print(f"Replayed to {args.url} as call {call_sid} in {time.time() - started:.1f}s")
+    else:
+        def describe_utterance(pcm):
+            return f"(utterance of {len(pcm) / SAMPLE_RATE:.1f}s)"
+
+        def make_analyzer(sid):
+            if args.no_transcribe:
+                return LiveCallAnalyzer(sid, transcribe=describe_utterance, flowchart=None)
+            return LiveCallAnalyzer(sid)
+
+        session = MediaStreamSession(make_analyzer, analyze=False, authenticate=False)
+        for message in messages:
+            session.handle(message)
+            if args.realtime and message['event'] == 'media':
+                time.sleep(FRAME_SAMPLES / SAMPLE_RATE)
+        print(session.analyzer.transcript)
+        print(f"{session.analyzer.frames} frames, {session.analyzer.utterances} utterance(s) "
+              f"in {time.time() - started:.1f}s")
+        if args.analyze and session.analyzer.transcript.strip():
+            from pipeline import process_call_transcript
+            print(f"Stored analysis {process_call_transcript(call_sid, session.analyzer.transcript)}")
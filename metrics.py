@@ -0,0 +1,218 @@
+import os
+import re
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+import db
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# How often each worker adds its new observations to the shared totals (seconds)
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+# Latency buckets in seconds, from template rendering up to long Whisper calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS metric_samples (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (name, labels)
+    ) WITHOUT ROWID
+    """,
+]
+
+_registry = {}
+_pending = defaultdict(float)
+_lock = threading.Lock()
+_flusher_pid = None
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels):
+    """Render label values in declaration order, e.g. stage="flowchart",source="upload" """
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return ','.join(f'{name}="{_escape(labels[name])}"' for name in labelnames)
+
+
+def _record(name, labels, amount):
+    """Add to a sample's pending delta; the flusher writes it to the shared totals"""
+    with _lock:
+        _pending[(name, labels)] += amount
+    _ensure_flusher()
+
+
+class Counter:
+    """A monotonically increasing count, summed across workers"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        _record(self.name, _format_labels(self.labelnames, labels), amount)
+
+
+class Histogram:
+    """Observations counted in cumulative buckets, summed across workers"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        _registry[name] = self
+
+    def observe(self, value, **labels):
+        label_text = _format_labels(self.labelnames, labels)
+        prefix = f"{label_text}," if label_text else ''
+        with _lock:
+            for bound in self.buckets:
+                if value <= bound:
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    _pending[(f"{self.name}_bucket", f'{prefix}le="{le}"')] += 1
+            _pending[(f"{self.name}_sum", label_text)] += value
+            _pending[(f"{self.name}_count", label_text)] += 1
+        _ensure_flusher()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, including when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+def flush(path=None):
+    """Add this process's pending observations to the totals shared by all workers"""
+    with _lock:
+        if not _pending:
+            return
+        pending = list(_pending.items())
+        _pending.clear()
+    db.ensure_schema(path, 'metrics', SCHEMA)
+    conn = db.connect(path)
+    try:
+        with db.transaction(conn):
+            conn.executemany(
+                """
+                INSERT INTO metric_samples (name, labels, value) VALUES (?, ?, ?)
+                ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value
+                """,
+                [(name, labels, value) for (name, labels), value in pending]
+            )
+    except Exception:
+        # Keep the observations for the next attempt
+        with _lock:
+            for key, value in pending:
+                _pending[key] += value
+        raise
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.warning(f"Could not flush metrics: {str(e)}")
+
+
+def _ensure_flusher():
+    """Start the flush thread once per process (gunicorn forks after import)"""
+    global _flusher_pid
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return
+    with _lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+
+def _reset_after_fork():
+    """A forked worker starts with no pending observations; the parent still owns them"""
+    global _lock
+    _lock = threading.Lock()
+    _pending.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(lambda: flush())
+
+
+_LE_PATTERN = re.compile(r'(?:^|,)le="([^"]*)"$')
+
+
+def _sample_order(row):
+    """Group a histogram's samples by label set, buckets in increasing order"""
+    labels = row['labels']
+    match = _LE_PATTERN.search(labels)
+    if match:
+        return labels[:match.start()], 0, float(match.group(1))
+    suffix = 1 if row['name'].endswith('_sum') else 2
+    return labels, suffix, 0.0
+
+
+def render(path=None):
+    """
+    Render every metric in the Prometheus text exposition format
+
+    Flushes this process first; other workers' observations appear within
+    METRICS_FLUSH_INTERVAL seconds.
+
+    Returns:
+        str: The exposition text
+    """
+    flush(path)
+    db.ensure_schema(path, 'metrics', SCHEMA)
+    samples = defaultdict(list)
+    for row in db.connect(path).execute("SELECT name, labels, value FROM metric_samples"):
+        base = re.sub(r'_(bucket|sum|count)$', '', row['name'])
+        samples[base if base in _registry and _registry[base].kind == 'histogram' else row['name']].append(row)
+
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for row in sorted(samples.get(name, []), key=_sample_order):
+            labels = f"{{{row['labels']}}}" if row['labels'] else ''
+            value = row['value']
+            lines.append(f"{row['name']}{labels} {int(value) if value == int(value) else value}")
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram(
+    'echomap_stage_duration_seconds', 'Time spent in each processing stage',
+    ('stage', 'source')
+)
+request_seconds = Histogram(
+    'echomap_request_duration_seconds', 'HTTP request latency by route',
+    ('route', 'method', 'status')
+)
+cache_hits = Counter('echomap_cache_hits_total', 'Work answered from a cache or shared result', ('cache',))
+cache_misses = Counter('echomap_cache_misses_total', 'Cache lookups that had to compute the result', ('cache',))
+retries = Counter('echomap_retries_total', 'Retried operations', ('operation',))
+admission_rejections = Counter(
+    'echomap_admission_rejections_total', 'Requests refused by admission control', ('route', 'status')
+)
+upstream_errors = Counter('echomap_upstream_errors_total', 'Failed calls to external services', ('service',))
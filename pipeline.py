@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import singleflight
+from flow_builder import generate_flowchart, generate_flowchart_async, strip_code_fences
+from analytics_cache import analytics_cache
+from analysis_store import analysis_store
+from upload_store import upload_store
+from call_store import call_store
+from events import broker
+from voxo_integration import get_transcript_from_voxo
+from recordings import transcribe_timeline
+from transcriber import transcribe_audio, transcribe_audio_async
+from fetcher import fetch_and_transcribe
+from scheduler import priority, call_priority
+from tracing import stage
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+def generate_flowchart_once(transcript, source='upload'):
+    """
+    Generate a transcript's flowchart, sharing one GPT-4 call among concurrent identical requests
+
+    Args:
+        transcript (str): The transcript text
+        source (str): Origin of the transcript for stage metrics ('upload', 'twilio', 'voxo')
+
+    Returns:
+        str: Mermaid flowchart code without code fences
+    """
+    def build():
+        with stage('flowchart', source):
+            flowchart = generate_flowchart(transcript)
+        with stage('fence_strip', source):
+            return strip_code_fences(flowchart)
+    key = f"flowchart:{hashlib.sha256(transcript.encode('utf-8')).hexdigest()}"
+    return singleflight.do(key, build)
+
+def transcribe_upload(filepath, digest):
+    """Transcribe a stored upload, sharing one Whisper call among concurrent uploads of the same file"""
+    return singleflight.do(f"transcribe:{digest}", transcribe_audio, filepath)
+
+async def generate_flowchart_once_async(transcript, source='upload'):
+    """generate_flowchart_once() for async request handlers"""
+    async def build():
+        with stage('flowchart', source):
+            flowchart = await generate_flowchart_async(transcript)
+        with stage('fence_strip', source):
+            return strip_code_fences(flowchart)
+    key = f"flowchart:{hashlib.sha256(transcript.encode('utf-8')).hexdigest()}"
+    return await singleflight.do_async(key, build)
+
+async def transcribe_upload_async(filepath, digest):
+    """transcribe_upload() for async request handlers"""
+    return await singleflight.do_async(f"transcribe:{digest}", transcribe_audio_async, filepath)
+
+def save_upload_analysis(digest, transcript, flowchart, result):
+    """
+    Store an upload's analysis once per content and link it to the upload
+
+    Returns:
+        int: The id of the stored analysis (shared by concurrent identical uploads)
+    """
+    def save():
+        analysis_id = analysis_store.save(
+            transcript, flowchart, result['metrics'], result['summary'], result['visualization_data'],
+            source='upload'
+        )
+        upload_store.link_analysis(digest, analysis_id)
+        return analysis_id
+    return singleflight.do(f"upload-analysis:{digest}", save)
+
+def record_failure(call_sid, error):
+    """
+    Keep a failed background analysis on the call, where /call-status reports it
+
+    The webhook that queued the job was answered with a 2xx, so its provider
+    will not retry it; without this a failure outside the stages below (e.g.
+    fetching the VOXO transcript) left the call 'processing' for good.
+
+    Args:
+        call_sid (str): The Twilio CallSid or VOXO call id
+        error (Exception): Why the job failed
+    """
+    already_reported = (call_store.get(call_sid) or {}).get('transcription_status') == 'failed'
+    call_store.update(call_sid, transcription_status='failed', transcription_error=str(error))
+    if not already_reported:
+        broker.publish(call_sid, 'error', {'error': f"Error analysing the call: {str(error)}"})
+
+def process_call_transcript(call_sid, transcript, source='twilio'):
+    """
+    Turn a call transcript into a stored analysis
+
+    Generates the flowchart, runs analytics, saves the result to the analysis
+    history and links it to the call. Progress and the final result are
+    published on the call's event channel. Meant to run in the background
+    (see jobs.submit) so webhooks can be acknowledged immediately.
+
+    Args:
+        call_sid (str): The Twilio CallSid or VOXO call id
+        transcript (str): The call transcript
+        source (str): 'twilio' or 'voxo'
+
+    Returns:
+        int: The id of the stored analysis
+    """
+    logger.info(f"Processing transcript for {source} call {call_sid}")
+    try:
+        call = call_store.update(call_sid, transcript=transcript, transcription_status='processing')
+        broker.publish(call_sid, 'transcript', {'transcript': transcript})
+
+        # Generate flowchart from transcription
+        broker.publish(call_sid, 'stage', {'stage': 'generating_flowchart'})
+        with priority(*call_priority(call)):
+            flowchart = generate_flowchart_once(transcript, source=source)
+
+        # Perform analytics
+        broker.publish(call_sid, 'stage', {'stage': 'analyzing'})
+        with stage('analytics', source):
+            result = analytics_cache.analyze(transcript, flowchart)
+
+        # Persist in the analysis history and link it to the call
+        analysis_id = analysis_store.save(
+            transcript, flowchart, result['metrics'], result['summary'], result['visualization_data'],
+            source=source, phone_number=call.get('to_number'), call_sid=call_sid,
+            dtmf_sequence=call.get('dtmf_sequence', [])
+        )
+        call_store.update(call_sid, analysis_id=analysis_id, transcription_status='complete', transcription_error=None)
+        broker.publish(call_sid, 'analysis', {
+            'analysis_id': analysis_id, 'transcript': transcript, 'flowchart': flowchart
+        })
+
+        logger.info(f"IVR analysis {analysis_id} completed successfully for call {call_sid}")
+        return analysis_id
+
+    except Exception as e:
+        logger.error(f"Error processing transcript for call {call_sid}: {str(e)}", exc_info=True)
+        call_store.update(call_sid, transcription_status='failed')
+        broker.publish(call_sid, 'error', {'error': f"Error processing transcription: {str(e)}"})
+        raise
+
+def process_call_recordings(call_sid):
+    """
+    Transcribe a finished Twilio call's recording segments and analyse them
+
+    Args:
+        call_sid (str): The Twilio CallSid
+
+    Returns:
+        int: The id of the stored analysis
+    """
+    call = call_store.update(call_sid, transcription_status='transcribing')
+    broker.publish(call_sid, 'stage', {'stage': 'transcribing'})
+    try:
+        with priority(*call_priority(call)), stage('transcription', 'twilio'):
+            transcript = transcribe_timeline(call.get('timeline', []))
+    except Exception as e:
+        logger.error(f"Error transcribing recordings for call {call_sid}: {str(e)}", exc_info=True)
+        call_store.update(call_sid, transcription_status='failed')
+        broker.publish(call_sid, 'error', {'error': f"Error transcribing recordings: {str(e)}"})
+        raise
+    if not transcript.strip():
+        call_store.update(call_sid, transcription_status='failed')
+        broker.publish(call_sid, 'error', {'error': 'The call recordings contained no speech'})
+        raise ValueError(f"Empty transcript for call {call_sid}")
+    return process_call_transcript(call_sid, transcript)
+
+def process_voxo_transcription(call_id, transcript=None):
+    """
+    Analyse a VOXO call once its transcription is available
+
+    VOXO may send TRANSCRIPTION_AVAILABLE before RECORDING_AVAILABLE. With
+    neither a transcript nor a recording yet, the call is left waiting and
+    the RECORDING_AVAILABLE webhook runs this again (see
+    CallStore.store_recording).
+
+    Args:
+        call_id (str): The VOXO call id
+        transcript (str): Transcript from the webhook payload; fetched from
+            the VOXO API when the event did not include it, and transcribed
+            from the call's recording when VOXO has none
+
+    Returns:
+        int: The id of the stored analysis, or None while waiting for the recording
+    """
+    if not transcript:
+        transcript = get_transcript_from_voxo(call_id)
+    if not transcript or not transcript.strip():
+        recording_url = call_store.wait_for_recording(call_id)
+        if not recording_url:
+            logger.info(f"No VOXO transcript or recording yet for call {call_id}, waiting for the recording")
+            return None
+        logger.info(f"No VOXO transcript for call {call_id}, transcribing its recording")
+        broker.publish(call_id, 'stage', {'stage': 'transcribing'})
+        with priority(*call_priority(call_store.get(call_id) or {})), \
+                stage('transcription', 'voxo'):
+            transcript = fetch_and_transcribe(recording_url)
+    if not transcript or not transcript.strip():
+        call_store.update(call_id, transcription_status='failed')
+        broker.publish(call_id, 'error', {'error': 'VOXO did not return a transcript for this call'})
+        raise ValueError(f"No transcript available for VOXO call {call_id}")
+    return process_call_transcript(call_id, transcript, source='voxo')
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+On-demand profiling of live requests
+
+A request is profiled when it carries an X-Profile header matching
+PROFILE_TOKEN, or at random with probability PROFILE_SAMPLE_RATE. The
+request runs under cProfile and tracemalloc; each processing stage (see
+tracing.stage) records its duration and top memory allocation sites. The
+CPU profile (.prof, readable with pstats or snakeviz) and the allocation
+report (.json) are saved to PROFILE_DIR and the response carries an
+X-Profile-Id header naming them.
+
+With no token and a zero sample rate nothing is started: the per-request
+cost is one header lookup, and stages check a context variable.
+
+Show a saved profile:
+
+    python profiling.py 20261019-101500-1a2b3c4d
+"""
+
+import os
+import hmac
+import json
+import time
+import uuid
+import pstats
+import random
+import logging
+import argparse
+import cProfile
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Requests with this value in the X-Profile header are profiled
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+
+# Fraction of requests profiled without the header (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+
+# Where profiles and allocation reports are written
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join('instance', 'profiles'))
+
+# Allocation sites reported per stage
+PROFILE_TOP_ALLOCATIONS = 15
+
+PROFILE_HEADER = 'X-Profile'
+
+_current = contextvars.ContextVar('request_profile', default=None)
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+# Allocations made by the profiler itself are not interesting
+_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+]
+
+
+def should_profile(header_value):
+    """Whether a request with this X-Profile header value should be profiled"""
+    if PROFILE_TOKEN and header_value and hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode()):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _start_tracemalloc():
+    """tracemalloc is process-wide; keep it running while any profile is open"""
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+def _top_allocations(after, before, limit=PROFILE_TOP_ALLOCATIONS):
+    """Allocation sites that grew the most between two snapshots"""
+    stats = after.filter_traces(_SNAPSHOT_FILTERS).compare_to(before.filter_traces(_SNAPSHOT_FILTERS), 'lineno')
+    stats = sorted(stats, key=lambda stat: stat.size_diff, reverse=True)[:limit]
+    return [
+        {
+            'site': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_kb': round(stat.size_diff / 1024, 1),
+            'count': stat.count_diff
+        }
+        for stat in stats if stat.size_diff > 0
+    ]
+
+
+class RequestProfile:
+    """
+    CPU profile and per-stage allocation report of one request.
+
+    tracemalloc sees every thread, so allocations of concurrent requests
+    appear in the report too; the CPU profile covers only the request's thread.
+    """
+
+    def __init__(self, name, directory=PROFILE_DIR):
+        self.name = name
+        self.directory = directory
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.stages = []
+        self.profiler = cProfile.Profile()
+        self._token = None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        _start_tracemalloc()
+        tracemalloc.reset_peak()
+        self._baseline = tracemalloc.take_snapshot()
+        self._started = time.perf_counter()
+        self._thread = threading.get_ident()
+        self._token = _current.set(self)
+        self.profiler.enable()
+
+    def suspend(self):
+        """Stop the CPU profile on this thread, where the request is not running for now"""
+        if threading.get_ident() == self._thread:
+            self.profiler.disable()
+            self._thread = None
+
+    def resume(self):
+        """Continue the CPU profile on this thread (e.g. the event loop running an async view)"""
+        if not self._stopped:
+            self._thread = threading.get_ident()
+            self.profiler.enable()
+
+    def _snapshot(self):
+        """A tracemalloc snapshot kept out of the CPU profile; None once tracing has stopped"""
+        # The profiler belongs to the request's thread: enabling it elsewhere would profile that thread
+        own_thread = threading.get_ident() == self._thread
+        if own_thread:
+            self.profiler.disable()
+        try:
+            return tracemalloc.take_snapshot()
+        except RuntimeError:
+            # This profile (or the last one open) stopped tracemalloc meanwhile
+            return None
+        finally:
+            if own_thread and not self._stopped:
+                self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record a stage's duration and the allocation sites it grew
+
+        Stages on other threads of the request (e.g. asgi.in_thread steps)
+        are recorded too; once the profile has stopped this does nothing.
+        """
+        if self._stopped:
+            yield
+            return
+        before = self._snapshot()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            after = self._snapshot()
+            if before is not None and after is not None and not self._stopped:
+                self.stages.append({
+                    'stage': name,
+                    'seconds': round(seconds, 4),
+                    'top_allocations': _top_allocations(after, before)
+                })
+
+    def stop(self, status=None):
+        """
+        Stop profiling and write the .prof and .json files
+
+        Returns:
+            str: Path of the allocation report
+        """
+        self._stopped = True
+        # Only the thread that runs the profiler can turn it off (see suspend())
+        if threading.get_ident() == self._thread:
+            self.profiler.disable()
+        _current.reset(self._token)
+        try:
+            duration = time.perf_counter() - self._started
+            _, peak = tracemalloc.get_traced_memory()
+            report = {
+                'id': self.id,
+                'request': self.name,
+                'status': status,
+                'seconds': round(duration, 4),
+                'peak_traced_kb': round(peak / 1024, 1),
+                'stages': self.stages,
+                'top_allocations': _top_allocations(tracemalloc.take_snapshot(), self._baseline)
+            }
+        finally:
+            _stop_tracemalloc()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(self.directory, f"{self.id}.prof"))
+        report_path = os.path.join(self.directory, f"{self.id}.json")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Profiled {self.name} in {duration:.2f}s: {report_path}")
+        return report_path
+
+
+def detach():
+    """
+    Leave the current request's profile (call it in a copied context, e.g. a
+    background job's): the job outlives the request, and its stages are not part of it
+    """
+    _current.set(None)
+
+
+@contextmanager
+def stage(name):
+    """Profile a stage if the current request is being profiled; otherwise do nothing"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    with profile.stage(name):
+        yield
+
+
+def show(profile_id, directory=PROFILE_DIR, limit=25):
+    """Print a saved profile: stages with their allocation sites, then the hottest functions"""
+    with open(os.path.join(directory, f"{profile_id}.json"), encoding='utf-8') as f:
+        report = json.load(f)
+    print(f"{report['request']} -> {report['status']}  {report['seconds']:.3f}s, "
+          f"peak traced memory {report['peak_traced_kb']:.0f}KB")
+    for entry in report['stages'] + [{'stage': 'whole request', 'seconds': report['seconds'],
+                                      'top_allocations': report['top_allocations']}]:
+        print(f"\n[{entry['stage']}] {entry['seconds']:.3f}s")
+        for site in entry['top_allocations'][:5]:
+            print(f"  {site['size_kb']:10.1f}KB {site['count']:7d}  {site['site']}")
+    print()
+    pstats.Stats(os.path.join(directory, f"{profile_id}.prof")).sort_stats('cumulative').print_stats(limit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show a saved request profile")
+    parser.add_argument('profile_id', help="Value of the X-Profile-Id response header")
+    parser.add_argument('--dir', default=PROFILE_DIR, help="Profile directory (default: PROFILE_DIR)")
+    parser.add_argument('--limit', type=int, default=25, help="Functions listed from the CPU profile")
+    args = parser.parse_args()
+    show(args.profile_id, args.dir, args.limit)
@@ -0,0 +1,120 @@
+import os
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from transcriber import transcribe_audio
+from twilio_integration import download_recording
+from media_stream import read_wav, split_utterances, transcribe_pcm, SAMPLE_RATE
+from fingerprints import prompt_index
+from jobs import bind
+from tracing import span
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Segments downloaded and transcribed at the same time for one call
+SEGMENT_WORKERS = int(os.getenv('SEGMENT_WORKERS', 4))
+
+# Silence between the utterances of a segment sent to Whisper together (seconds)
+UTTERANCE_GAP_SECONDS = 0.3
+
+
+def recording_segments(timeline):
+    """Return the recording entries of a call timeline, in order"""
+    return [entry for entry in timeline if entry.get('type') == 'recording' and entry.get('url')]
+
+
+def transcribe_segment(segment, workdir):
+    """
+    Download one recording segment and transcribe it
+
+    The segment is split into utterances and each one is looked up in the
+    prompt fingerprint index, so greetings and menus heard on earlier calls
+    are not sent to Whisper again. The audio from the first to the last
+    utterance that is not known goes to Whisper in one request, known
+    prompts in between included, which keeps the order of the transcript
+    and gives Whisper the context of the whole menu.
+
+    Returns:
+        str: The segment transcript ('' for empty recordings)
+    """
+    if segment.get('duration') is not None and int(segment['duration']) <= 0:
+        return ''
+    with span('recordings.segment', recording_sid=segment['recording_sid']) as current:
+        path = os.path.join(workdir, f"{segment['recording_sid']}.wav")
+        download_recording(segment['url'], path, media_format='wav')
+        utterances = split_utterances(read_wav(path))
+        if not utterances:
+            return transcribe_audio(path).strip()
+        texts = [prompt_index.known(pcm) for pcm in utterances]
+        unknown = [i for i, text in enumerate(texts) if text is None]
+        if current is not None:
+            current.set(utterances=len(utterances), known=len(utterances) - len(unknown))
+        if unknown:
+            first, last = unknown[0], unknown[-1]
+            if first == last:
+                texts[first] = transcribe_pcm(utterances[first])
+                prompt_index.learn(utterances[first], texts[first])
+            else:
+                gap = np.zeros(int(UTTERANCE_GAP_SECONDS * SAMPLE_RATE), dtype=np.int16)
+                pieces = [piece for pcm in utterances[first:last + 1] for piece in (pcm, gap)]
+                texts[first:last + 1] = [transcribe_pcm(np.concatenate(pieces[:-1]))]
+        return ' '.join(text for text in texts if text)
+
+
+def stitch_transcript(timeline, transcripts):
+    """
+    Join segment transcripts and DTMF presses into one ordered transcript
+
+    Args:
+        timeline (list): The call timeline from the call store
+        transcripts (dict): Segment transcript by RecordingSid
+
+    Returns:
+        str: One line per segment, with the keys pressed in between
+    """
+    lines = []
+    for entry in timeline:
+        if entry.get('type') == 'dtmf':
+            lines.append(f"[Pressed {' '.join(entry['digits'])}]")
+        elif transcripts.get(entry.get('recording_sid')):
+            lines.append(transcripts[entry['recording_sid']])
+    return '\n'.join(lines)
+
+
+def transcribe_timeline(timeline, max_workers=SEGMENT_WORKERS):
+    """
+    Transcribe every recording segment of a call and stitch the result
+
+    Segments are downloaded and transcribed in parallel; the transcript keeps
+    the order of the timeline regardless of which segment finishes first.
+
+    Args:
+        timeline (list): The call timeline from the call store
+        max_workers (int): Segments processed at the same time
+
+    Returns:
+        str: The stitched transcript
+
+    Raises:
+        ValueError: If the call has no recording segments
+    """
+    segments = recording_segments(timeline)
+    if not segments:
+        raise ValueError("No recording segments for this call")
+
+    workdir = tempfile.mkdtemp(prefix='segments-')
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(segments)))) as executor:
+            futures = {
+                segment['recording_sid']: executor.submit(bind(transcribe_segment), segment, workdir)
+                for segment in segments
+            }
+            transcripts = {recording_sid: future.result() for recording_sid, future in futures.items()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    logger.info(f"Transcribed {len(segments)} recording segment(s)")
+    return stitch_transcript(timeline, transcripts)
@@ -3,7 +3,9 @@
 Production server launcher for EchoMap
 
 This script initializes and runs the EchoMap application in a production environment
-using Gunicorn WSGI server.
+using Gunicorn WSGI server. With SERVER_INTERFACE=asgi it serves asgi.py on
+Uvicorn workers instead, where uploads and outbound calls wait on OpenAI and
+Twilio without holding a thread.
 
 Usage:
     python run.py
@@ -66,9 +68,11 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
     workers = int(os.getenv("WORKERS", "2"))
     threads = int(os.getenv("THREADS", "4"))
+    # 'wsgi' (sync Gunicorn workers) or 'asgi' (Uvicorn workers serving asgi.py)
+    interface = os.getenv("SERVER_INTERFACE", "wsgi").lower()
     
     # Log startup information
-    logger.info(f"Starting EchoMap production server on {host}:{port}")
+    logger.info(f"Starting EchoMap production server ({interface}) on {host}:{port}")
     
     # Configuration for Gunicorn
     options = {
@@ -82,6 +86,10 @@ if __name__ == "__main__":
         "loglevel": log_level.lower(),
         "preload_app": True,
     }
+    application = flask_app
+    if interface == "asgi":
+        from asgi import app as application
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
     
     # Run the application with Gunicorn
-    StandaloneApplication(flask_app, options).run()
\ No newline at end of file
+    StandaloneApplication(application, options).run()
\ No newline at end of file
@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import itertools
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque, defaultdict
+from tracing import annotate
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Concurrent OpenAI calls (Whisper and GPT-4) per worker process
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 4))
+
+# Slots only interactive requests may use, so bulk work can never fill the quota
+INTERACTIVE_RESERVED = int(os.getenv('INTERACTIVE_RESERVED', 1))
+
+# Priority classes, highest first
+PRIORITY_CLASSES = ('interactive', 'standard', 'bulk')
+
+# Wait times kept per class for percentiles
+WAIT_SAMPLES = 1000
+
+_current = contextvars.ContextVar('openai_priority', default=('standard', 'default'))
+
+
+@contextmanager
+def priority(name, tenant=None):
+    """
+    Run OpenAI calls made inside the block with a priority class and tenant
+
+    The setting follows the code into jobs.submit() background jobs and
+    jobs.bind() executor tasks, which copy the caller's context.
+
+    Args:
+        name (str): 'interactive', 'standard' or 'bulk'
+        tenant (str): Who the work is for (client, campaign, number); tenants
+            of one class share its slots fairly
+    """
+    if name not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class: {name}")
+    token = _current.set((name, str(tenant or 'default')))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current_priority():
+    """Return the (class, tenant) OpenAI calls made here are scheduled with"""
+    return _current.get()
+
+
+def call_priority(call):
+    """
+    Priority class and tenant for OpenAI work on a call
+
+    Campaign and IVR crawl calls are bulk work, shared fairly between the
+    numbers being crawled; calls placed from the UI are standard work,
+    shared between providers.
+
+    Args:
+        call (dict): The call's call_store entry
+
+    Returns:
+        tuple: (class, tenant) for priority()
+    """
+    if call.get('automated'):
+        return 'bulk', call.get('to_number') or 'automated'
+    return 'standard', call.get('provider') or 'twilio'
+
+
+class PriorityScheduler:
+    """
+    Admission to a fixed number of OpenAI call slots.
+
+    A freed slot goes to the highest priority class with a waiting request;
+    within a class, tenants are served by weighted fair queuing (start-time
+    fair queuing on per-tenant virtual finish times), so one large crawl
+    cannot crowd out other sources of the same class. reserved slots are
+    held back for interactive requests: lower classes may only use
+    capacity - reserved slots between them.
+    """
+
+    def __init__(self, capacity=OPENAI_CONCURRENCY, reserved=INTERACTIVE_RESERVED, weights=None):
+        """
+        Args:
+            capacity (int): Concurrent calls allowed
+            reserved (int): Slots kept for the 'interactive' class
+            weights (dict): Relative share per tenant (default 1.0)
+        """
+        self.capacity = max(1, capacity)
+        self.reserved = min(max(0, reserved), self.capacity - 1)
+        self.weights = weights or {}
+        self._condition = threading.Condition()
+        self._waiting = {name: [] for name in PRIORITY_CLASSES}
+        self._running = defaultdict(int)
+        self._virtual_time = defaultdict(float)
+        self._finish_tags = defaultdict(float)
+        self._sequence = itertools.count()
+        self._admitted = defaultdict(int)
+        self._wait_total = defaultdict(float)
+        self._wait_max = defaultdict(float)
+        self._waits = {name: deque(maxlen=WAIT_SAMPLES) for name in PRIORITY_CLASSES}
+
+    def _eligible(self, name):
+        """Whether a request of this class may take a slot now"""
+        total = sum(self._running.values())
+        if total >= self.capacity:
+            return False
+        if name == 'interactive':
+            return True
+        return total - self._running['interactive'] < self.capacity - self.reserved
+
+    def _next(self):
+        """The waiting request that should get the next slot, or None"""
+        for name in PRIORITY_CLASSES:
+            if self._waiting[name] and self._eligible(name):
+                return min(self._waiting[name], key=lambda w: (w['finish'], w['seq']))
+        return None
+
+    def _enqueue(self, name, tenant, cost, wake=None):
+        """Queue a waiter with its virtual start and finish tags (caller holds the condition)"""
+        start = max(self._virtual_time[name], self._finish_tags[(name, tenant)])
+        finish = start + cost / self.weights.get(tenant, 1.0)
+        self._finish_tags[(name, tenant)] = finish
+        waiter = {'start': start, 'finish': finish, 'seq': next(self._sequence), 'wake': wake}
+        self._waiting[name].append(waiter)
+        return waiter
+
+    def _admit(self, name, waiter, requested):
+        """Give a waiter its slot and record the wait (caller holds the condition)"""
+        self._waiting[name].remove(waiter)
+        self._running[name] += 1
+        self._virtual_time[name] = waiter['start']
+        self._forget_finish_tags(name)
+
+        waited = time.time() - requested
+        self._admitted[name] += 1
+        self._wait_total[name] += waited
+        self._wait_max[name] = max(self._wait_max[name], waited)
+        self._waits[name].append(waited)
+        # Another waiter may be eligible for a remaining slot
+        self._notify()
+        return waited
+
+    def _forget_finish_tags(self, name):
+        """
+        Drop the finish tags that no longer affect a start tag (caller holds the condition)
+
+        Tenants are client addresses, so tags would otherwise pile up for
+        every client ever seen. A tag at or behind the class's virtual time
+        changes nothing; once the class is idle, its virtual time moves to
+        the last finish tag (the end of an SFQ busy period) and all go.
+        """
+        tags = [(key, finish) for key, finish in self._finish_tags.items() if key[0] == name]
+        if not self._waiting[name] and self._running[name] == 0 and tags:
+            self._virtual_time[name] = max(self._virtual_time[name], max(finish for _, finish in tags))
+        for key, finish in tags:
+            if finish <= self._virtual_time[name]:
+                del self._finish_tags[key]
+
+    def _notify(self):
+        """Wake every waiter to check its turn (caller holds the condition)"""
+        self._condition.notify_all()
+        for waiters in self._waiting.values():
+            for waiter in waiters:
+                if waiter['wake'] is not None:
+                    waiter['wake']()
+
+    def acquire(self, name, tenant, cost=1.0):
+        """Block until a slot is granted; returns the seconds waited"""
+        requested = time.time()
+        with self._condition:
+            waiter = self._enqueue(name, tenant, cost)
+            while self._next() is not waiter:
+                self._condition.wait()
+            waited = self._admit(name, waiter, requested)
+        if waited > 1:
+            logger.info(f"{name} request for {tenant} waited {waited:.1f}s for an OpenAI slot")
+        return waited
+
+    async def acquire_async(self, name, tenant, cost=1.0):
+        """
+        Wait for a slot without blocking the event loop; returns the seconds waited
+
+        Async and thread waiters share one queue: whichever is next by class
+        and fair share gets the freed slot.
+        """
+        requested = time.time()
+        loop = asyncio.get_running_loop()
+        turn = asyncio.Event()
+        with self._condition:
+            waiter = self._enqueue(name, tenant, cost, wake=lambda: loop.call_soon_threadsafe(turn.set))
+        try:
+            while True:
+                with self._condition:
+                    if self._next() is waiter:
+                        waited = self._admit(name, waiter, requested)
+                        break
+                    turn.clear()
+                await turn.wait()
+        except BaseException:
+            # Cancelled while queued (e.g. the client went away): give up the place
+            with self._condition:
+                if waiter in self._waiting[name]:
+                    self._waiting[name].remove(waiter)
+                    self._notify()
+            raise
+        if waited > 1:
+            logger.info(f"{name} request for {tenant} waited {waited:.1f}s for an OpenAI slot")
+        return waited
+
+    def release(self, name):
+        with self._condition:
+            self._running[name] -= 1
+            self._forget_finish_tags(name)
+            self._notify()
+
+    @contextmanager
+    def slot(self, cost=1.0):
+        """Hold a slot for the current priority class and tenant"""
+        name, tenant = current_priority()
+        waited = self.acquire(name, tenant, cost)
+        annotate(priority=name, tenant=tenant, queued_seconds=round(waited, 3))
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    @asynccontextmanager
+    async def async_slot(self, cost=1.0):
+        """slot() for coroutines: waits in the event loop instead of a thread"""
+        name, tenant = current_priority()
+        waited = await self.acquire_async(name, tenant, cost)
+        annotate(priority=name, tenant=tenant, queued_seconds=round(waited, 3))
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self):
+        """
+        Queue depth and wait-time metrics per priority class
+
+        Returns:
+            dict: capacity, reserved and, per class, 'queued', 'running',
+                'admitted', 'wait_avg', 'wait_p50', 'wait_p95' and 'wait_max' (seconds)
+        """
+        with self._condition:
+            classes = {}
+            for name in PRIORITY_CLASSES:
+                waits = sorted(self._waits[name])
+                admitted = self._admitted[name]
+                classes[name] = {
+                    'queued': len(self._waiting[name]),
+                    'running': self._running[name],
+                    'admitted': admitted,
+                    'wait_avg': self._wait_total[name] / admitted if admitted else 0.0,
+                    'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+                    'wait_p95': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                    'wait_max': self._wait_max[name]
+                }
+            return {'capacity': self.capacity, 'reserved': self.reserved, 'classes': classes}
+
+
+# Shared scheduler for this process
+openai_scheduler = PriorityScheduler()
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+import db
+from metrics import cache_hits
+from scheduler import current_priority, PRIORITY_CLASSES
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# A leader's lease lasts this many seconds and is renewed every third of it while the
+# leader runs, so the lease of a worker that was killed is taken over soon after
+LEASE_TTL = int(os.getenv('SINGLEFLIGHT_LEASE_TTL', 30))
+
+# Finished results are shared with requests arriving this many seconds later
+RESULT_TTL = int(os.getenv('SINGLEFLIGHT_RESULT_TTL', 30))
+
+# How often waiters in other worker processes check for the leader's result: first
+# after POLL_INTERVAL, then twice as long each time up to MAX_POLL_INTERVAL (seconds)
+POLL_INTERVAL = 0.2
+MAX_POLL_INTERVAL = 2.0
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS inflight_requests (
+        key TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        status TEXT NOT NULL,
+        result TEXT,
+        started_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+]
+
+
+class _Call:
+    """An in-process computation that other threads can wait on"""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_calls = {}
+_lock = threading.Lock()
+_last_purge = 0
+
+
+def do(key, fn, *args, path=None, ttl=LEASE_TTL, **kwargs):
+    """
+    Run fn once for all concurrent callers with the same key
+
+    Threads of this process that ask for a key already being computed wait
+    for that computation and get its result (or exception). Across gunicorn
+    workers, the first caller takes a lease in the shared database and the
+    others poll for its result, which must therefore be JSON-serialisable.
+    If the leader in another worker fails or dies, a waiting worker takes
+    over and runs fn itself. A caller whose priority class (see
+    scheduler.priority) is higher than the leader's does not queue behind it
+    at the leader's priority either: it runs fn itself, unshared.
+
+    Args:
+        key (str): Content key, e.g. 'transcribe:<sha256 of the audio>'
+        fn (callable): The computation
+        *args: Positional arguments for fn
+        path (str): Database path for cross-worker leases
+        ttl (int): Seconds before an unfinished lease may be taken over
+        **kwargs: Keyword arguments for fn
+
+    Returns:
+        The result of fn
+    """
+    priority = current_priority()[0]
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call(priority)
+
+    if not leader:
+        if _outranks(priority, call.priority):
+            logger.info(f"Running {key} at {priority} priority instead of waiting for a {call.priority} leader")
+            return fn(*args, **kwargs)
+        logger.info(f"Waiting for in-flight {key}")
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        cache_hits.inc(cache='singleflight')
+        return call.result
+
+    try:
+        call.result = _run_shared(key, fn, args, kwargs, path, ttl)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _calls.pop(key, None)
+        call.done.set()
+
+
+def _outranks(priority, other):
+    """Whether a priority class comes before another (see scheduler.PRIORITY_CLASSES)"""
+    ranks = {name: rank for rank, name in enumerate(PRIORITY_CLASSES)}
+    return ranks.get(priority, len(ranks)) < ranks.get(other, len(ranks))
+
+
+def _new_owner():
+    """A lease owner id: this process, the caller's priority class and a unique part"""
+    return f"{os.getpid()}:{current_priority()[0]}:{uuid.uuid4().hex}"
+
+
+def _owner_priority(owner):
+    """The priority class a lease's leader runs at"""
+    parts = owner.split(':')
+    return parts[1] if len(parts) == 3 else 'standard'
+
+
+@contextmanager
+def _renewing(path, key, owner, ttl):
+    """Keep a lease alive while the block runs, renewing it every ttl / 3 seconds"""
+    stop = threading.Event()
+
+    def renew():
+        conn = db.connect(path)
+        while not stop.wait(ttl / 3):
+            conn.execute(
+                "UPDATE inflight_requests SET expires_at = ? WHERE key = ? AND owner = ? AND status = 'running'",
+                (time.time() + ttl, key, owner)
+            )
+
+    thread = threading.Thread(target=renew, name='singleflight-lease', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def _claim(conn, key, owner, ttl):
+    """
+    Take the lease on a key unless another worker holds a live one
+
+    Returns:
+        sqlite3.Row: The other worker's lease, or None if the lease is now ours
+    """
+    now = time.time()
+    with db.transaction(conn):
+        row = conn.execute("SELECT * FROM inflight_requests WHERE key = ?", (key,)).fetchone()
+        if row is None or row['expires_at'] <= now:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO inflight_requests (key, owner, status, result, started_at, expires_at)
+                VALUES (?, ?, 'running', NULL, ?, ?)
+                """,
+                (key, owner, now, now + ttl)
+            )
+            return None
+    return row
+
+
+def _poll(conn, key, owner, ttl):
+    """
+    Check on another worker's lease with a plain read; write only to take over
+    one that has expired (or been abandoned)
+
+    Returns:
+        sqlite3.Row: The other worker's lease, or None if the lease is now ours
+    """
+    row = conn.execute("SELECT * FROM inflight_requests WHERE key = ?", (key,)).fetchone()
+    if row is not None and row['expires_at'] > time.time():
+        return row
+    return _claim(conn, key, owner, ttl)
+
+
+def _abandon(conn, key, owner):
+    """Let a waiting worker retry rather than inherit the failure"""
+    conn.execute("DELETE FROM inflight_requests WHERE key = ? AND owner = ?", (key, owner))
+
+
+def _publish(conn, key, owner, result):
+    """Share the leader's result with waiting workers for RESULT_TTL seconds"""
+    try:
+        conn.execute(
+            "UPDATE inflight_requests SET status = 'done', result = ?, expires_at = ? WHERE key = ? AND owner = ?",
+            (json.dumps(result), time.time() + RESULT_TTL, key, owner)
+        )
+    except TypeError:
+        logger.warning(f"Result of {key} is not JSON-serialisable; not shared across workers")
+        conn.execute("DELETE FROM inflight_requests WHERE key = ? AND owner = ?", (key, owner))
+    _maybe_purge(conn)
+
+
+def _run_shared(key, fn, args, kwargs, path, ttl):
+    """Run fn under a cross-worker lease, or wait for the worker holding it"""
+    db.ensure_schema(path, 'singleflight', SCHEMA)
+    conn = db.connect(path)
+    owner = _new_owner()
+    delay = POLL_INTERVAL
+
+    row = _claim(conn, key, owner, ttl)
+    while row is not None:
+        if row['status'] == 'done':
+            logger.info(f"Reusing result of {key} computed by another worker")
+            cache_hits.inc(cache='singleflight')
+            return json.loads(row['result'])
+        if _outranks(_owner_priority(owner), _owner_priority(row['owner'])):
+            logger.info(f"Running {key} instead of waiting for a lower priority worker")
+            return fn(*args, **kwargs)
+        if delay == POLL_INTERVAL:
+            logger.info(f"Waiting for {key} in flight in another worker")
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_POLL_INTERVAL)
+        row = _poll(conn, key, owner, ttl)
+
+    try:
+        with _renewing(path, key, owner, ttl):
+            result = fn(*args, **kwargs)
+    except Exception:
+        _abandon(conn, key, owner)
+        raise
+    _publish(conn, key, owner, result)
+    return result
+
+
+_async_calls = {}
+
+
+async def do_async(key, fn, *args, path=None, ttl=LEASE_TTL, **kwargs):
+    """
+    do() for coroutines: fn is awaited once for all concurrent callers with the same key
+
+    Tasks of this event loop wait on the leader's future; other workers are
+    coordinated through the same database leases as do(), polled with
+    asyncio.sleep so waiting never blocks the loop.
+
+    Returns:
+        The result of fn
+    """
+    priority = current_priority()[0]
+    if key in _async_calls:
+        future, leader_priority = _async_calls[key]
+        if _outranks(priority, leader_priority):
+            logger.info(f"Running {key} at {priority} priority instead of waiting for a {leader_priority} leader")
+            return await fn(*args, **kwargs)
+        logger.info(f"Waiting for in-flight {key}")
+        # A waiter going away must not cancel the leader's work
+        result = await asyncio.shield(future)
+        cache_hits.inc(cache='singleflight')
+        return result
+
+    future = asyncio.get_running_loop().create_future()
+    _async_calls[key] = (future, priority)
+    try:
+        result = await _run_shared_async(key, fn, args, kwargs, path, ttl)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        # Mark the exception retrieved when nobody was waiting for it
+        future.exception()
+        raise
+    finally:
+        _async_calls.pop(key, None)
+
+
+async def _run_shared_async(key, fn, args, kwargs, path, ttl):
+    """_run_shared() for coroutines"""
+    db.ensure_schema(path, 'singleflight', SCHEMA)
+    conn = db.connect(path)
+    owner = _new_owner()
+    delay = POLL_INTERVAL
+
+    row = _claim(conn, key, owner, ttl)
+    while row is not None:
+        if row['status'] == 'done':
+            logger.info(f"Reusing result of {key} computed by another worker")
+            cache_hits.inc(cache='singleflight')
+            return json.loads(row['result'])
+        if _outranks(_owner_priority(owner), _owner_priority(row['owner'])):
+            logger.info(f"Running {key} instead of waiting for a lower priority worker")
+            return await fn(*args, **kwargs)
+        if delay == POLL_INTERVAL:
+            logger.info(f"Waiting for {key} in flight in another worker")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_POLL_INTERVAL)
+        row = _poll(conn, key, owner, ttl)
+
+    try:
+        with _renewing(path, key, owner, ttl):
+            result = await fn(*args, **kwargs)
+    except BaseException:
+        _abandon(conn, key, owner)
+        raise
+    _publish(conn, key, owner, result)
+    return result
+
+
+def _maybe_purge(conn):
+    """Delete expired leases and results at most once a minute in this process"""
+    global _last_purge
+    now = time.time()
+    if now - _last_purge > 60:
+        _last_purge = now
+        conn.execute("DELETE FROM inflight_requests WHERE expires_at <= ?", (now,))
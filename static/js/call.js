@@ -3,6 +3,8 @@ let callTimer;
 let callStartTime;
 let currentTranscript = '';
 let currentDTMFSequence = [];
+let callEventSource = null;
+let currentCallStatus = 'initiated';
 
 function formatPhoneNumber(phoneNumber) {
     // Remove all non-digit characters
@@ -61,8 +63,12 @@ async function handleMakeCall() {
             // Show modal with call details
             showCallStatusModal('Call initiated successfully. Waiting for connection...');
             
-            // Poll for call status and updates
-            pollCallStatus(data.call_sid);
+            // Subscribe to pushed call events (fall back to polling without EventSource)
+            if (window.EventSource) {
+                subscribeToCallEvents(data.call_sid);
+            } else {
+                pollCallStatus(data.call_sid);
+            }
         } else {
             showCallStatusModal(`Error: ${data.error || 'Failed to initiate call'}`);
         }
@@ -88,6 +94,118 @@ function stopCallTimer() {
     clearInterval(callTimer);
 }
 
+function describeCallStatus(status) {
+    switch (status) {
+        case 'initiated':
+            return 'Call initiated. Waiting for connection...';
+        case 'ringing':
+            return 'Call is ringing...';
+        case 'in-progress':
+        case 'answered':
+            return 'Call connected. Recording in progress...';
+        case 'completed':
+            return 'Call completed. Processing analysis...';
+        default:
+            return `Call status: ${status}`;
+    }
+}
+
+function describeStage(stage) {
+    switch (stage) {
+        case 'saving':
+            return 'Saving your recording...';
+        case 'recorded':
+            return 'Recording received. Waiting for transcription...';
+        case 'transcribing':
+            return 'Transcribing recording...';
+        case 'generating_flowchart':
+            return 'Generating flowchart...';
+        case 'analyzing':
+            return 'Analyzing IVR structure...';
+        default:
+            return `Processing: ${stage}`;
+    }
+}
+
+function redirectToInsights(analysis) {
+    // Stored analyses are looked up by id; older responses carry the full text
+    const params = analysis.analysis_id
+        ? new URLSearchParams({ analysis_id: analysis.analysis_id })
+        : new URLSearchParams({
+            transcript: analysis.transcript,
+            flowchart: analysis.flowchart
+        });
+    window.location.href = `/insights?${params.toString()}`;
+}
+
+function subscribeToCallEvents(callSid) {
+    if (callEventSource) {
+        callEventSource.close();
+    }
+
+    // The server pushes status, DTMF, transcript and stage events as they happen;
+    // EventSource reconnects on its own and resumes from the last event id.
+    const source = new EventSource(`/events/${encodeURIComponent(callSid)}`);
+    callEventSource = source;
+
+    source.addEventListener('status', (e) => {
+        const data = JSON.parse(e.data);
+        currentCallStatus = data.status;
+        showCallStatusModal(describeCallStatus(data.status));
+        if (['busy', 'failed', 'no-answer', 'canceled'].includes(data.status)) {
+            stopCallTimer();
+            source.close();
+        }
+    });
+
+    source.addEventListener('dtmf', (e) => {
+        const data = JSON.parse(e.data);
+        currentDTMFSequence.push(data.digits);
+        showCallStatusModal(describeCallStatus(currentCallStatus), data.digits);
+    });
+
+    source.addEventListener('transcript', (e) => {
+        const data = JSON.parse(e.data);
+        currentTranscript = data.transcript;
+        showCallStatusModal(describeCallStatus(currentCallStatus), null, currentTranscript);
+    });
+
+    // Live calls (LIVE_ANALYSIS) also push a flowchart that grows during the call
+    source.addEventListener('flowchart', (e) => {
+        const data = JSON.parse(e.data);
+        if (typeof updateLiveFlowchart === 'function') {
+            updateLiveFlowchart(data.flowchart);
+        }
+    });
+
+    source.addEventListener('stage', (e) => {
+        const data = JSON.parse(e.data);
+        showCallStatusModal(describeStage(data.stage));
+    });
+
+    source.addEventListener('analysis', (e) => {
+        const analysis = JSON.parse(e.data);
+        source.close();
+        stopCallTimer();
+        showCallStatusModal('Analysis complete!', null, analysis.transcript);
+        redirectToInsights(analysis);
+    });
+
+    source.addEventListener('error', (e) => {
+        // Server-sent error events carry data; connection errors do not and are retried
+        if (e.data) {
+            const data = JSON.parse(e.data);
+            source.close();
+            stopCallTimer();
+            showCallStatusModal(`Error: ${data.error}`);
+        } else if (source.readyState === EventSource.CLOSED) {
+            // Refused (e.g. 503 when the server has too many streams open): no retry, so poll instead
+            callEventSource = null;
+            pollCallStatus(callSid);
+        }
+    });
+}
+
 async function pollCallStatus(callSid) {
     let attempts = 0;
     const maxAttempts = 60; // 5 minutes maximum (5s * 60)
@@ -109,24 +227,7 @@ async function pollCallStatus(callSid) {
                 console.log('Status data:', statusData);
                 
                 // Update call status
-                let statusMessage = '';
-                switch (statusData.status) {
-                    case 'initiated':
-                        statusMessage = 'Call initiated. Waiting for connection...';
-                        break;
-                    case 'ringing':
-                        statusMessage = 'Call is ringing...';
-                        break;
-                    case 'in-progress':
-                    case 'answered':
-                        statusMessage = 'Call connected. Recording in progress...';
-                        break;
-                    case 'completed':
-                        statusMessage = 'Call completed. Processing analysis...';
-                        break;
-                    default:
-                        statusMessage = `Call status: ${statusData.status}`;
-                }
+                const statusMessage = describeCallStatus(statusData.status);
                 
                 // Update DTMF if detected
                 if (statusData.dtmf) {
@@ -146,17 +247,20 @@ async function pollCallStatus(callSid) {
                     showCallStatusModal(statusMessage);
                 }
                 
+                // The background analysis failed (its webhook will not be retried)
+                if (statusData.transcription_status === 'failed') {
+                    stopCallTimer();
+                    showCallStatusModal(`Error: ${statusData.transcription_error || 'The call could not be analysed'}`);
+                    return;
+                }
+                
                 // Check for analysis completion
                 if (statusData.analysis && statusData.analysis.transcript) {
                     console.log('Analysis complete:', statusData.analysis);
                     stopCallTimer();
                     showCallStatusModal('Analysis complete!', null, statusData.analysis.transcript);
                     // Redirect to insights page with the analysis data
-                    const params = new URLSearchParams({
-                        transcript: statusData.analysis.transcript,
-                        flowchart: statusData.analysis.flowchart
-                    });
-                    window.location.href = `/insights?${params.toString()}`;
+                    redirectToInsights(statusData.analysis);
                     return;
                 }
             } else {
@@ -165,7 +269,7 @@ async function pollCallStatus(callSid) {
             
             // Continue polling
             attempts++;
-            setTimeout(checkStatus, 1000); // Poll more frequently for real-time updates
+            setTimeout(checkStatus, 5000);
         } catch (error) {
             console.error('Error polling call status:', error);
             attempts++;
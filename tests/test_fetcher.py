@@ -0,0 +1,145 @@
+"""
+fetch_recording() against a local HTTP server standing in for Twilio/VOXO recording URLs
+
+    python -m pytest tests/test_fetcher.py
+"""
+
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import fetcher
+
+RECORDING = bytes(range(256)) * 1024  # 256KB, several FETCH_CHUNK_SIZE chunks
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """
+    Serves RECORDING; the server's attributes choose how it misbehaves
+
+    drops (int): Responses still to be cut off halfway through the body
+    honour_range (bool): Answer Range requests with 206 (else always 200 with the whole body)
+    send_length (bool): Send Content-Length (else the body ends when the connection closes)
+    delay (float): Seconds each response takes
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.headers.get('Range'))
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.delay)
+            start = 0
+            if server.honour_range and self.headers.get('Range'):
+                start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+                self.send_response(206)
+                self.send_header('Content-Range', f"bytes {start}-{len(RECORDING) - 1}/{len(RECORDING)}")
+            else:
+                self.send_response(200)
+            body = RECORDING[start:]
+            if server.send_length:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            with server.lock:
+                drop = server.drops > 0
+                server.drops -= drop
+            # A dropped connection: the declared length is never delivered
+            self.wfile.write(body[:len(body) // 2] if drop else body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.active = httpd.peak = 0
+    httpd.drops = 0
+    httpd.honour_range = True
+    httpd.send_length = True
+    httpd.delay = 0
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/recording.wav"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    """Resume at once instead of sleeping between attempts"""
+    monkeypatch.setattr(fetcher.time, 'sleep', lambda seconds: None)
+
+
+def test_resumes_with_range_after_dropped_connection(server, no_backoff, tmp_path):
+    server.drops = 1
+    path = tmp_path / 'recording.wav'
+
+    assert fetcher.fetch_recording(server.url, str(path)) == len(RECORDING)
+    assert path.read_bytes() == RECORDING
+    assert server.requests == [None, f"bytes={len(RECORDING) // 2}-"]
+
+
+def test_restarts_from_zero_when_server_ignores_range(server, no_backoff, tmp_path):
+    server.drops = 1
+    server.honour_range = False
+    path = tmp_path / 'recording.wav'
+
+    assert fetcher.fetch_recording(server.url, str(path)) == len(RECORDING)
+    assert path.read_bytes() == RECORDING
+    assert len(server.requests) == 2 and server.requests[1] is not None
+
+
+def test_gives_up_after_max_resumes(server, no_backoff, tmp_path):
+    server.drops = fetcher.FETCH_MAX_RESUMES + 1
+
+    with pytest.raises(fetcher.requests.RequestException):
+        fetcher.fetch_recording(server.url, str(tmp_path / 'recording.wav'))
+    assert len(server.requests) == fetcher.FETCH_MAX_RESUMES + 1
+
+
+def test_rejects_declared_size_over_cap(server, tmp_path):
+    with pytest.raises(ValueError, match='too large'):
+        fetcher.fetch_recording(server.url, str(tmp_path / 'recording.wav'), max_bytes=len(RECORDING) - 1)
+
+
+def test_stops_reading_past_cap_without_content_length(server, tmp_path):
+    server.send_length = False
+    max_bytes = fetcher.FETCH_CHUNK_SIZE
+
+    with pytest.raises(ValueError, match='too large'):
+        fetcher.fetch_recording(server.url, str(tmp_path / 'recording.wav'), max_bytes=max_bytes)
+    # At most one chunk past the cap reaches the disk
+    assert os.path.getsize(tmp_path / 'recording.wav') <= max_bytes + fetcher.FETCH_CHUNK_SIZE
+
+
+def test_concurrent_downloads_bounded_by_fetch_concurrency(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(fetcher, '_slots', threading.BoundedSemaphore(2))
+    server.delay = 0.2
+    errors = []
+
+    def fetch(n):
+        try:
+            fetcher.fetch_recording(server.url, str(tmp_path / f"recording-{n}.wav"))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(n,)) for n in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert not errors
+    assert len(server.requests) == 6
+    assert server.peak == 2
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Request-scoped tracing keyed by CallSid or upload id
+
+One IVR call is handled by several independent requests (/make-call,
+/twilio-ivr, /handle-dtmf, /recording-callback, /call-status, ...) and the
+background jobs they start. Every request opens a root span and everything
+it does - pipeline stages, OpenAI, Twilio and VOXO calls, recording
+downloads - is recorded as child spans. The trace id is derived from the
+CallSid (or upload id), so all requests of one call land in the same trace.
+
+Spans are appended to TRACE_FILE in the OTLP JSON format, one export
+request per line; the OpenTelemetry Collector reads such files with its
+otlpjsonfile receiver. TRACE_OTLP_ENDPOINT additionally posts them to a
+collector's OTLP/HTTP endpoint. Tracing is off unless TRACING_ENABLED=true.
+
+Break one call down from the file:
+
+    python tracing.py CA0123456789abcdef0123456789abcdef
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from metrics import stage_seconds
+from profiling import stage as profiled_stage
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Record traces at all
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'False').lower() == 'true'
+
+# File spans are appended to (OTLP JSON lines)
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join('instance', 'traces.jsonl'))
+
+# Optional OTLP/HTTP collector, e.g. http://localhost:4318
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT')
+
+SERVICE_NAME = 'echomap'
+
+_current = contextvars.ContextVar('trace_span', default=None)
+_write_lock = threading.Lock()
+
+
+class Trace:
+    """The spans of one request; they are exported together when its root span ends"""
+
+    def __init__(self, key=None):
+        self.key = key
+        self.root = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._anonymous_id = os.urandom(16).hex()
+
+    @property
+    def trace_id(self):
+        return _trace_id(self.key) if self.key else self._anonymous_id
+
+    def finish(self, span):
+        """Buffer spans until the root ends (its key may still be set); later ones go straight out"""
+        with self._lock:
+            if span is not self.root and self.root is not None and self.root.end_ns is None:
+                self._buffer.append(span)
+                return
+            spans, self._buffer = self._buffer + [span], []
+        export(self, spans)
+
+
+class Span:
+    """One timed step of a trace"""
+
+    def __init__(self, trace, name, parent=None, kind=1, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+def _trace_id(key):
+    """Stable 128-bit trace id for a CallSid or upload id"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def start_span(name, key=None, kind=1, **attributes):
+    """
+    Open a span under the current one and make it current
+
+    Returns:
+        tuple: (span, token) for end_span(); (None, None) when tracing is off
+    """
+    if not TRACING_ENABLED:
+        return None, None
+    parent = _current.get()
+    if parent is None:
+        trace = Trace(key)
+    else:
+        trace = parent.trace
+        if key and not trace.key:
+            trace.key = key
+    span = Span(trace, name, parent, kind, attributes)
+    if parent is None:
+        trace.root = span
+    return span, _current.set(span)
+
+
+def end_span(span, token, error=None):
+    """Close a span opened by start_span() and restore the previous one"""
+    if span is None:
+        return
+    _current.reset(token)
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.error = f"{type(error).__name__}: {str(error)}"
+    span.trace.finish(span)
+
+
+@contextmanager
+def span(name, kind=1, **attributes):
+    """
+    Record the block as a span of the current trace
+
+    Args:
+        name (str): Span name, e.g. 'openai.transcription'
+        kind (int): OTLP span kind (1 internal, 2 server, 3 client)
+        **attributes: Span attributes
+
+    Yields:
+        Span: The open span (None when tracing is off)
+    """
+    current, token = start_span(name, kind=kind, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        end_span(current, token, error=e)
+        raise
+    else:
+        end_span(current, token)
+
+
+@contextmanager
+def stage(name, source):
+    """Time a processing stage in the stage latency histogram, as a span and in request profiles"""
+    with stage_seconds.time(stage=name, source=source), span(f"stage.{name}", source=source), \
+            profiled_stage(name):
+        yield
+
+
+def set_key(key):
+    """Attach the current trace to a CallSid or upload id once it is known"""
+    current = _current.get()
+    if current is not None and key and not current.trace.key:
+        current.trace.key = key
+
+
+def annotate(**attributes):
+    """Add attributes to the current span, if any"""
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def to_otlp(trace, spans):
+    """Build an OTLP JSON ExportTraceServiceRequest for spans of one trace"""
+    otlp_spans = []
+    for s in spans:
+        attributes = dict(s.attributes, **{'echomap.trace_key': trace.key or ''})
+        otlp_spans.append({
+            'traceId': trace.trace_id,
+            'spanId': s.span_id,
+            'parentSpanId': s.parent_id or '',
+            'name': s.name,
+            'kind': s.kind,
+            'startTimeUnixNano': str(s.start_ns),
+            'endTimeUnixNano': str(s.end_ns),
+            'attributes': [_attribute(k, v) for k, v in attributes.items() if v is not None],
+            'status': {'code': 2, 'message': s.error} if s.error else {'code': 1}
+        })
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            _attribute('service.name', SERVICE_NAME), _attribute('process.pid', os.getpid())
+        ]},
+        'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': otlp_spans}]
+    }]}
+
+
+def export(trace, spans, path=None):
+    """Append spans to the trace file and send them to the collector, if configured"""
+    payload = to_otlp(trace, spans)
+    line = (json.dumps(payload, separators=(',', ':')) + '\n').encode('utf-8')
+    path = path or TRACE_FILE
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # One O_APPEND write per export keeps lines from different workers whole
+        with _write_lock:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+    except OSError as e:
+        logger.warning(f"Could not write trace: {str(e)}")
+
+    if TRACE_OTLP_ENDPOINT:
+        import jobs
+        jobs.submit(_post, payload)
+
+
+def _post(payload):
+    import requests
+    requests.post(f"{TRACE_OTLP_ENDPOINT.rstrip('/')}/v1/traces", json=payload, timeout=5).raise_for_status()
+
+
+def load_trace(key, path=None):
+    """
+    Read every span recorded for a CallSid or upload id
+
+    Returns:
+        list: Spans as dicts ('span_id', 'parent_id', 'name', 'start', 'end',
+            'attributes', 'error'), ordered by start time
+    """
+    trace_id = _trace_id(key)
+    spans = []
+    with open(path or TRACE_FILE, encoding='utf-8') as f:
+        for line in f:
+            for resource in json.loads(line)['resourceSpans']:
+                for scope in resource['scopeSpans']:
+                    for s in scope['spans']:
+                        if s['traceId'] != trace_id:
+                            continue
+                        spans.append({
+                            'span_id': s['spanId'],
+                            'parent_id': s['parentSpanId'] or None,
+                            'name': s['name'],
+                            'start': int(s['startTimeUnixNano']) / 1e9,
+                            'end': int(s['endTimeUnixNano']) / 1e9,
+                            'attributes': {a['key']: next(iter(a['value'].values())) for a in s['attributes']},
+                            'error': s['status'].get('message')
+                        })
+    return sorted(spans, key=lambda s: s['start'])
+
+
+def format_trace(spans):
+    """Render spans as an indented timeline: offset from the first span, duration, name"""
+    if not spans:
+        return 'No spans'
+    ids = {s['span_id'] for s in spans}
+    children = {}
+    for s in spans:
+        parent = s['parent_id'] if s['parent_id'] in ids else None
+        children.setdefault(parent, []).append(s)
+
+    origin = spans[0]['start']
+    lines = [f"{len(children.get(None, []))} request(s)/job(s) over {max(s['end'] for s in spans) - origin:.3f}s"]
+
+    def walk(parent, depth):
+        for s in children.get(parent, []):
+            skip = {'echomap.trace_key', 'http.method', 'http.route'}
+            details = ' '.join(f"{k}={v}" for k, v in s['attributes'].items() if k not in skip)
+            error = f"  ERROR {s['error']}" if s['error'] else ''
+            lines.append(
+                f"{s['start'] - origin:9.3f}s {(s['end'] - s['start']) * 1000:9.1f}ms  "
+                f"{'  ' * depth}{s['name']}  {details}{error}".rstrip()
+            )
+            walk(s['span_id'], depth + 1)
+
+    walk(None, 0)
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the recorded timeline of one call or upload")
+    parser.add_argument('key', help="CallSid, VOXO call id or upload id")
+    parser.add_argument('--file', default=TRACE_FILE, help="Trace file (default: TRACE_FILE)")
+    args = parser.parse_args()
+    print(format_trace(load_trace(args.key, args.file)))
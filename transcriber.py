@@ -1,14 +1,13 @@
-import openai
 import os
 import logging
-from dotenv import load_dotenv
+from contextlib import contextmanager
+from scheduler import openai_scheduler
+from metrics import upstream_errors
+from tracing import span
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
 def get_client():
     """Create and return an OpenAI client with error handling"""
     api_key = os.getenv("OPENAI_API_KEY")
@@ -16,22 +15,52 @@ def get_client():
         logger.critical("OPENAI_API_KEY not set in environment variables")
         raise ValueError("OPENAI_API_KEY environment variable is not set")
     
+    # The SDK takes a large share of worker start-up to import: load it on first use
+    import openai
     return openai.OpenAI(api_key=api_key)
 
-def transcribe_audio(filepath):
+_async_client = None
+
+def get_async_client():
+    """Return this process's shared AsyncOpenAI client (one connection pool for all coroutines)"""
+    global _async_client
+    if _async_client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            logger.critical("OPENAI_API_KEY not set in environment variables")
+            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        import openai
+        _async_client = openai.AsyncOpenAI(api_key=api_key)
+    return _async_client
+
+@contextmanager
+def openai_errors(action):
+    """Count failed OpenAI calls and re-raise them with the messages shown to users"""
+    import openai
+    try:
+        yield
+    except openai.APIError as e:
+        upstream_errors.inc(service='openai')
+        logger.error(f"API error: {str(e)}")
+        raise Exception(f"OpenAI API error: {str(e)}")
+    except openai.APIConnectionError as e:
+        upstream_errors.inc(service='openai')
+        logger.error(f"Connection error: {str(e)}")
+        raise Exception(f"Connection error: {str(e)}")
+    except openai.RateLimitError as e:
+        upstream_errors.inc(service='openai')
+        logger.error(f"Rate limit error: {str(e)}")
+        raise Exception("API rate limit exceeded. Please try again later.")
+    except Exception as e:
+        logger.error(f"Unexpected error during {action}: {str(e)}")
+        raise
+
+def check_audio_file(filepath):
     """
-    Transcribe an audio file using OpenAI's Whisper API
-    
-    Args:
-        filepath (str): Path to the audio file
-        
+    Check that an audio file exists and fits the Whisper API limit
+
     Returns:
-        str: The transcribed text
-        
-    Raises:
-        FileNotFoundError: If the audio file doesn't exist
-        ValueError: If the API key is not set or invalid
-        Exception: For other API errors
+        float: The file size in MB
     """
     logger.info(f"Transcribing file: {filepath}")
     
@@ -45,11 +74,32 @@ def transcribe_audio(filepath):
     if file_size > 25:
         logger.error(f"File too large: {file_size:.2f}MB (max 25MB)")
         raise ValueError(f"Audio file too large: {file_size:.2f}MB (max 25MB)")
+    return file_size
+
+def transcribe_audio(filepath):
+    """
+    Transcribe an audio file using OpenAI's Whisper API
     
-    try:
+    Args:
+        filepath (str): Path to the audio file
+        
+    Returns:
+        str: The transcribed text
+        
+    Raises:
+        FileNotFoundError: If the audio file doesn't exist
+        ValueError: If the API key is not set or invalid
+        Exception: For other API errors
+    """
+    file_size = check_audio_file(filepath)
+    
+    with openai_errors('transcription'):
         client = get_client()
         
-        with open(filepath, "rb") as audio_file:
+        # Longer recordings count for more of their tenant's fair share
+        with open(filepath, "rb") as audio_file, \
+                span('openai.transcription', kind=3, model='whisper-1', size_mb=round(file_size, 2)), \
+                openai_scheduler.slot(cost=max(1.0, file_size)):
             response = client.audio.transcriptions.create(
                 model="whisper-1",
                 file=audio_file
@@ -57,16 +107,25 @@ def transcribe_audio(filepath):
         
         logger.info("Transcription successful")
         return response.text
-        
-    except openai.APIError as e:
-        logger.error(f"API error: {str(e)}")
-        raise Exception(f"OpenAI API error: {str(e)}")
-    except openai.APIConnectionError as e:
-        logger.error(f"Connection error: {str(e)}")
-        raise Exception(f"Connection error: {str(e)}")
-    except openai.RateLimitError as e:
-        logger.error(f"Rate limit error: {str(e)}")
-        raise Exception("API rate limit exceeded. Please try again later.")
-    except Exception as e:
-        logger.error(f"Unexpected error during transcription: {str(e)}")
-        raise
\ No newline at end of file
+
+async def transcribe_audio_async(filepath):
+    """
+    transcribe_audio() for async request handlers
+
+    Waits for the OpenAI slot and the response in the event loop, so no
+    thread is held while Whisper works.
+    """
+    file_size = check_audio_file(filepath)
+
+    with openai_errors('transcription'):
+        client = get_async_client()
+        with open(filepath, "rb") as audio_file, \
+                span('openai.transcription', kind=3, model='whisper-1', size_mb=round(file_size, 2)):
+            async with openai_scheduler.async_slot(cost=max(1.0, file_size)):
+                response = await client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=audio_file
+                )
+
+        logger.info("Transcription successful")
+        return response.text
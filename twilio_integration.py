@@ -0,0 +1,104 @@
+import os
+from fetcher import fetch_recording
+from metrics import upstream_errors
+from tracing import span
+
+# Twilio call statuses after which nothing more will happen on a call
+TERMINAL_STATUSES = {'completed', 'busy', 'failed', 'no-answer', 'canceled'}
+
+
+def get_client(http_client=None):
+    """Create a Twilio REST client from the environment"""
+    account_sid = os.getenv('TWILIO_ACCOUNT_SID')
+    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+    if not all([account_sid, auth_token, os.getenv('TWILIO_NUMBER')]):
+        raise ValueError("Missing Twilio credentials in environment variables")
+    # The SDK is slow to import; only workers that place calls pay for it
+    from twilio.rest import Client
+    client = Client(account_sid, auth_token, http_client=http_client)
+    # A different REST API host, e.g. the stand-in used by loadtest.py
+    if os.getenv('TWILIO_API_BASE'):
+        client.api.base_url = os.getenv('TWILIO_API_BASE').rstrip('/')
+    return client
+
+
+def call_options(to_number, webhook_url, send_digits=None):
+    """Parameters of calls.create() for a call handed to the /twilio-ivr flow"""
+    options = dict(
+        to=to_number,
+        from_=os.getenv('TWILIO_NUMBER'),
+        url=f"{webhook_url}/twilio-ivr",
+        status_callback=f"{webhook_url}/call-status",
+        status_callback_event=['initiated', 'ringing', 'answered', 'completed'],
+        status_callback_method='POST',
+        machine_detection='DetectMessageEnd',  # Detect when answering machine message ends
+        machine_detection_timeout=30,  # Wait up to 30 seconds for machine detection
+        machine_detection_speech_threshold=3000,  # 3 seconds of speech to consider it a human
+        machine_detection_speech_end_threshold=1000,  # 1 second of silence to consider speech ended
+        machine_detection_silence_timeout=5000,  # 5 seconds of silence to consider it a machine
+    )
+    if send_digits:
+        options['send_digits'] = send_digits
+    return options
+
+
+def place_call(to_number, webhook_url, send_digits=None):
+    """
+    Dial a number and hand the call to the /twilio-ivr flow
+
+    Args:
+        to_number (str): E.164 number to call
+        webhook_url (str): Public base URL of this app (no trailing slash)
+        send_digits (str): DTMF digits Twilio plays once the call connects
+            ('w' waits half a second), used to navigate into a menu
+
+    Returns:
+        twilio.rest.api.v2010.account.call.CallInstance: The created call
+    """
+    client = get_client()
+
+    # Create the call with machine detection
+    try:
+        with span('twilio.calls.create', kind=3, send_digits=send_digits):
+            return client.calls.create(**call_options(to_number, webhook_url, send_digits))
+    except Exception:
+        upstream_errors.inc(service='twilio')
+        raise
+
+
+async def place_call_async(to_number, webhook_url, send_digits=None):
+    """place_call() for async request handlers; waits for Twilio in the event loop"""
+    from twilio.http.async_http_client import AsyncTwilioHttpClient
+    http_client = AsyncTwilioHttpClient()
+    client = get_client(http_client)
+    try:
+        with span('twilio.calls.create', kind=3, send_digits=send_digits):
+            return await client.calls.create_async(**call_options(to_number, webhook_url, send_digits))
+    except Exception:
+        upstream_errors.inc(service='twilio')
+        raise
+    finally:
+        await http_client.close()
+
+
+def recording_auth():
+    """Basic auth for Twilio recording URLs, if credentials are configured"""
+    if os.getenv('TWILIO_ACCOUNT_SID') and os.getenv('TWILIO_AUTH_TOKEN'):
+        return (os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+    return None
+
+
+def download_recording(recording_url, path, media_format='mp3'):
+    """
+    Stream a Twilio recording to a local file (see fetcher.fetch_recording)
+
+    Args:
+        recording_url (str): RecordingUrl from a Twilio callback (no extension)
+        path (str): Destination file
+        media_format (str): 'mp3' or 'wav'
+
+    Returns:
+        str: The destination path
+    """
+    fetch_recording(f"{recording_url}.{media_format}", path, auth=recording_auth())
+    return path
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Content-addressed upload storage
+
+Uploaded recordings are stored once per distinct content, named by their
+SHA-256 digest in sharded directories (objects/ab/cd/abcd....wav), so two
+customers' recording.wav never collide and repeated uploads cost no extra
+disk. Each digest remembers the analysis it produced, which lets a repeated
+upload be answered before any transcription happens.
+
+Files are pinned (reference counted) while a request is using them. A
+garbage collector deletes unpinned files that have not been used for
+UPLOAD_RETENTION seconds, and the least recently used ones whenever the
+store grows beyond UPLOAD_MAX_BYTES. The digest index outlives the files,
+so duplicates are still recognised after their audio has been collected.
+
+Run a collection by hand:
+
+    python upload_store.py --gc
+"""
+
+import os
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import db
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Unused files are deleted after this many seconds
+UPLOAD_RETENTION = int(os.getenv('UPLOAD_RETENTION', 7 * 24 * 60 * 60))
+
+# Upper bound on the disk used by stored uploads
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 1024 * 1024 * 1024))
+
+# Pins older than this are treated as leaked by a crashed request
+PIN_TIMEOUT = 60 * 60
+
+# How often each process runs the garbage collector after storing a file (seconds)
+GC_INTERVAL = 10 * 60
+
+CHUNK_SIZE = 64 * 1024
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS uploads (
+        digest TEXT PRIMARY KEY,
+        extension TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        stored INTEGER NOT NULL DEFAULT 1,
+        upload_count INTEGER NOT NULL DEFAULT 0,
+        analysis_id INTEGER,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_uploads_gc ON uploads (stored, refcount, last_used_at)",
+]
+
+
+def default_upload_root():
+    """Return the directory uploads are stored under"""
+    if os.getenv('UPLOAD_FOLDER'):
+        return os.getenv('UPLOAD_FOLDER')
+    # Render free tier has no persistent disk, so keep uploads in the temp directory
+    if os.getenv('RENDER', 'False').lower() == 'true':
+        return os.path.join(tempfile.gettempdir(), 'echomap-uploads')
+    return 'uploads'
+
+
+class UploadStore:
+    """Deduplicated, garbage-collected storage for uploaded recordings"""
+
+    def __init__(self, root=None, path=None, retention=UPLOAD_RETENTION, max_bytes=UPLOAD_MAX_BYTES):
+        """
+        Args:
+            root (str): Directory for stored files (defaults to default_upload_root())
+            path (str): Database path for the digest index
+            retention (int): Seconds an unused file is kept
+            max_bytes (int): Disk budget for stored files
+        """
+        self.root = root or default_upload_root()
+        self.path = path
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self._last_gc = 0
+
+    def _conn(self):
+        db.ensure_schema(self.path, 'upload_store', SCHEMA)
+        return db.connect(self.path)
+
+    def object_path(self, digest, extension):
+        """Sharded location of a stored file"""
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:4], f"{digest}.{extension}")
+
+    def put(self, stream, extension):
+        """
+        Store an upload and pin it for the caller
+
+        The stream is hashed while it is spooled to disk in chunks, so the
+        digest is known before any processing starts. Call release() once the
+        file is no longer needed.
+
+        Args:
+            stream: Binary file-like object with the upload
+            extension (str): File extension without the dot, e.g. 'wav'
+
+        Returns:
+            dict: 'digest', 'path', 'size', 'duplicate' (the content was
+                uploaded before) and 'analysis_id' (analysis of that content, if any)
+        """
+        spool = self.spool(extension)
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                spool.write(chunk)
+        except BaseException:
+            spool.abort()
+            raise
+        return spool.commit()
+
+    def spool(self, extension):
+        """
+        Start writing an upload that arrives in pieces
+
+        Returns:
+            UploadSpool: write() the bytes, then commit() to store and pin the
+                file (same result as put()) or abort() to discard it
+        """
+        return UploadSpool(self, extension)
+
+    def _commit(self, digest, extension, size, spool_path):
+        """Index a spooled file and move it into place unless the content is already stored"""
+        now = time.time()
+        conn = self._conn()
+        # File moves happen inside the write transaction so the collector never races them
+        with db.transaction(conn):
+            row = conn.execute("SELECT * FROM uploads WHERE digest = ?", (digest,)).fetchone()
+            if row is not None and row['stored'] and os.path.exists(self.object_path(digest, row['extension'])):
+                extension = row['extension']
+            else:
+                target = self.object_path(digest, extension)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(spool_path, target)
+            conn.execute(
+                """
+                INSERT INTO uploads (digest, extension, size, refcount, stored, upload_count, created_at, last_used_at)
+                VALUES (?, ?, ?, 1, 1, 1, ?, ?)
+                ON CONFLICT (digest) DO UPDATE SET
+                    extension = excluded.extension,
+                    refcount = refcount + 1,
+                    stored = 1,
+                    upload_count = upload_count + 1,
+                    last_used_at = excluded.last_used_at
+                """,
+                (digest, extension, size, now, now)
+            )
+        if row is not None:
+            logger.info(f"Duplicate upload {digest[:12]} (uploaded {row['upload_count'] + 1} times)")
+        return {
+            'digest': digest,
+            'path': self.object_path(digest, extension),
+            'size': size,
+            'duplicate': row is not None,
+            'analysis_id': row['analysis_id'] if row is not None else None
+        }
+
+    def release(self, digest):
+        """Unpin a file so the garbage collector may delete it"""
+        self._conn().execute(
+            "UPDATE uploads SET refcount = MAX(refcount - 1, 0), last_used_at = ? WHERE digest = ?",
+            (time.time(), digest)
+        )
+
+    def link_analysis(self, digest, analysis_id):
+        """Remember the analysis produced from an upload's content"""
+        self._conn().execute("UPDATE uploads SET analysis_id = ? WHERE digest = ?", (analysis_id, digest))
+
+    def get(self, digest):
+        """Return the index entry for a digest, or None"""
+        row = self._conn().execute("SELECT * FROM uploads WHERE digest = ?", (digest,)).fetchone()
+        return dict(row) if row else None
+
+    def usage(self):
+        """Return the number and total size of stored files"""
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM uploads WHERE stored = 1"
+        ).fetchone()
+        return dict(row)
+
+    def collect_garbage(self):
+        """
+        Delete expired files, then least recently used ones until under the size budget
+
+        Pinned files are kept unless their pin is older than PIN_TIMEOUT.
+
+        Returns:
+            dict: 'deleted' files and 'freed_bytes'
+        """
+        now = time.time()
+        deleted = freed = 0
+        conn = self._conn()
+        with db.transaction(conn):
+            unpinned = "stored = 1 AND (refcount = 0 OR last_used_at < ?)"
+            candidates = conn.execute(
+                f"SELECT digest, extension, size FROM uploads WHERE {unpinned} AND last_used_at < ?",
+                (now - PIN_TIMEOUT, now - self.retention)
+            ).fetchall()
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM uploads WHERE stored = 1").fetchone()[0]
+            total -= sum(row['size'] for row in candidates)
+            if total > self.max_bytes:
+                expired = {row['digest'] for row in candidates}
+                for row in conn.execute(
+                    f"SELECT digest, extension, size FROM uploads WHERE {unpinned} ORDER BY last_used_at",
+                    (now - PIN_TIMEOUT,)
+                ):
+                    if total <= self.max_bytes:
+                        break
+                    if row['digest'] not in expired:
+                        candidates.append(row)
+                        total -= row['size']
+
+            for row in candidates:
+                try:
+                    os.remove(self.object_path(row['digest'], row['extension']))
+                except FileNotFoundError:
+                    pass
+                conn.execute("UPDATE uploads SET stored = 0, refcount = 0 WHERE digest = ?", (row['digest'],))
+                deleted += 1
+                freed += row['size']
+
+        if deleted:
+            logger.info(f"Upload GC deleted {deleted} file(s), freed {freed / (1024 * 1024):.1f}MB")
+        return {'deleted': deleted, 'freed_bytes': freed}
+
+    def _maybe_collect(self):
+        """Run the garbage collector at most once per GC_INTERVAL in this process"""
+        if time.time() - self._last_gc > GC_INTERVAL:
+            self._last_gc = time.time()
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                logger.error(f"Upload garbage collection failed: {str(e)}", exc_info=True)
+
+
+class UploadSpool:
+    """
+    An upload being written to the store's incoming directory, hashed as it arrives
+
+    The spooled file is moved into place on commit(), so the bytes are
+    written to disk once.
+    """
+
+    def __init__(self, store, extension):
+        self.store = store
+        self.extension = extension.lower().lstrip('.')
+        incoming = os.path.join(store.root, 'incoming')
+        os.makedirs(incoming, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=incoming, suffix=f".{self.extension}")
+        self._file = os.fdopen(fd, 'wb')
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self._digest.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, extension=None):
+        """
+        Store the spooled file and pin it
+
+        Args:
+            extension (str): Store under this extension instead, e.g. the
+                format found in the file
+
+        Returns:
+            dict: As UploadStore.put()
+        """
+        try:
+            self._file.close()
+            extension = (extension or self.extension).lower().lstrip('.')
+            result = self.store._commit(self._digest.hexdigest(), extension, self.size, self.path)
+        finally:
+            self.abort()
+        self.store._maybe_collect()
+        return result
+
+    def abort(self):
+        """Discard the spooled bytes (a no-op once committed)"""
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Shared store for this process
+upload_store = UploadStore()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or garbage-collect stored uploads")
+    parser.add_argument('--gc', action='store_true', help="Delete expired and over-budget files")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.gc:
+        print(upload_store.collect_garbage())
+    print(upload_store.usage())
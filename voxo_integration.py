@@ -1,46 +1,64 @@
 import os
-import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import upstream_errors
+from tracing import span
 
 VOXO_API_KEY = os.getenv('VOXO_API_KEY')
 VOXO_API_BASE = os.getenv('VOXO_API_BASE', 'https://api.voxo.co/v1')
 VOXO_WEBHOOK_URL = os.getenv('VOXO_WEBHOOK_URL', 'https://944e-142-190-3-138.ngrok-free.app/voxo-webhook')
 
+# (connect, read) timeouts for VOXO API requests, in seconds
+VOXO_TIMEOUT = (5, 30)
+
+_session = None
+
+
+def get_session():
+    """Return a shared requests session with a connection pool and retries for idempotent calls"""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv('VOXO_POOL_SIZE', 10)), max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Authorization': f'Bearer {VOXO_API_KEY}'})
+        _session = session
+    return _session
+
+
+def _request(method, url, **kwargs):
+    """Send a VOXO API request, counting failures, and return the response"""
+    try:
+        with span(f"voxo {method}", kind=3, url=url):
+            response = get_session().request(method, url, timeout=VOXO_TIMEOUT, **kwargs)
+            response.raise_for_status()
+        return response
+    except requests.RequestException:
+        upstream_errors.inc(service='voxo')
+        raise
+
 
 def initiate_call_and_record(phone_number):
-    headers = {
-        'Authorization': f'Bearer {VOXO_API_KEY}',
-        'Content-Type': 'application/json'
-    }
+    """Start a recorded VOXO call; progress is reported to VOXO_WEBHOOK_URL"""
     payload = {
         'to': phone_number,
         'record': True,
         'webhook': VOXO_WEBHOOK_URL
     }
-    response = requests.post(f'{VOXO_API_BASE}/calls', json=payload, headers=headers)
-    response.raise_for_status()
+    response = _request('POST', f'{VOXO_API_BASE}/calls', json=payload)
     call_data = response.json()
     return call_data['call_id']
 
 
 def get_call_recording(call_id):
-    headers = {
-        'Authorization': f'Bearer {VOXO_API_KEY}',
-    }
-    for _ in range(30):
-        resp = requests.get(f'{VOXO_API_BASE}/calls/{call_id}', headers=headers)
-        resp.raise_for_status()
-        call_info = resp.json()
-        if call_info.get('recording_url'):
-            return call_info['recording_url']
-        time.sleep(5)
-    raise Exception('Recording not available after waiting.')
+    """Return the call's recording URL, or None if VOXO has not produced it yet (does not wait)"""
+    resp = _request('GET', f'{VOXO_API_BASE}/calls/{call_id}')
+    return resp.json().get('recording_url')
 
 
 def get_transcript_from_voxo(call_id):
-    headers = {
-        'Authorization': f'Bearer {VOXO_API_KEY}',
-    }
-    resp = requests.get(f'{VOXO_API_BASE}/calls/{call_id}/transcription', headers=headers)
-    resp.raise_for_status()
-    return resp.json().get('transcript') 
\ No newline at end of file
+    resp = _request('GET', f'{VOXO_API_BASE}/calls/{call_id}/transcription')
+    return resp.json().get('transcript')
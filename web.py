@@ -0,0 +1,437 @@
+"""
+Pages and uploads: the upload form (POST / runs the whole pipeline), the
+insights page, progress events and the Prometheus scrape endpoint
+"""
+
+import re
+import json
+import logging
+import threading
+from flask import (
+    Blueprint, current_app, render_template, request, flash, redirect, url_for, session, jsonify,
+    Response, stream_with_context, make_response, g
+)
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, NeedData, Epilogue
+from admission import admission, audio_cost, client_key
+from analytics_cache import analytics_cache, content_key
+from events import broker, stream
+from analysis_store import analysis_store
+from upload_store import upload_store, CHUNK_SIZE
+from audio_probe import AudioProbe, AudioError
+from pipeline import generate_flowchart_once, transcribe_upload, save_upload_analysis
+from scheduler import priority
+import tracing
+from tracing import stage
+from metrics import cache_hits, cache_misses, render as render_metrics
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+web = Blueprint('web', __name__)
+
+# Event channels are CallSids, VOXO call ids or client-generated upload ids
+CHANNEL_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Event streams open in this worker, capped by SSE_MAX_STREAMS
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+def allowed_file(filename):
+    """Check if the file has an allowed extension"""
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+
+def publish_stage(channel, stage, **data):
+    """Publish a processing stage event if a channel was provided"""
+    if channel:
+        broker.publish(channel, 'stage', dict(stage=stage, **data))
+
+def upload_error(message, status, is_ajax, upload_id=''):
+    """Answer a failed upload as JSON or on the upload page, and tell the upload's event stream"""
+    if upload_id:
+        broker.publish(upload_id, 'error', {'error': message})
+    if is_ajax:
+        return jsonify({'error': message}), status
+    return render_template('index.html', error=message), status
+
+def receive_upload():
+    """
+    Read the upload form of POST / as it arrives, validating and storing the audio
+
+    The multipart body is parsed chunk by chunk: the file's bytes go through an
+    AudioProbe and straight into an upload spool, so a corrupt, silent or too
+    long recording is refused as soon as its bytes show it - usually within the
+    first chunk - without reading the rest of the body, and a valid one is
+    written to disk once without being held in memory.
+
+    Returns:
+        tuple: (stored upload as from upload_store.put() plus its 'duration'
+            in seconds, upload_id, is_ajax, error response or None)
+    """
+    is_ajax = request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html
+    upload_id = ''
+    tracing.set_key(upload_id)
+
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        logger.warning("No file part in the request")
+        return None, upload_id, is_ajax, upload_error("No file uploaded.", 400, is_ajax, upload_id)
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'), request.max_form_memory_size)
+    part = None  # Field or File event of the part being read
+    value = bytearray()
+    spool = probe = None
+    try:
+        while True:
+            chunk = request.stream.read(CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, (Field, File)):
+                    part = event
+                    value.clear()
+                    if isinstance(part, File) and part.name == 'file':
+                        logger.debug(f"File received: {part.filename}")
+                        # Name checks need no audio: answer before reading any
+                        if part.filename == '':
+                            logger.warning("No selected file")
+                            return None, upload_id, is_ajax, upload_error("No file selected.", 400, is_ajax, upload_id)
+                        if not allowed_file(part.filename):
+                            logger.warning(f"Invalid file type: {part.filename}")
+                            return None, upload_id, is_ajax, upload_error(
+                                "Invalid file type. Please upload MP3, WAV, OGG, or M4A files.", 400, is_ajax, upload_id
+                            )
+                        publish_stage(upload_id, 'saving')
+                        spool = upload_store.spool(part.filename.rsplit('.', 1)[1])
+                        probe = AudioProbe()
+                elif isinstance(part, File):
+                    if part.name == 'file' and spool is not None:
+                        probe.feed(event.data)
+                        spool.write(event.data)
+                elif part is not None:
+                    value += event.data
+                    # Optional client-generated id used to stream progress events for this upload
+                    if not event.more_data and part.name == 'upload_id':
+                        upload_id = value.decode('utf-8', 'replace')
+                        if not CHANNEL_PATTERN.match(upload_id):
+                            upload_id = ''
+                        tracing.set_key(upload_id)
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+
+        if spool is None:
+            logger.warning("No file part in the request")
+            return None, upload_id, is_ajax, upload_error("No file uploaded.", 400, is_ajax, upload_id)
+        info = probe.finish()
+        # Stored under the format found in the file, whatever it was named
+        stored = dict(spool.commit(info['extension']), duration=info['duration'])
+        logger.info(
+            f"File validated: {part.filename} ({info['format']}/{info['codec']}, "
+            f"{info['sample_rate']}Hz, {info['duration']:.1f}s)"
+        )
+        return stored, upload_id, is_ajax, None
+    except AudioError as e:
+        logger.warning(f"Rejected upload: {str(e)}")
+        return None, upload_id, is_ajax, upload_error(str(e), e.status, is_ajax, upload_id)
+    except ValueError as e:
+        logger.warning(f"Malformed upload: {str(e)}")
+        return None, upload_id, is_ajax, upload_error("Malformed upload. Please try again.", 400, is_ajax, upload_id)
+    finally:
+        # Rejected or failed uploads leave nothing behind (a no-op once committed)
+        if spool is not None:
+            spool.abort()
+
+def duplicate_upload_response(analysis, upload_id, is_ajax):
+    """Answer an upload whose recording was analysed before with the stored analysis"""
+    logger.info(f"Returning analysis {analysis['id']} for duplicate upload")
+    if upload_id:
+        broker.publish(upload_id, 'analysis', {
+            'analysis_id': analysis['id'], 'transcript': analysis['transcript'], 'flowchart': analysis['flowchart']
+        })
+    if is_ajax:
+        return jsonify({
+            'analysis_id': analysis['id'], 'transcript': analysis['transcript'],
+            'flowchart': analysis['flowchart'], 'duplicate': True
+        }), 200
+    return render_template(
+        'insights.html',
+        transcript=analysis['transcript'],
+        flowchart=analysis['flowchart'],
+        metrics=analysis['metrics'],
+        summary=analysis['summary'],
+        visualization_data=json.dumps(analysis['visualization_data'])
+    )
+
+def upload_analysis_response(analysis_id, transcript, flowchart, result, upload_id, is_ajax):
+    """Publish a new upload analysis and answer with it as JSON or the insights page"""
+    logger.info("Rendering insights page")
+    if upload_id:
+        broker.publish(upload_id, 'analysis', {
+            'analysis_id': analysis_id, 'transcript': transcript, 'flowchart': flowchart
+        })
+    if is_ajax:
+        return jsonify({'analysis_id': analysis_id, 'transcript': transcript, 'flowchart': flowchart}), 200
+    with stage('render', 'upload'):
+        return render_template(
+            'insights.html',
+            transcript=transcript,
+            flowchart=flowchart,
+            metrics=result['metrics'],
+            summary=result['summary'],
+            visualization_data=json.dumps(result['visualization_data'])
+        )
+
+@web.route('/', methods=['GET', 'POST'])
+def index():
+    logger.info(f"[ROUTE] / (index) {request.method} {request.path}")
+    if request.method != 'POST':
+        logger.info("Rendering index page")
+        return render_template('index.html', transcript=None, flowchart=None, error=None)
+
+    logger.info("Received POST request for file upload")
+    # Validate the audio while it arrives and store it by content hash; identical uploads share one copy
+    with stage('upload_save', 'upload'):
+        stored, upload_id, is_ajax, error = receive_upload()
+    if error is not None:
+        return error
+
+    try:
+        filepath = stored['path']
+        logger.info(f"Stored upload {stored['digest'][:12]} at {filepath}")
+
+        # The same recording was analysed before: answer without reprocessing it
+        analysis = analysis_store.get(stored['analysis_id']) if stored['analysis_id'] else None
+        if analysis:
+            cache_hits.inc(cache='upload')
+            upload_store.release(stored['digest'])
+            return duplicate_upload_response(analysis, upload_id, is_ajax)
+
+        cache_misses.inc(cache='upload')
+        if g.get('admitted'):
+            # The recording's length is known now: it is what transcription will cost
+            admission.charge(client_key(), audio_cost(stored['duration']))
+
+        # Transcribe audio
+        logger.info(f"Starting transcription for file: {filepath}")
+        publish_stage(upload_id, 'transcribing')
+        try:
+            try:
+                # Someone is waiting on this page: ahead of call and crawl work
+                with priority('interactive', tenant=client_key()), \
+                        stage('transcription', 'upload'):
+                    transcript = transcribe_upload(filepath, stored['digest'])
+            finally:
+                # Only transcription reads the file; unpin it for the garbage collector
+                upload_store.release(stored['digest'])
+            logger.info(f"Transcription complete. Transcript length: {len(transcript)} characters")
+            logger.debug(f"Transcript preview: {transcript[:100]}")
+            
+            # Generate flowchart
+            logger.info("Starting flowchart generation")
+            publish_stage(upload_id, 'generating_flowchart')
+            try:
+                with priority('interactive', tenant=client_key()):
+                    flowchart = generate_flowchart_once(transcript)
+                logger.info(f"Flowchart generated. Length: {len(flowchart)} characters")
+                logger.debug(f"Processed flowchart preview: {flowchart[:100]}")
+            except Exception as e:
+                logger.error(f"Error generating flowchart: {str(e)}", exc_info=True)
+                return upload_error(f"Error generating flowchart: {str(e)}", 500, is_ajax, upload_id)
+        except Exception as e:
+            logger.error(f"Error transcribing audio: {str(e)}", exc_info=True)
+            return upload_error(f"Error transcribing audio: {str(e)}", 500, is_ajax, upload_id)
+        
+        # Analytics
+        logger.info("Starting analytics generation")
+        publish_stage(upload_id, 'analyzing')
+        try:
+            with stage('analytics', 'upload'):
+                result = analytics_cache.analyze(transcript, flowchart)
+            logger.info("Analytics complete")
+            logger.debug(f"Metrics keys: {list(result['metrics'].keys())}")
+            logger.debug(f"Summary: {result['summary']}")
+            analysis_id = save_upload_analysis(stored['digest'], transcript, flowchart, result)
+            return upload_analysis_response(analysis_id, transcript, flowchart, result, upload_id, is_ajax)
+        except Exception as e:
+            logger.error(f"Error generating insights: {str(e)}", exc_info=True)
+            if not is_ajax:
+                flash(f"Error generating insights: {str(e)}", 'error')
+            return upload_error(f"Error generating insights: {str(e)}", 500, is_ajax, upload_id)
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}", exc_info=True)
+        return upload_error(f"An unexpected error occurred: {str(e)}", 500, is_ajax, upload_id)
+
+def not_modified(etag):
+    """Return a 304 response if the client already holds this ETag, else None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+def render_insights(etag, transcript, flowchart, metrics, summary, visualization_data):
+    """Render the insights page with an ETag so repeat views can be revalidated"""
+    with stage('render', 'insights'):
+        page = render_template(
+            'insights.html',
+            transcript=transcript,
+            flowchart=flowchart,
+            metrics=metrics,
+            summary=summary,
+            visualization_data=json.dumps(visualization_data)
+        )
+    response = make_response(page)
+    response.set_etag(etag)
+    # Browsers keep the page but must revalidate it, which costs a 304 at most
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@web.route('/insights', methods=['GET', 'POST'])
+def insights():
+    logger.info(f"[ROUTE] /insights {request.method} {request.path}")
+
+    # Stored analyses are rendered straight from the history without recomputing
+    analysis_id = request.args.get('analysis_id', type=int)
+    if analysis_id:
+        analysis = analysis_store.get(analysis_id)
+        if not analysis:
+            flash('Analysis not found. Please upload an audio file first.', 'warning')
+            return redirect(url_for('web.index'))
+        etag = content_key(analysis['transcript'], analysis['flowchart'])
+        cached = not_modified(etag)
+        if cached is not None:
+            cache_hits.inc(cache='insights_etag')
+            logger.info(f"Insights for analysis {analysis_id} not modified")
+            return cached
+        return render_insights(
+            etag, analysis['transcript'], analysis['flowchart'],
+            analysis['metrics'], analysis['summary'], analysis['visualization_data']
+        )
+
+    transcript = request.args.get('transcript', '')
+    flowchart = request.args.get('flowchart', '')
+    
+    if not transcript or not flowchart:
+        logger.warning('No IVR data available for analysis. Redirecting to home.')
+        # Try to get from session if not in query params
+        transcript = session.get('transcript', '')
+        flowchart = session.get('flowchart', '')
+    
+    # If still no transcript or flowchart, redirect to home
+    if not transcript or not flowchart:
+        flash('No IVR data available for analysis. Please upload an audio file first.', 'warning')
+        logger.warning('No transcript or flowchart found. Redirecting to index.')
+        return redirect(url_for('web.index'))
+    
+    # Store in session (only when it changed, so repeat views don't rewrite the cookie)
+    if session.get('transcript') != transcript or session.get('flowchart') != flowchart:
+        session['transcript'] = transcript
+        session['flowchart'] = flowchart
+        logger.debug('Transcript and flowchart stored in session.')
+
+    # Repeat views of the same data are answered without computing or rendering
+    etag = content_key(transcript, flowchart)
+    cached = not_modified(etag)
+    if cached is not None:
+        cache_hits.inc(cache='insights_etag')
+        logger.info('Insights not modified')
+        return cached
+    
+    # Generate insights
+    try:
+        logger.info('Generating insights for /insights route')
+        with stage('analytics', 'insights'):
+            result = analytics_cache.analyze(transcript, flowchart)
+        logger.info('Insights generation complete. Rendering insights page.')
+        return render_insights(
+            etag, transcript, flowchart,
+            result['metrics'], result['summary'], result['visualization_data']
+        )
+        
+    except Exception as e:
+        logger.error(f"Error generating insights: {str(e)}", exc_info=True)
+        flash(f"Error generating insights: {str(e)}", 'error')
+        return redirect(url_for('web.index'))
+
+def open_stream():
+    """Claim one of this worker's SSE_MAX_STREAMS event streams, False if none is free"""
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= current_app.config['SSE_MAX_STREAMS']:
+            return False
+        _open_streams += 1
+        return True
+
+def close_stream():
+    """Give back an event stream claimed by open_stream()"""
+    global _open_streams
+    with _streams_lock:
+        _open_streams -= 1
+
+@web.route('/events/<channel>', methods=['GET'])
+def events(channel):
+    """Stream progress events for a call or upload as Server-Sent Events"""
+    if not CHANNEL_PATTERN.match(channel):
+        return jsonify({'error': 'Invalid event channel'}), 400
+
+    # EventSource sends Last-Event-ID when it reconnects after a dropped stream
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_id = 0
+
+    logger.info(f"[ROUTE] /events/{channel} (last event {last_id})")
+    max_duration = current_app.config['SSE_MAX_STREAM_SECONDS']
+    # A single-threaded server (a sync gunicorn worker) would serve nothing else while the stream is open
+    if not request.environ.get('wsgi.multithread') or not open_stream():
+        # EventSource gives up on a 503: the call page falls back to polling /call-status
+        logger.warning(f"Refused /events/{channel}: no thread to spare for another stream")
+        response = jsonify({'error': 'Too many open event streams', 'retry_after': max_duration})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(max_duration)
+        return response
+
+    response = Response(
+        stream_with_context(stream(broker, channel, last_id, max_duration=max_duration)),
+        mimetype='text/event-stream'
+    )
+    # Called by the server once the stream ends or the client goes away, started or not
+    response.call_on_close(close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx/Render)
+    return response
+
+@web.route('/latest-analysis', methods=['GET'])
+def latest_analysis_view():
+    """Return the latest analysis results as JSON"""
+    latest_analysis = analysis_store.latest()
+    if not latest_analysis:
+        return jsonify({
+            'transcript': '',
+            'flowchart': '',
+            'metrics': {},
+            'summary': '',
+            'visualization_data': {},
+            'dtmf_sequence': [],
+            'status': 'pending'
+        })
+        
+    return jsonify({
+        'id': latest_analysis['id'],
+        'transcript': latest_analysis['transcript'],
+        'flowchart': latest_analysis['flowchart'],
+        'metrics': latest_analysis['metrics'],
+        'summary': latest_analysis['summary'],
+        'visualization_data': latest_analysis['visualization_data'],
+        'dtmf_sequence': latest_analysis['dtmf_sequence'],
+        'timestamp': latest_analysis['created_at'],
+        'status': 'completed'
+    })
+
+@web.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage latency histograms and cache, retry and error counters of all workers"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')